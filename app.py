@@ -1,10 +1,23 @@
 import os
 import json
+import time
+import base64
+import hashlib
+import sqlite3
+import threading
+import contextvars
+import itertools
+import random
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import List, Dict, Any, Literal
+from typing import List, Dict, Any, Literal, Callable
 
 import numpy as np
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import openai
 from openai import OpenAI
 from dotenv import load_dotenv
 from pathlib import Path
@@ -24,11 +37,195 @@ load_dotenv()
 
 OPENAI_MODEL = os.getenv("EBCS_MODEL", "gpt-5-mini")
 EMBED_MODEL = os.getenv("EBCS_EMBED_MODEL", "text-embedding-3-large")
+# 一次 embeddings.create 最多带多少条文本
+EMBED_BATCH_SIZE = int(os.getenv("EBCS_EMBED_BATCH_SIZE", "64"))
+# Embedding 缓存：进程内 LRU + SQLite 磁盘层（路径设为空字符串即关闭磁盘层）
+EMBED_CACHE_PATH = os.getenv("EBCS_EMBED_CACHE_PATH", ".cache/ebcs_embeddings.sqlite3")
+EMBED_CACHE_MEM_ITEMS = int(os.getenv("EBCS_EMBED_CACHE_MEM_ITEMS", "2048"))
+EMBED_CACHE_DISK_ITEMS = int(os.getenv("EBCS_EMBED_CACHE_DISK_ITEMS", "50000"))
 # Qdrant
 QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 POLICY_COLLECTION = os.getenv("QDRANT_POLICY_COLLECTION", "policy_docs")
 THESES_COLLECTION = os.getenv("QDRANT_THESES_COLLECTION", "thesis_segments")
+# 每个 collection 的检索方式：
+# - "full":      直接在完整向量上检索（默认，对应未命名的默认向量）
+# - "two_stage": 先在截断维度的 named vector（COARSE_VECTOR_NAME）上粗排，
+#                再用完整向量（FULL_VECTOR_NAME）对 overfetch 的候选 rescoring
+POLICY_RETRIEVAL_MODE = os.getenv("EBCS_POLICY_RETRIEVAL_MODE", "full")
+THESES_RETRIEVAL_MODE = os.getenv("EBCS_THESES_RETRIEVAL_MODE", "full")
+FULL_VECTOR_NAME = os.getenv("EBCS_FULL_VECTOR_NAME", "full")
+COARSE_VECTOR_NAME = os.getenv("EBCS_COARSE_VECTOR_NAME", "coarse")
+COARSE_VECTOR_DIM = int(os.getenv("EBCS_COARSE_VECTOR_DIM", "256"))
+COARSE_OVERFETCH = int(os.getenv("EBCS_COARSE_OVERFETCH", "4"))
+# stage/mode/gap bonus 在哪里算："server"（Qdrant formula query，需要 Qdrant ≥ 1.14）或 "python"
+SCORING_MODE = os.getenv("EBCS_SCORING", "server")
+# server scoring 遇到暂时性错误（超时 / 断连 / 5xx）后，这么多秒内先用 python scoring，之后再试 server
+SCORING_RETRY_S = float(os.getenv("EBCS_SCORING_RETRY_S", "60"))
+# fix_raw_excerpt_md 结果的进程级 memo 上限（条数）
+FIXED_MD_CACHE_ITEMS = int(os.getenv("EBCS_FIXED_MD_CACHE_ITEMS", "4096"))
+# 检索命中 payload 对象的进程级 intern 表上限（条数）
+PAYLOAD_INTERN_ITEMS = int(os.getenv("EBCS_PAYLOAD_INTERN_ITEMS", "20000"))
+# 向量检索后端："qdrant"（远程 Qdrant）| "local"（进程内 mmap 矩阵，见 LocalVectorIndex）
+VECTOR_BACKEND = os.getenv("EBCS_VECTOR_BACKEND", "qdrant")
+# local 后端的索引目录：<dir>/<collection>/vectors.npy + payloads.jsonl
+LOCAL_INDEX_DIR = os.getenv("EBCS_LOCAL_INDEX_DIR", ".cache/local_index")
+# fuse_evidence 的 MMR 是否取回候选的存储向量（"0" 关闭：MMR 退化为按 score 排序）
+MMR_USE_VECTORS = os.getenv("EBCS_MMR_VECTORS", "1") == "1"
+# 检索阶段每个 session（每轮）同时在飞的检索请求上限；1 = 串行（先 policy 再 thesis）
+RETRIEVAL_MAX_INFLIGHT = int(os.getenv("EBCS_RETRIEVAL_MAX_INFLIGHT", "4"))
+# 所有 session 共享的检索线程池大小
+RETRIEVAL_POOL_SIZE = int(os.getenv("EBCS_RETRIEVAL_POOL_SIZE", "16"))
+# 路由 LLM 运行期间，用当前 alignment 推测执行子查询生成 + 检索（"1" 开启），见 SpeculativeRetrieval。
+# 和 EBCS_FUSED_INTAKE 互斥：两个都开时只用合并 intake（推测任务自己的子查询调用会和 intake 重复）
+SPECULATIVE_RETRIEVAL = os.getenv("EBCS_SPECULATIVE_RETRIEVAL", "0") == "1"
+SPECULATION_POOL_SIZE = int(os.getenv("EBCS_SPECULATION_POOL_SIZE", "8"))
+# 流式生成 CoachPlan：每条 recommendation 解析完整就先渲染出来（"0" 关闭，回到一次性 parse）
+STREAM_PLAN = os.getenv("EBCS_STREAM_PLAN", "1") == "1"
+# 合并 intake：一次 responses.parse 同时拿到路由结果和子查询（失败时回退到 route_and_maybe_ask + generate_subqueries）；
+# 开启时不做推测检索（见 SPECULATIVE_RETRIEVAL）
+FUSED_INTAKE = os.getenv("EBCS_FUSED_INTAKE", "0") == "1"
+# 本地路由：对话 embedding 对 stage / mode / gap 原型做最近质心分类，只有没把握时才调 LLM 路由
+LOCAL_ROUTER = os.getenv("EBCS_LOCAL_ROUTER", "0") == "1"
+# 滚动对话记忆（RollingMemory）：未折叠的原文超过 CONTEXT_FOLD_TOKENS 时，除最近 N 条外的原文
+# 在后台一次性折叠进摘要；每个用途的 task_context 有自己的 token 上限，
+# EBCS_CONTEXT_SITE_TOKENS 可覆盖，例如 "route=1200,plan=3000"
+CONTEXT_RECENT_MESSAGES = int(os.getenv("EBCS_CONTEXT_RECENT_MESSAGES", "4"))
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("EBCS_CONTEXT_SUMMARY_TOKENS", "400"))
+CONTEXT_SITE_TOKENS = {
+    # 路由 / 本地路由 / 追问 / 提醒
+    "route": 1500,
+    # 子查询生成、rerank 的 query、检索 embedding
+    "retrieval": 800,
+    "plan": 2500,
+}
+# evidence 打包的 token 预算（pack_evidence）：plan prompt 里所有 evidence 合计、rerank prompt 里所有候选合计，
+# 以及 rerank 单条 snippet 的上限（≈ 原来的 420 字符）和每条至少保留的 token 数
+PLAN_EVIDENCE_TOKENS = int(os.getenv("EBCS_PLAN_EVIDENCE_TOKENS", "2000"))
+RERANK_EVIDENCE_TOKENS = int(os.getenv("EBCS_RERANK_EVIDENCE_TOKENS", "2400"))
+RERANK_SNIPPET_MAX_TOKENS = int(os.getenv("EBCS_RERANK_SNIPPET_MAX_TOKENS", "105"))
+EVIDENCE_MIN_TOKENS = int(os.getenv("EBCS_EVIDENCE_MIN_TOKENS", "30"))
+CONTEXT_SITE_TOKENS.update({
+    site.strip(): int(tokens)
+    for site, _, tokens in (
+        item.partition("=") for item in os.getenv("EBCS_CONTEXT_SITE_TOKENS", "").split(",") if "=" in item
+    )
+})
+# 默认等于路由的预算：没超过之前路由看到的就是完整原文，不需要摘要
+CONTEXT_FOLD_TOKENS = int(os.getenv("EBCS_CONTEXT_FOLD_TOKENS", str(CONTEXT_SITE_TOKENS["route"])))
+ROUTER_PROTOTYPES_PATH = os.getenv("EBCS_ROUTER_PROTOTYPES", ".cache/router_prototypes.npz")
+ROUTER_TEMPERATURE = float(os.getenv("EBCS_ROUTER_TEMPERATURE", "0.05"))
+ROUTER_MIN_CONFIDENCE = float(os.getenv("EBCS_ROUTER_MIN_CONFIDENCE", "0.6"))
+# evidence rerank 后端："llm"（llm_rerank_evidence）或 "local"（CPU 上的 embedding + BM25 特征打分，不调 LLM）
+RERANKER = os.getenv("EBCS_RERANKER", "llm")
+# 一轮问答（路由 → 子查询 → 检索 → rerank → plan）的总延迟预算（秒），见 TurnBudget
+TURN_BUDGET_S = float(os.getenv("EBCS_TURN_BUDGET_S", "90"))
+# 没有 TurnBudget 时单次 LLM 请求的超时（秒）；SDK 默认是 10 分钟
+LLM_TIMEOUT_S = float(os.getenv("EBCS_LLM_TIMEOUT_S", "60"))
+# call_llm 响应缓存：条数上限 + 每个 call site 的 TTL（秒，0 = 不缓存）。
+# EBCS_LLM_CACHE_TTLS 可覆盖部分 site，例如 "route=300,rerank=0"
+LLM_CACHE_ITEMS = int(os.getenv("EBCS_LLM_CACHE_ITEMS", "1024"))
+LLM_CACHE_TTLS = {
+    "route": 900,
+    "subqueries": 3600,
+    "rerank": 3600,
+    # 面向学生的措辞类输出不缓存
+    "followup": 0,
+    "warning": 0,
+    # 滚动摘要的输入就是旧摘要 + 要折叠的消息，结果确定，可以缓存
+    "summary": 3600,
+}
+LLM_CACHE_TTLS.update({
+    site.strip(): int(ttl)
+    for site, _, ttl in (
+        item.partition("=") for item in os.getenv("EBCS_LLM_CACHE_TTLS", "").split(",") if "=" in item
+    )
+})
+# 用量计费：每百万 token 的美元价格 (input, cached input, output)，按模型名（或其前缀，兼容带日期的快照名）查。
+# EBCS_OPENAI_PRICES 可覆盖/补充，例如 "gpt-5-mini=0.25/0.025/2.0,text-embedding-3-large=0.13/0/0"
+OPENAI_PRICES_PER_M = {
+    "gpt-5": (1.25, 0.125, 10.0),
+    "gpt-5-mini": (0.25, 0.025, 2.0),
+    "gpt-5-nano": (0.05, 0.005, 0.40),
+    "gpt-4.1": (2.0, 0.50, 8.0),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "text-embedding-3-large": (0.13, 0.0, 0.0),
+    "text-embedding-3-small": (0.02, 0.0, 0.0),
+}
+OPENAI_PRICES_PER_M.update({
+    model.strip(): tuple(float(p) for p in prices.split("/"))
+    for model, _, prices in (
+        item.partition("=") for item in os.getenv("EBCS_OPENAI_PRICES", "").split(",") if "=" in item
+    )
+})
+# LLM 调用的容错层（见 resilient_call）：429/5xx/超时 按 full-jitter 指数退避重试，
+# 连续失败 LLM_BREAKER_FAILURES 次后熔断 LLM_BREAKER_COOLDOWN_S 秒，期间直接走模板兜底
+LLM_RETRIES = int(os.getenv("EBCS_LLM_RETRIES", "2"))
+LLM_BACKOFF_BASE_S = float(os.getenv("EBCS_LLM_BACKOFF_BASE_S", "0.5"))
+LLM_BACKOFF_MAX_S = float(os.getenv("EBCS_LLM_BACKOFF_MAX_S", "8"))
+LLM_BREAKER_FAILURES = int(os.getenv("EBCS_LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("EBCS_LLM_BREAKER_COOLDOWN_S", "30"))
+# 每个 call site 单次请求的超时（秒）；整体仍不超过调用方给的 timeout（TurnBudget）。
+# EBCS_LLM_SITE_TIMEOUTS 可覆盖，例如 "route=15,plan=120"
+LLM_SITE_TIMEOUTS = {
+    "route": 20,
+    "route_fallback": 15,
+    "subqueries": 20,
+    # 合并 intake 一次做路由 + 子查询
+    "intake": 30,
+    "rerank": 30,
+    "followup": 20,
+    "warning": 20,
+    "warning_fallback": 20,
+    "summary": 20,
+    "plan": 90,
+}
+LLM_SITE_TIMEOUTS.update({
+    site.strip(): float(sec)
+    for site, _, sec in (
+        item.partition("=") for item in os.getenv("EBCS_LLM_SITE_TIMEOUTS", "").split(",") if "=" in item
+    )
+})
+# hedged requests：请求超过该 site 近期延迟的 LLM_HEDGE_QUANTILE 分位还没回来，就再发一份，取先回来的。
+# 会多花 token，默认关闭；只对短小、幂等的 site 开
+LLM_HEDGE = os.getenv("EBCS_LLM_HEDGE", "0") == "1"
+LLM_HEDGE_SITES = set(os.getenv("EBCS_LLM_HEDGE_SITES", "route,subqueries,rerank").split(","))
+LLM_HEDGE_QUANTILE = float(os.getenv("EBCS_LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("EBCS_LLM_HEDGE_MIN_SAMPLES", "20"))
+# 每个 call site 用哪个调用 profile（model / reasoning effort / verbosity / 输出上限 / 超时，见 LLMProfile）。
+# EBCS_LLM_PROFILES：JSON（或 JSON 文件路径），按字段覆盖/新增 profile，例如
+#   '{"classify": {"model": "gpt-5-nano"}, "plan": {"reasoning_effort": "low", "timeout_s": 60}}'
+# EBCS_LLM_SITE_PROFILES：覆盖 site → profile，例如 "rerank=classify,followup=plan"
+LLM_PROFILE_DEFAULTS = {
+    "default": {},
+    # 短的分类 / JSON 输出
+    "classify": {"reasoning_effort": "minimal", "verbosity": "low", "max_output_tokens": 1200},
+    # rerank 要输出每个候选一条 JSON，留多一点
+    "rerank": {"reasoning_effort": "minimal", "verbosity": "low", "max_output_tokens": 3000},
+    # 给学生看的短文本（追问 / 提醒 / 摘要）
+    "write": {"reasoning_effort": "low", "verbosity": "low", "max_output_tokens": 1500},
+    "plan": {"reasoning_effort": "medium", "verbosity": "medium", "max_output_tokens": 8000},
+}
+LLM_PROFILES_CONFIG = os.getenv("EBCS_LLM_PROFILES", "")
+LLM_SITE_PROFILES = {
+    "route": "classify",
+    "intake": "classify",
+    "subqueries": "classify",
+    "rerank": "rerank",
+    "route_fallback": "write",
+    "followup": "write",
+    "warning": "write",
+    "warning_fallback": "write",
+    "summary": "write",
+    "plan": "plan",
+}
+LLM_SITE_PROFILES.update({
+    site.strip(): profile.strip()
+    for site, _, profile in (
+        item.partition("=") for item in os.getenv("EBCS_LLM_SITE_PROFILES", "").split(",") if "=" in item
+    )
+})
 
 from qdrant_client import QdrantClient, models
 
@@ -128,6 +325,36 @@ chat_turns_ebcs_table = Table(
     Column("retrieved_scores", Text),
 )
 
+# 每轮触发的降级（TurnBudget.degradations）：一行一个，和 chat_turns_ebcs 通过 user_id + turn_index 对应。
+# 单独建表而不是给 chat_turns_ebcs 加列：没迁移的库上只丢降级记录，不影响问答日志。
+turn_degradations_ebcs_table = Table(
+    "turn_degradations_ebcs", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("user_id", String(64)),
+    Column("turn_index", Integer),
+    Column("timestamp_answer", Text),
+    Column("degradation", String(64)),
+)
+
+# 每轮 OpenAI 用量：一行一个 (call site, model)，和 chat_turns_ebcs 通过 user_id + turn_index 对应
+turn_usage_ebcs_table = Table(
+    "turn_usage_ebcs", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("user_id", String(64)),
+    Column("turn_index", Integer),
+    Column("timestamp_answer", Text),
+    Column("site", String(64)),
+    Column("model", String(128)),
+    Column("calls", Integer),
+    Column("cache_hits", Integer),
+    Column("input_tokens", Integer),
+    Column("cached_input_tokens", Integer),
+    Column("reasoning_tokens", Integer),
+    Column("output_tokens", Integer),
+    Column("wall_ms", Float),
+    Column("cost_usd", Float),
+)
+
 evidence_events_ebcs_table = Table(
     "evidence_events_ebcs", metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
@@ -176,6 +403,273 @@ def log_step(msg: str):
     print(msg)  # 本地跑的话直接在 terminal 里也能看到
 
 
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+@lru_cache(maxsize=1)
+def _token_encoder():
+    """装了 tiktoken（可选依赖）且编码表能加载时用 o200k_base 精确计数，否则返回 None 用启发式。"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    token 数估计，用于预算：有 tiktoken 就精确计数；否则 CJK 字符按 1 个 token，
+    其余按 4 个字符 1 个 token。
+    """
+    if not text:
+        return 0
+    encoder = _token_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    n_cjk = len(_CJK_RE.findall(text))
+    return n_cjk + (len(text) - n_cjk + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep: Literal["head", "tail"] = "tail") -> str:
+    """把 text 截到 estimate_tokens ≤ max_tokens；keep="tail" 保留末尾（最近的内容），"head" 保留开头。"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    # 二分找能保留的最多字符数
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        piece = text[-mid:] if keep == "tail" else text[:mid]
+        if estimate_tokens(piece) <= max_tokens - 1:
+            lo = mid
+        else:
+            hi = mid - 1
+    return "…" + text[-lo:] if keep == "tail" else text[:lo] + "…"
+
+
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?。！？；;])\s+|\n+")
+
+
+def trim_to_sentences(text: str, max_tokens: int) -> str:
+    """按句子边界把 text 截到约 max_tokens：保留能放下的前几句；第一句都放不下时按 token 硬截。"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    kept: List[str] = []
+    used = 1  # 结尾的 "…"
+    for sentence in _SENTENCE_END_RE.split(text.strip()):
+        if not sentence.strip():
+            continue
+        cost = estimate_tokens(sentence) + 1
+        if used + cost > max_tokens:
+            break
+        kept.append(sentence)
+        used += cost
+    if not kept:
+        return truncate_to_tokens(text, max_tokens, keep="head")
+    return " ".join(kept) + " …"
+
+
+def allocate_token_budget(costs: List[int], scores: List[float], budget: int, floor: int) -> List[int]:
+    """
+    把 budget 个 token 分给各条 evidence：先每条给 min(cost, floor)（放不下时按 score 从高到低给），
+    剩下的按 score 比例分配（water-filling：每条不超过自己的完整 cost，用不完的再分给其余的）。
+    """
+    n = len(costs)
+    alloc = [0] * n
+    order = sorted(range(n), key=lambda i: -scores[i])
+    remaining = budget
+    for i in order:
+        give = min(costs[i], floor, max(remaining, 0))
+        alloc[i] = give
+        remaining -= give
+
+    weights = [max(float(s), 1e-6) for s in scores]
+    active = [i for i in order if alloc[i] < costs[i]]
+    while remaining > 0 and active:
+        total_w = sum(weights[i] for i in active)
+        spent = 0
+        for i in active:
+            extra = min(costs[i] - alloc[i], int(remaining * weights[i] / total_w))
+            alloc[i] += extra
+            spent += extra
+        if spent == 0:
+            # 剩下的零头不够按比例分：整块给分数最高的
+            i = active[0]
+            extra = min(costs[i] - alloc[i], remaining)
+            alloc[i] += extra
+            spent = extra
+        remaining -= spent
+        active = [i for i in active if alloc[i] < costs[i]]
+    return alloc
+
+
+def pack_evidence(
+        headers: List[str],
+        snippets: List[str],
+        scores: List[float],
+        budget_tokens: int,
+        max_snippet_tokens: int | None = None,
+        label: str = "evidence",
+) -> List[str]:
+    """
+    在 budget_tokens 内打包 evidence：header（id + 标题）原样保留，snippet 的 token 按 score 分配
+    （allocate_token_budget），超出分配的按句子边界截断（trim_to_sentences）。
+    max_snippet_tokens: 单条 snippet 的上限。返回截断后的 snippets，并 log 省下的 token 数。
+    """
+    if not snippets:
+        return []
+    full = [estimate_tokens(s) for s in snippets]
+    costs = [min(c, max_snippet_tokens) if max_snippet_tokens else c for c in full]
+    snippet_budget = budget_tokens - sum(estimate_tokens(h) + 2 for h in headers)
+    alloc = allocate_token_budget(costs, scores, max(snippet_budget, 0), EVIDENCE_MIN_TOKENS)
+
+    packed = [
+        s if a >= c else (trim_to_sentences(s, a) if a > 0 else "")
+        for s, a, c in zip(snippets, alloc, full)
+    ]
+    before, after = sum(full), sum(estimate_tokens(p) for p in packed)
+    n_trimmed = sum(1 for s, p in zip(snippets, packed) if p != s)
+    if n_trimmed:
+        log_step(
+            f"[{label}] packed {len(snippets)} snippets: {before} → {after} tokens "
+            f"(saved {before - after}, {n_trimmed} trimmed, budget {budget_tokens})"
+        )
+    return packed
+
+
+class TurnBudget:
+    """
+    一轮问答的延迟预算。每个阶段在预算的某个累计比例处截止（cutoffs），
+    LLM 请求的 timeout 取到该阶段截止的剩余时间；可选阶段时间不够就降级而不是继续等：
+    - subqueries 没时间 → 只用原始问题做一条子查询（raw_query_subquery）
+    - rerank 没时间     → 跳过 LLM rerank（skip_rerank）
+    - 留给 plan 的时间不足 → 少选几条 evidence，缩短 plan 的 prompt（shrink_total_k）
+    - 检索后没时间取向量 → MMR 退化为按 score 排序（skip_mmr_vectors）
+    - plan 请求失败 / LLM 熔断 → 用 evidence 拼的模板 plan（template_plan）
+    触发过的降级记在 degradations 里，每轮写进 turn_degradations_ebcs（见 log_turn_degradations）。
+    """
+
+    cutoffs = {"route": 0.20, "subqueries": 0.30, "retrieval": 0.45, "rerank": 0.65, "plan": 1.0}
+
+    def __init__(self, total_s: float = TURN_BUDGET_S):
+        self.total_s = total_s
+        self.start = time.monotonic()
+        self.degradations: List[str] = []
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def remaining(self, stage: str = "plan") -> float:
+        """到 stage 截止还剩多少秒（可能为负）。"""
+        return self.cutoffs[stage] * self.total_s - self.elapsed()
+
+    def share(self, stage: str) -> float:
+        """stage 自己分到的秒数（与上一个阶段截止之间的间隔）。"""
+        stages = list(self.cutoffs)
+        i = stages.index(stage)
+        prev = self.cutoffs[stages[i - 1]] if i else 0.0
+        return (self.cutoffs[stage] - prev) * self.total_s
+
+    def allows(self, stage: str, min_s: float) -> bool:
+        return self.remaining(stage) >= min_s
+
+    def timeout(self, stage: str, floor_s: float = 5.0) -> float:
+        """给 stage 内 LLM 请求的 timeout；必需的阶段（route/plan）至少给 floor_s 秒。"""
+        return max(floor_s, self.remaining(stage))
+
+    def degrade(self, what: str):
+        if what not in self.degradations:
+            self.degradations.append(what)
+        log_step(f"[budget] degrade: {what} at {self.elapsed():.1f}s / {self.total_s:.0f}s")
+
+    def fork(self) -> "TurnBudget":
+        """同一个截止时间、独立的 degradations（推测执行用：结果被丢弃时降级也不算数）。"""
+        child = TurnBudget(self.total_s)
+        child.start = self.start
+        return child
+
+    def absorb(self, child: "TurnBudget"):
+        for what in child.degradations:
+            if what not in self.degradations:
+                self.degradations.append(what)
+
+
+class UsageMeter:
+    """
+    一轮问答里所有 OpenAI 调用的用量：按 (site, model) 累计调用次数、缓存命中、
+    input / cached input / reasoning / output token、墙钟时间和估算费用。
+    当前轮的 meter 放在 contextvar CURRENT_USAGE 里，call_llm / generate_coach_plan / embed_* 通过
+    record_usage 记账；线程池任务用 contextvars.copy_context() 带上它（见 run_bounded / SpeculativeRetrieval）。
+    """
+
+    fields = ("calls", "cache_hits", "input_tokens", "cached_input_tokens",
+              "reasoning_tokens", "output_tokens", "wall_ms", "cost_usd")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sites: Dict[tuple, Dict[str, float]] = {}
+
+    def _row(self, site: str, model: str) -> Dict[str, float]:
+        return self.sites.setdefault((site, model), dict.fromkeys(self.fields, 0))
+
+    def record(self, site: str, model: str, usage: Any, wall_s: float):
+        """usage 可以是 Responses 的 ResponseUsage，也可以是 Embeddings 的 usage（只有 prompt_tokens）。"""
+        input_tokens = getattr(usage, "input_tokens", None)
+        if input_tokens is None:
+            input_tokens = getattr(usage, "prompt_tokens", 0)
+        input_tokens = input_tokens or 0
+        cached = getattr(getattr(usage, "input_tokens_details", None), "cached_tokens", 0) or 0
+        reasoning = getattr(getattr(usage, "output_tokens_details", None), "reasoning_tokens", 0) or 0
+        output_tokens = getattr(usage, "output_tokens", 0) or 0
+        cost = estimate_cost_usd(model, input_tokens, cached, output_tokens)
+        with self._lock:
+            row = self._row(site, model)
+            row["calls"] += 1
+            row["input_tokens"] += input_tokens
+            row["cached_input_tokens"] += cached
+            row["reasoning_tokens"] += reasoning
+            row["output_tokens"] += output_tokens
+            row["wall_ms"] += wall_s * 1000
+            row["cost_usd"] += cost
+
+    def record_cache_hit(self, site: str, model: str, n: int = 1):
+        with self._lock:
+            self._row(site, model)["cache_hits"] += n
+
+    def rows(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [{"site": site, "model": model, **row} for (site, model), row in self.sites.items()]
+
+    def totals(self) -> Dict[str, float]:
+        out = dict.fromkeys(self.fields, 0)
+        for row in self.rows():
+            for f in self.fields:
+                out[f] += row[f]
+        return out
+
+
+CURRENT_USAGE: contextvars.ContextVar[UsageMeter | None] = contextvars.ContextVar("ebcs_usage", default=None)
+
+
+def estimate_cost_usd(model: str, input_tokens: int, cached_tokens: int, output_tokens: int) -> float:
+    prices = OPENAI_PRICES_PER_M.get(model)
+    if prices is None:
+        # 带日期的快照名（gpt-5-mini-2025-08-07）按最长前缀匹配
+        matches = [m for m in OPENAI_PRICES_PER_M if model.startswith(m + "-")]
+        if not matches:
+            return 0.0
+        prices = OPENAI_PRICES_PER_M[max(matches, key=len)]
+    p_in, p_cached, p_out = prices
+    return ((input_tokens - cached_tokens) * p_in + cached_tokens * p_cached + output_tokens * p_out) / 1e6
+
+
+def record_usage(site: str, model: str, usage: Any, wall_s: float):
+    meter = CURRENT_USAGE.get()
+    if meter is not None and usage is not None:
+        meter.record(site, model, usage, wall_s)
+
+
 def login_page():
     # If already logged in, skip login screen
     if st.session_state.get("user_id"):
@@ -951,13 +1445,245 @@ def extract_json(text: str):
         raise ValueError("No JSON found")
 
 
-def embed_text(text: str) -> List[float]:
+class EmbeddingCache:
+    """
+    两级 embedding 缓存，key = sha256(EMBED_MODEL + 归一化后的文本)：
+    - 进程内 LRU（OrderedDict），按条数上限淘汰；
+    - SQLite 磁盘层（float32 bytes），容器重启后依然有效，按 last_used 淘汰最久未用的。
+    hits / misses 计数在 self.stats 里。
+    """
+
+    def __init__(self, model: str, path: str | None, mem_items: int, disk_items: int):
+        self.model = model
+        self.mem_items = mem_items
+        self.disk_items = disk_items
+        self.stats = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "disk_evictions": 0}
+        self._mem: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            try:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    " key TEXT PRIMARY KEY, vec BLOB NOT NULL, last_used REAL NOT NULL)"
+                )
+                self._db.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)"
+                )
+                self._db.commit()
+            except Exception as e:
+                print("Embedding disk cache disabled:", e)
+                self._db = None
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    def key(self, text: str) -> str:
+        raw = f"{self.model}\x00{self.normalize(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, vec: np.ndarray):
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_items:
+            self._mem.popitem(last=False)
+
+    def get_many(self, texts: List[str]) -> List[np.ndarray | None]:
+        keys = [self.key(t) for t in texts]
+        out: List[np.ndarray | None] = [None] * len(texts)
+        with self._lock:
+            missing = []
+            for i, k in enumerate(keys):
+                vec = self._mem.get(k)
+                if vec is not None:
+                    self._mem.move_to_end(k)
+                    out[i] = vec
+                    self.stats["mem_hits"] += 1
+                else:
+                    missing.append(i)
+
+            if missing and self._db is not None:
+                try:
+                    wanted = list({keys[i] for i in missing})
+                    found = {}
+                    for start in range(0, len(wanted), 500):
+                        chunk = wanted[start:start + 500]
+                        rows = self._db.execute(
+                            f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                            chunk,
+                        ).fetchall()
+                        found.update({k: np.frombuffer(blob, dtype=np.float32) for k, blob in rows})
+                    if found:
+                        now = time.time()
+                        self._db.executemany(
+                            "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                            [(now, k) for k in found],
+                        )
+                        self._db.commit()
+                    still_missing = []
+                    for i in missing:
+                        vec = found.get(keys[i])
+                        if vec is None:
+                            still_missing.append(i)
+                            continue
+                        out[i] = vec
+                        self._remember(keys[i], vec)
+                        self.stats["disk_hits"] += 1
+                    missing = still_missing
+                except Exception as e:
+                    print("Embedding disk cache read failed:", e)
+
+            self.stats["misses"] += len(missing)
+        return out
+
+    def put_many(self, texts: List[str], vecs: List[np.ndarray]):
+        if not texts:
+            return
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, vec in zip(texts, vecs):
+                vec = np.asarray(vec, dtype=np.float32)
+                if vec.flags.writeable:
+                    # 缓存里的向量会被多处共享，统一只读
+                    vec = vec.copy()
+                    vec.setflags(write=False)
+                k = self.key(text)
+                self._remember(k, vec)
+                rows.append((k, vec.tobytes(), now))
+
+            if self._db is None:
+                return
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vec, last_used) VALUES (?, ?, ?)",
+                    rows,
+                )
+                (n_rows,) = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+                overflow = n_rows - self.disk_items
+                if overflow > 0:
+                    self._db.execute(
+                        "DELETE FROM embeddings WHERE key IN ("
+                        " SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                        (overflow,),
+                    )
+                    self.stats["disk_evictions"] += overflow
+                self._db.commit()
+            except Exception as e:
+                print("Embedding disk cache write failed:", e)
+
+
+@st.cache_resource
+def get_embedding_cache() -> EmbeddingCache:
+    return EmbeddingCache(
+        model=EMBED_MODEL,
+        path=EMBED_CACHE_PATH,
+        mem_items=EMBED_CACHE_MEM_ITEMS,
+        disk_items=EMBED_CACHE_DISK_ITEMS,
+    )
+
+
+def decode_embedding(data) -> np.ndarray:
+    """
+    embeddings.create(encoding_format="base64") 返回的是 little-endian float32 的 base64 字符串，
+    直接 np.frombuffer 成 float32 向量，不经过 Python list[float]。
+    """
+    emb = data.embedding
+    if isinstance(emb, str):
+        return np.frombuffer(base64.b64decode(emb), dtype=np.float32)
+    return np.asarray(emb, dtype=np.float32)
+
+
+def embed_text(text: str) -> np.ndarray:
+    cache = get_embedding_cache()
+    cached = cache.get_many([text])[0]
+    if cached is not None:
+        log_step("Step 1 done: embedding served from cache.")
+        meter = CURRENT_USAGE.get()
+        if meter is not None:
+            meter.record_cache_hit("embed", EMBED_MODEL)
+        return cached
+
+    t0 = time.perf_counter()
     resp = client.embeddings.create(
         model=EMBED_MODEL,
         input=[text],
+        encoding_format="base64",
     )
+    record_usage("embed", EMBED_MODEL, resp.usage, time.perf_counter() - t0)
     log_step("Step 1 done: embedding received.")
-    return resp.data[0].embedding
+    emb = decode_embedding(resp.data[0])
+    cache.put_many([text], [emb])
+    return emb
+
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """
+    批量 embedding：每 EMBED_BATCH_SIZE 条文本只发一次 embeddings.create。
+    - 先查 EmbeddingCache，只对 miss 的文本调用 API
+    - 返回 (len(texts), dim) 的 float32 矩阵，行顺序与 texts 一致（按 resp.data[i].index 放回）
+    - 某个 batch 失败时逐条重试；仍然失败（或空文本）的行保持全 0，调用方据此跳过
+    - 每个 batch 的耗时都会 log 出来
+    """
+    cache = get_embedding_cache()
+    rows: List[np.ndarray | None] = cache.get_many(texts)
+    todo = [i for i, t in enumerate(texts) if rows[i] is None and t and t.strip()]
+    n_cached = sum(1 for r in rows if r is not None)
+    if n_cached:
+        log_step(f"embed_texts: {n_cached}/{len(texts)} served from cache")
+        meter = CURRENT_USAGE.get()
+        if meter is not None:
+            meter.record_cache_hit("embed", EMBED_MODEL, n_cached)
+
+    for start in range(0, len(todo), EMBED_BATCH_SIZE):
+        idxs = todo[start:start + EMBED_BATCH_SIZE]
+        t0 = time.perf_counter()
+        try:
+            resp = client.embeddings.create(
+                model=EMBED_MODEL,
+                input=[texts[i] for i in idxs],
+                encoding_format="base64",
+            )
+            record_usage("embed", EMBED_MODEL, resp.usage, time.perf_counter() - t0)
+            for d in resp.data:
+                rows[idxs[d.index]] = decode_embedding(d)
+            log_step(
+                f"embed batch of {len(idxs)} done in {(time.perf_counter() - t0) * 1000:.0f} ms"
+            )
+        except Exception as e:
+            log_step(
+                f"embed batch of {len(idxs)} failed after {(time.perf_counter() - t0) * 1000:.0f} ms "
+                f"({e}); retrying one by one"
+            )
+            for i in idxs:
+                try:
+                    t_one = time.perf_counter()
+                    resp = client.embeddings.create(
+                        model=EMBED_MODEL,
+                        input=[texts[i]],
+                        encoding_format="base64",
+                    )
+                    record_usage("embed", EMBED_MODEL, resp.usage, time.perf_counter() - t_one)
+                    rows[i] = decode_embedding(resp.data[0])
+                except Exception as e_one:
+                    log_step(f"embed text #{i} failed: {e_one}")
+
+    fresh = [i for i in todo if rows[i] is not None]
+    cache.put_many([texts[i] for i in fresh], [rows[i] for i in fresh])
+
+    dim = next((r.shape[0] for r in rows if r is not None), 0)
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, r in enumerate(rows):
+        if r is not None:
+            out[i] = r
+    n_failed = sum(1 for r in rows if r is None)
+    if n_failed:
+        log_step(f"embed_texts: {n_failed}/{len(texts)} texts have no embedding")
+    return out
 
 
 def cosine_sim_matrix(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
@@ -965,160 +1691,728 @@ def cosine_sim_matrix(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
     return (matrix @ query) / denom
 
 
+def truncate_embedding(vec: np.ndarray, dim: int) -> np.ndarray:
+    """
+    Matryoshka 截断：取前 dim 维再做 L2 归一化。
+    text-embedding-3-* 的前缀维度本身就是可用的低维 embedding（等价于 API 的 dimensions=dim）。
+    """
+    head = np.asarray(vec[:dim], dtype=np.float32)
+    norm = float(np.linalg.norm(head))
+    return head / norm if norm > 0 else head
+
+
+def vector_query_kwargs(
+    query_emb: np.ndarray,
+    limit: int,
+    retrieval_mode: str = "full",
+    for_request: bool = False,
+) -> Dict[str, Any]:
+    """
+    生成 query_points 的向量检索参数。
+    two_stage：prefetch 在 coarse 向量上取 limit * COARSE_OVERFETCH 个候选，
+    外层 query 用完整向量只对这些候选重新打分（Qdrant 服务端一次完成）。
+    for_request=True 时给 models.QueryRequest 用（pydantic 模型只接受 list[float]）。
+    """
+    if for_request:
+        query_emb = np.asarray(query_emb, dtype=np.float32).tolist()
+    if retrieval_mode == "two_stage":
+        return {
+            "prefetch": models.Prefetch(
+                query=truncate_embedding(query_emb, COARSE_VECTOR_DIM).tolist(),
+                using=COARSE_VECTOR_NAME,
+                limit=limit * COARSE_OVERFETCH,
+            ),
+            "query": query_emb,
+            "using": FULL_VECTOR_NAME,
+            "limit": limit,
+        }
+    return {"query": query_emb, "limit": limit}
+
+
 # ========= Qdrant Repositories =========
-class PolicyItemFromPayload:
-    def __init__(self, payload: dict):
-        self.id = payload["raw_id"]
-        self.label = payload.get("label")
-        self.description = payload.get("description")
-        self.risk_level = payload.get("risk_level")
-        self.doc_title = payload.get("doc_title")
-        self.doc_stage = payload.get("doc_stage")
-        self.doc_mode = payload.get("doc_mode")
-        self.item_stage = payload.get("item_stage", self.doc_stage)
-        self.item_mode = payload.get("item_mode", self.doc_mode)
-        self.source_type = "policy"
-        self.source_path = payload.get("source_path")
-        self.source_chunk_md = fix_raw_excerpt_md(
-            payload.get("source_chunk_md"),
-            self.source_path,
+class FixedMarkdownCache:
+    """
+    fix_raw_excerpt_md 的进程级 memo：key = (raw_id, hash(source_path + 原文))。
+    四遍正则只在第一次展示某个 chunk 时跑，之后所有 session 共享结果；按条数 LRU 淘汰。
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self.stats = {"hits": 0, "misses": 0}
+        self._memo: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, raw_id: Any, raw_md: str | None, source_path: str | None) -> str | None:
+        if not raw_md:
+            return raw_md
+        digest = hashlib.sha1(f"{source_path or ''}\x00{raw_md}".encode("utf-8")).hexdigest()
+        key = (raw_id, digest)
+        with self._lock:
+            fixed = self._memo.get(key)
+            if fixed is not None:
+                self._memo.move_to_end(key)
+                self.stats["hits"] += 1
+                return fixed
+
+        fixed = fix_raw_excerpt_md(raw_md, source_path)
+        with self._lock:
+            self.stats["misses"] += 1
+            self._memo[key] = fixed
+            while len(self._memo) > self.max_items:
+                self._memo.popitem(last=False)
+        return fixed
+
+
+@st.cache_resource
+def get_fixed_md_cache() -> FixedMarkdownCache:
+    return FixedMarkdownCache(FIXED_MD_CACHE_ITEMS)
+
+
+class _FrozenPayloadItem:
+    """
+    检索命中的紧凑只读表示：__slots__ 省掉每个对象的 __dict__，
+    并且同一个 raw_id 在所有子查询 / 所有 session 之间共享一个实例（见 PayloadInternCache），
+    所以构造之后不允许再改属性。
+    """
+    __slots__ = ()
+
+    def _init_fields(self, **fields):
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is shared across sessions and immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is shared across sessions and immutable")
+
+    @property
+    def source_chunk_md(self) -> str | None:
+        # 只有真正被展示时才跑 fix_raw_excerpt_md；同一 chunk 进程内只改写一次
+        return get_fixed_md_cache().get(self.id, self._raw_md, self.source_path)
+
+
+class PolicyItemFromPayload(_FrozenPayloadItem):
+    __slots__ = (
+        "id", "point_id", "label", "description", "risk_level", "doc_title",
+        "doc_stage", "doc_mode", "item_stage", "item_mode", "source_type",
+        "source_path", "_raw_md",
+    )
+
+    def __init__(self, payload: dict, point_id=None):
+        doc_stage = payload.get("doc_stage")
+        doc_mode = payload.get("doc_mode")
+        self._init_fields(
+            id=payload["raw_id"],
+            point_id=point_id,  # Qdrant point id，用于按需 retrieve 原文 markdown
+            label=payload.get("label"),
+            description=payload.get("description"),
+            risk_level=payload.get("risk_level"),
+            doc_title=payload.get("doc_title"),
+            doc_stage=doc_stage,
+            doc_mode=doc_mode,
+            item_stage=payload.get("item_stage", doc_stage),
+            item_mode=payload.get("item_mode", doc_mode),
+            source_type="policy",
+            source_path=payload.get("source_path"),
+            _raw_md=payload.get("source_chunk_md"),
         )
-        self.embedding = None  # 不再存本地 embedding
-
-
-class ThesisSegmentFromPayload:
-    def __init__(self, payload: dict):
-        self.id = payload["raw_id"]
-        self.label = payload.get("label", "")
-        self.summary = payload.get("summary") or payload.get("description") or ""
-        self.stage = payload.get("stage", payload.get("item_stage", "other"))
-        self.mode = payload.get("mode", payload.get("item_mode", "precedents"))
-        self.field = payload.get("field", "unknown")
-        self.source_path = payload.get("source_path")
-        self.doc_title = payload.get("doc_title")
-        self.source_type = payload.get("source_type", "thesis")
-        self.role = payload.get("role", "technical_precedent")
-        self.domain_tags = payload.get("domain_tags", [])
-        self.construct_tags = payload.get("construct_tags", [])
-        self.user_tags = payload.get("user_tags", [])
-        self.metric_tags = payload.get("metric_tags", [])
-        raw_md = payload.get("raw_excerpt_md") or payload.get("source_chunk_md")
-        self.source_chunk_md = fix_raw_excerpt_md(raw_md, self.source_path)
-        self.embedding = None
-
-
-class PolicyRepository:
-    def __init__(self, client: QdrantClient, collection_name: str = "policy_docs"):
+
+
+class ThesisSegmentFromPayload(_FrozenPayloadItem):
+    __slots__ = (
+        "id", "point_id", "label", "summary", "stage", "mode", "field",
+        "source_path", "doc_title", "source_type", "role",
+        "domain_tags", "construct_tags", "user_tags", "metric_tags",
+        "_raw_md",
+    )
+
+    def __init__(self, payload: dict, point_id=None):
+        self._init_fields(
+            id=payload["raw_id"],
+            point_id=point_id,
+            label=payload.get("label", ""),
+            summary=payload.get("summary") or payload.get("description") or "",
+            stage=payload.get("stage", payload.get("item_stage", "other")),
+            mode=payload.get("mode", payload.get("item_mode", "precedents")),
+            field=payload.get("field", "unknown"),
+            source_path=payload.get("source_path"),
+            doc_title=payload.get("doc_title"),
+            source_type=payload.get("source_type", "thesis"),
+            role=payload.get("role", "technical_precedent"),
+            # 共享对象：tag 用 tuple，避免被某个 session 原地修改
+            domain_tags=tuple(payload.get("domain_tags") or ()),
+            construct_tags=tuple(payload.get("construct_tags") or ()),
+            user_tags=tuple(payload.get("user_tags") or ()),
+            metric_tags=tuple(payload.get("metric_tags") or ()),
+            _raw_md=payload.get("raw_excerpt_md") or payload.get("source_chunk_md"),
+        )
+
+
+class PayloadInternCache:
+    """
+    (item 类型, raw_id, point_id) -> 只读 payload 对象 的进程级 intern 表。
+    一个 turn 里多个子查询命中同一条证据、以及不同 session 命中同一条证据时都复用同一个实例，
+    不再为每个 hit 重新构造；按条数 LRU 淘汰。
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self.stats = {"hits": 0, "misses": 0}
+        self._items: "OrderedDict[tuple, _FrozenPayloadItem]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, item_cls, payload: dict, point_id=None) -> _FrozenPayloadItem:
+        key = (item_cls.__name__, payload.get("raw_id"), point_id)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                self.stats["hits"] += 1
+                return item
+
+        item = item_cls(payload, point_id=point_id)
+        with self._lock:
+            self.stats["misses"] += 1
+            # 并发 miss 时以先写入的为准，保证只有一个共享实例
+            item = self._items.setdefault(key, item)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return item
+
+
+@st.cache_resource
+def get_payload_intern_cache() -> PayloadInternCache:
+    return PayloadInternCache(PAYLOAD_INTERN_ITEMS)
+
+
+def _payload_nbytes(payload: dict | None) -> int:
+    """估算一个 payload 在 JSON 传输里的字节数（用于报告每轮的传输量）。"""
+    if not payload:
+        return 0
+    return len(json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+def _match(key: str, value: str):
+    return models.FieldCondition(key=key, match=models.MatchValue(value=value))
+
+
+def _is_empty(key: str):
+    return models.IsEmptyCondition(is_empty=models.PayloadField(key=key))
+
+
+def _is_missing(key: str):
+    """字段不存在（is_empty 还会匹配显式 null，而 p.get(key, default) 对 null 返回 None）。"""
+    is_null = models.IsNullCondition(is_null=models.PayloadField(key=key))
+    return models.Filter(must=[_is_empty(key)], must_not=[is_null])
+
+
+def _match_or_default(key: str, value: str, default: str):
+    """对应 Python 里的 p.get(key, default) == value：字段缺失时按 default 算，显式 null 不算。"""
+    if value == default:
+        return models.Filter(should=[_match(key, value), _is_missing(key)])
+    return _match(key, value)
+
+
+def formula_unsupported(e: Exception) -> bool:
+    """
+    server scoring 失败的原因是不是"这个 Qdrant 跑不了 formula query"：
+    4xx（除 404 / 408 / 429）、gRPC INVALID_ARGUMENT / UNIMPLEMENTED、客户端自己拒绝（老版本 qdrant-client
+    的 ValueError / TypeError / NotImplementedError）→ True；超时、断连、5xx 等暂时性错误 → False。
+    """
+    status = getattr(e, "status_code", None)
+    if status is not None:
+        return 400 <= status < 500 and status not in (404, 408, 429)
+    code = getattr(e, "code", None)  # grpc.RpcError
+    if callable(code):
+        return getattr(code(), "name", "") in ("INVALID_ARGUMENT", "UNIMPLEMENTED")
+    return isinstance(e, (ValueError, TypeError, NotImplementedError))
+
+
+class LocalPayloadTable:
+    """
+    payload 的列式视图：bonus 用到的每个字段是一列 object ndarray（按需构建后缓存），
+    这样 stage/mode/gap bonus 可以对整个语料一次性向量化算出来。
+    """
+
+    def __init__(self, payloads: List[dict]):
+        self.payloads = payloads
+        self._columns: Dict[tuple, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.payloads)
+
+    def _build(self, key: tuple, values) -> np.ndarray:
+        col = self._columns.get(key)
+        if col is None:
+            col = np.empty(len(self.payloads), dtype=object)
+            for i, v in enumerate(values):
+                col[i] = v
+            self._columns[key] = col
+        return col
+
+    def column(self, key: str, default: Any = None) -> np.ndarray:
+        """对应 p.get(key, default)。"""
+        return self._build(("get", key, default), (p.get(key, default) for p in self.payloads))
+
+    def coalesce(self, key: str, fallback_key: str) -> np.ndarray:
+        """对应 p.get(key) or p.get(fallback_key)。"""
+        return self._build(
+            ("or", key, fallback_key), (p.get(key) or p.get(fallback_key) for p in self.payloads)
+        )
+
+
+class LocalVectorIndex:
+    """
+    进程内向量索引（EBCS_VECTOR_BACKEND=local）：
+    - vectors.npy：float32 (n, dim)，已 L2 归一化，用 mmap 只读打开，多个 worker 进程通过 OS page cache 共享；
+    - payloads.jsonl：每行 {"id": point_id, "payload": {...}}，读成 LocalPayloadTable，markdown 字段单独存放。
+    目录由 `python bench.py export-local` 从 Qdrant collection 导出。
+    """
+
+    def __init__(self, path: str | Path, markdown_fields: tuple = ()):
+        self.path = Path(path)
+        self.vectors = np.load(self.path / "vectors.npy", mmap_mode="r")
+        ids, payloads, markdown = [], [], []
+        with open(self.path / "payloads.jsonl", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                p = row.get("payload") or {}
+                ids.append(row["id"])
+                markdown.append({k: p.pop(k) for k in markdown_fields if k in p})
+                payloads.append(p)
+        if len(ids) != self.vectors.shape[0]:
+            raise ValueError(
+                f"{self.path}: {len(ids)} payload rows but {self.vectors.shape[0]} vectors"
+            )
+        self.ids = ids
+        self.table = LocalPayloadTable(payloads)
+        self._markdown = markdown
+        self._row_of = {pid: i for i, pid in enumerate(ids)}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query_embs: List[np.ndarray], limit: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        所有 query 一次矩阵乘；每行用 argpartition 取 cosine 最高的 limit 个，再按相似度降序排好。
+        返回 (行号, 相似度)，形状都是 (n_queries, limit)。
+        """
+        q = np.asarray(query_embs, dtype=np.float32)
+        q = q / (np.linalg.norm(q, axis=1, keepdims=True) + 1e-9)
+        sims = q @ self.vectors.T
+        k = min(limit, sims.shape[1])
+        if k < sims.shape[1]:
+            idx = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        else:
+            idx = np.broadcast_to(np.arange(k), sims.shape)
+        top = np.take_along_axis(sims, idx, axis=1)
+        order = np.argsort(-top, axis=1, kind="stable")
+        return np.take_along_axis(idx, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+    def fetch_vectors(self, point_ids: List[Any]) -> Dict[Any, np.ndarray]:
+        rows = {pid: self._row_of[pid] for pid in point_ids if pid in self._row_of}
+        return {pid: np.asarray(self.vectors[r]) for pid, r in rows.items()}
+
+    def retrieve(self, point_ids: List[Any]) -> List[tuple[Any, dict]]:
+        """按 point id 取 (id, 完整 payload)，含 markdown 字段；不存在的 id 跳过。"""
+        out = []
+        for pid in point_ids:
+            row = self._row_of.get(pid)
+            if row is not None:
+                out.append((pid, {**self.table.payloads[row], **self._markdown[row]}))
+        return out
+
+
+@st.cache_resource
+def get_local_index(collection_name: str, markdown_fields: tuple = ()) -> LocalVectorIndex:
+    path = Path(LOCAL_INDEX_DIR) / collection_name
+    log_step(f"loading local vector index from {path}")
+    return LocalVectorIndex(path, markdown_fields)
+
+
+class QdrantRepository:
+    """
+    两个 Qdrant 仓库共用的检索逻辑；子类只定义 payload → item 以及 stage/mode/gap bonus。
+    scoring:
+    - "server": bonus 写成 Qdrant formula query，服务端对 prefetch 的 fetch_limit 个候选重排，只返回 top_k；
+    - "python": 取回 fetch_limit 个 hit，在 Python 里加 bonus 再截断（老路径）。
+      server 不支持 formula 时永久退回；暂时性错误只让 SCORING_RETRY_S 秒内的请求走 python（见 active_scoring）。
+    传入 local_index 时不走 Qdrant：在本地 mmap 矩阵上取 fetch_limit 个候选，bonus 用 vector_bonus 向量化计算，
+    结果与 "python" 一致。
+    """
+    fetch_limit = 60
+    item_cls = None
+    index_fields: List[str] = []
+    # 检索时不取这些大字段；只有展示的 evidence 才用 fetch_markdown 按 id 取
+    markdown_fields: List[str] = []
+
+    def __init__(
+        self,
+        client: QdrantClient,
+        collection_name: str,
+        retrieval_mode: str = "full",
+        scoring: str = "python",
+        local_index: LocalVectorIndex | None = None,
+    ):
         self.client = client
         self.collection_name = collection_name
+        self.retrieval_mode = retrieval_mode
+        self.scoring = scoring
+        self.local_index = local_index
+        self._server_retry_at = 0.0
+
+    # ---- 子类实现 ----
+    def python_bonus(self, payload: dict, stage: str, mode: str, gap: str) -> float:
+        raise NotImplementedError
+
+    def bonus_terms(self, stage: str, mode: str, gap: str) -> List[Any]:
+        """和 python_bonus 等价的 formula 项（每项是 float 常数或 MultExpression）。"""
+        raise NotImplementedError
+
+    def vector_bonus(self, table: LocalPayloadTable, stage: str, mode: str, gap: str) -> np.ndarray:
+        """和 python_bonus 等价、对整张 payload 表一次算完的版本（local 后端用）。"""
+        raise NotImplementedError
+
+    # ---- 公共部分 ----
+    def ensure_payload_indexes(self):
+        """formula 里的条件走 keyword payload index；已存在时 Qdrant 直接忽略。"""
+        if self.local_index is not None:
+            return
+        for field in self.index_fields:
+            try:
+                self.client.create_payload_index(
+                    collection_name=self.collection_name,
+                    field_name=field,
+                    field_schema=models.PayloadSchemaType.KEYWORD,
+                )
+            except Exception as e:
+                log_step(f"[{self.collection_name}] could not create payload index on {field}: {e}")
+
+    def active_scoring(self) -> str:
+        """这次请求用哪种 scoring：server 在暂时性错误后的冷却期内先用 python。"""
+        if self.scoring == "server" and time.monotonic() < self._server_retry_at:
+            return "python"
+        return self.scoring
+
+    def _query_kwargs(self, query_emb: np.ndarray, stage: str, mode: str, gap: str, top_k: int,
+                      for_request: bool = False, scoring: str | None = None) -> Dict[str, Any]:
+        if (scoring or self.scoring) == "server":
+            formula = models.SumExpression(sum=["$score", *self.bonus_terms(stage, mode, gap)])
+            return {
+                "prefetch": models.Prefetch(
+                    **vector_query_kwargs(query_emb, limit=self.fetch_limit,
+                                          retrieval_mode=self.retrieval_mode, for_request=True)
+                ),
+                "query": models.FormulaQuery(formula=formula),
+                "limit": top_k,
+            }
+        return vector_query_kwargs(query_emb, limit=self.fetch_limit,
+                                   retrieval_mode=self.retrieval_mode, for_request=for_request)
+
+    def _payload_selector(self):
+        if not self.markdown_fields:
+            return True
+        return models.PayloadSelectorExclude(exclude=self.markdown_fields)
+
+    def fetch_markdown(self, point_ids: List[Any], stats: Dict[str, int] | None = None) -> Dict[Any, str]:
+        """按 point id 取原文 markdown（已经过 fix_raw_excerpt_md），只给真正要展示的 evidence 用。"""
+        if not point_ids:
+            return {}
+        if self.local_index is not None:
+            out = {}
+            for pid, p in self.local_index.retrieve(list(point_ids)):
+                raw_md = next((p[f] for f in self.markdown_fields if p.get(f)), None)
+                out[pid] = get_fixed_md_cache().get(p.get("raw_id", pid), raw_md, p.get("source_path"))
+            return out
+        points = self.client.retrieve(
+            collection_name=self.collection_name,
+            ids=list(point_ids),
+            with_payload=models.PayloadSelectorInclude(include=[*self.markdown_fields, "source_path", "raw_id"]),
+            with_vectors=False,
+        )
+        out = {}
+        n_bytes = 0
+        for pt in points:
+            p = pt.payload or {}
+            n_bytes += _payload_nbytes(p)
+            raw_md = next((p[f] for f in self.markdown_fields if p.get(f)), None)
+            out[pt.id] = get_fixed_md_cache().get(p.get("raw_id", pt.id), raw_md, p.get("source_path"))
+        if stats is not None:
+            stats["markdown_bytes"] = stats.get("markdown_bytes", 0) + n_bytes
+        log_step(f"[{self.collection_name}] fetched markdown for {len(out)} points, ~{n_bytes} bytes")
+        return out
+
+    def fetch_vectors(self, point_ids: List[Any]) -> Dict[Any, np.ndarray]:
+        """按 point id 取存储的完整向量（float32，L2 归一化），只给融合后的候选做 MMR 用。"""
+        if not point_ids:
+            return {}
+        if self.local_index is not None:
+            return self.local_index.fetch_vectors(list(point_ids))
+        points = self.client.retrieve(
+            collection_name=self.collection_name,
+            ids=list(point_ids),
+            with_payload=False,
+            with_vectors=[FULL_VECTOR_NAME] if self.retrieval_mode == "two_stage" else True,
+        )
+        out = {}
+        for pt in points:
+            vec = pt.vector
+            if isinstance(vec, dict):
+                vec = vec.get(FULL_VECTOR_NAME)
+            if vec is None:
+                continue
+            vec = np.asarray(vec, dtype=np.float32)
+            out[pt.id] = vec / (np.linalg.norm(vec) + 1e-9)
+        return out
+
+    def _rank_hits(self, hits, stage: str, mode: str, gap: str, top_k: int,
+                   stats: Dict[str, int] | None = None, scoring: str | None = None) -> List[tuple[Any, float]]:
+        if stats is not None:
+            stats["hits"] = stats.get("hits", 0) + len(hits)
+            stats["payload_bytes"] = stats.get("payload_bytes", 0) + sum(_payload_nbytes(h.payload) for h in hits)
+
+        interned = get_payload_intern_cache()
+        if (scoring or self.scoring) == "server":
+            # 分数里已经含 bonus，且服务端已排好序
+            return [
+                (interned.get(self.item_cls, h.payload or {}, h.id), float(h.score or 0.0))
+                for h in hits[:top_k]
+            ]
+
+        scored = [
+            (h, float((h.score or 0.0) + self.python_bonus(h.payload or {}, stage, mode, gap)))
+            for h in hits
+        ]
+        scored.sort(key=lambda x: x[1], reverse=True)
+        # 只为进入 top_k 的 hit 取对象，其余 hit 不再构造
+        return [(interned.get(self.item_cls, h.payload or {}, h.id), s) for h, s in scored[:top_k]]
+
+    def _local_batch_search(self, query_embs: List[np.ndarray], stage: str, mode: str, gap: str,
+                            top_k: int, stats: Dict[str, int] | None = None) -> List[List[tuple[Any, float]]]:
+        t0 = time.perf_counter()
+        index = self.local_index
+        rows, sims = index.search(query_embs, self.fetch_limit)
+        bonus = self.vector_bonus(index.table, stage, mode, gap)
+        final = sims + bonus[rows]
+        # 稳定排序：同分时保持相似度顺序，和 "python" 路径对 hit 列表 sort 的结果一致
+        order = np.argsort(-final, axis=1, kind="stable")[:, :top_k]
+        interned = get_payload_intern_cache()
+        results = []
+        for q_rows, q_final, q_order in zip(rows, final, order):
+            hits = []
+            for j in q_order:
+                r = q_rows[j]
+                hits.append((interned.get(self.item_cls, index.table.payloads[r], index.ids[r]), float(q_final[j])))
+            results.append(hits)
+        if stats is not None:
+            stats["hits"] = stats.get("hits", 0) + int(rows.size)
+        log_step(f"[{self.collection_name}] local search: {len(query_embs)} queries x {len(index)} points "
+                 f"in {(time.perf_counter() - t0) * 1000:.1f} ms")
+        return results
+
+    def _server_scoring_failed(self, e: Exception):
+        if formula_unsupported(e):
+            log_step(f"[{self.collection_name}] server-side scoring unsupported ({e}); switching to Python scoring")
+            self.scoring = "python"
+            return
+        self._server_retry_at = time.monotonic() + SCORING_RETRY_S
+        log_step(f"[{self.collection_name}] server-side scoring failed ({type(e).__name__}: {e}); "
+                 f"using Python scoring for {SCORING_RETRY_S:.0f}s")
 
     def scored_search(
         self,
-        query_emb: List[float],
+        query_emb: np.ndarray,
         stage: str,
         mode: str,
         gap: str,
         top_k: int = 12,
-    ) -> List[tuple[PolicyItemFromPayload, float]]:
-        if not query_emb:
+        stats: Dict[str, int] | None = None,
+    ) -> List[tuple[Any, float]]:
+        if query_emb is None or len(query_emb) == 0:
             return []
+        if self.local_index is not None:
+            return self._local_batch_search([query_emb], stage, mode, gap, top_k, stats=stats)[0]
+
+        def query(scoring: str):
+            return self.client.query_points(
+                collection_name=self.collection_name,
+                with_payload=self._payload_selector(),
+                **self._query_kwargs(query_emb, stage, mode, gap, top_k, scoring=scoring),
+            )
 
-        # ① 调用 query_points，得到一个响应对象
-        resp = self.client.query_points(
-            collection_name=self.collection_name,
-            query=query_emb,
-            limit=60,
-            with_payload=True,
-        )
-        # ② 真正的 hits 在 resp.points 里
-        hits = resp.points
-        print(f"{resp.points}")
-        results = []
-        print(f"hits:{hits}")
-        for h in hits:
-            p = h.payload or {}
-            base_sim = h.score or 0.0
-            bonus = 0.0
-            item_stage = p.get("item_stage") or p.get("doc_stage")
-            item_mode = p.get("item_mode") or p.get("doc_mode")
-
-            if item_stage == stage:
-                bonus += 0.10
-            elif p.get("doc_stage") == stage:
-                bonus += 0.05
-            if item_mode == mode:
-                bonus += 0.10
-            elif p.get("doc_mode") == mode:
-                bonus += 0.05
-
-            if gap in ("process", "content") and mode in ("checklist", "diagnose", "ethics"):
-                bonus += 0.05
-
-            final_score = float(base_sim + bonus)
-            item = PolicyItemFromPayload(p)
-            results.append((item, final_score))
-
-        results.sort(key=lambda x: x[1], reverse=True)
-        return results[:top_k]
-
-
-class ThesisRepository:
-    def __init__(self, client: QdrantClient, collection_name: str = "thesis_segments"):
-        self.client = client
-        self.collection_name = collection_name
-
-    def scored_search(
+        scoring = self.active_scoring()
+        try:
+            resp = query(scoring)
+        except Exception as e:
+            if scoring != "server":
+                raise
+            self._server_scoring_failed(e)
+            scoring = "python"
+            resp = query(scoring)
+        return self._rank_hits(resp.points, stage, mode, gap, top_k, stats=stats, scoring=scoring)
+
+    def batch_scored_search(
         self,
-        query_emb: List[float],
+        query_embs: List[np.ndarray],
         stage: str,
         mode: str,
         gap: str,
-        top_k: int = 16,
-    ) -> List[tuple[ThesisSegmentFromPayload, float]]:
-        if not query_emb:
+        top_k: int = 12,
+        stats: Dict[str, int] | None = None,
+    ) -> List[List[tuple[Any, float]]]:
+        """所有子查询用一次 query_batch_points 发出去；返回的每个结果列表单独走 _rank_hits。"""
+        if not query_embs:
             return []
+        if self.local_index is not None:
+            return self._local_batch_search(query_embs, stage, mode, gap, top_k, stats=stats)
+        def query(scoring: str):
+            return self.client.query_batch_points(
+                collection_name=self.collection_name,
+                requests=[
+                    models.QueryRequest(
+                        with_payload=self._payload_selector(),
+                        **self._query_kwargs(e, stage, mode, gap, top_k, for_request=True, scoring=scoring),
+                    )
+                    for e in query_embs
+                ],
+            )
 
-        resp = self.client.query_points(
-            collection_name=self.collection_name,
-            query=query_emb,
-            limit=80,
-            with_payload=True,
-        )
-        hits = resp.points
+        scoring = self.active_scoring()
+        try:
+            responses = query(scoring)
+        except Exception as e:
+            if scoring != "server":
+                raise
+            self._server_scoring_failed(e)
+            scoring = "python"
+            responses = query(scoring)
+        return [self._rank_hits(r.points, stage, mode, gap, top_k, stats=stats, scoring=scoring) for r in responses]
+
+
+class PolicyRepository(QdrantRepository):
+    # 每个子查询先多取一些，再用 stage/mode/gap bonus 重排后截断到 top_k
+    fetch_limit = 60
+    item_cls = PolicyItemFromPayload
+    index_fields = ["item_stage", "doc_stage", "item_mode", "doc_mode"]
+    markdown_fields = ["source_chunk_md"]
+
+    def __init__(self, client: QdrantClient, collection_name: str = "policy_docs", **kwargs):
+        super().__init__(client, collection_name, **kwargs)
+
+    def python_bonus(self, p: dict, stage: str, mode: str, gap: str) -> float:
+        bonus = 0.0
+        item_stage = p.get("item_stage") or p.get("doc_stage")
+        item_mode = p.get("item_mode") or p.get("doc_mode")
+
+        if item_stage == stage:
+            bonus += 0.10
+        elif p.get("doc_stage") == stage:
+            bonus += 0.05
+        if item_mode == mode:
+            bonus += 0.10
+        elif p.get("doc_mode") == mode:
+            bonus += 0.05
+
+        if gap in ("process", "content") and mode in ("checklist", "diagnose", "ethics"):
+            bonus += 0.05
+        return bonus
+
+    def vector_bonus(self, table: LocalPayloadTable, stage: str, mode: str, gap: str) -> np.ndarray:
+        bonus = np.zeros(len(table))
+        for key, value in (("stage", stage), ("mode", mode)):
+            item_hit = table.coalesce(f"item_{key}", f"doc_{key}") == value
+            doc_hit = table.column(f"doc_{key}") == value
+            bonus += np.where(item_hit, 0.10, np.where(doc_hit, 0.05, 0.0))
+        if gap in ("process", "content") and mode in ("checklist", "diagnose", "ethics"):
+            bonus += 0.05
+        return bonus
+
+    @staticmethod
+    def _item_or_doc_terms(item_key: str, doc_key: str, value: str) -> List[Any]:
+        # item 字段命中（或缺失时回退到 doc 字段命中）→ 0.10；否则 doc 字段命中 → 0.05
+        return [
+            models.MultExpression(mult=[0.10, models.Filter(should=[
+                _match(item_key, value),
+                models.Filter(must=[_is_empty(item_key), _match(doc_key, value)]),
+            ])]),
+            models.MultExpression(mult=[0.05, models.Filter(
+                must=[_match(doc_key, value)],
+                must_not=[_match(item_key, value), _is_empty(item_key)],
+            )]),
+        ]
 
-        results = []
-        for h in hits:
-            p = h.payload or {}
-            base_sim = h.score or 0.0
-
-            seg_stage = p.get("stage", "other")
-            seg_mode = p.get("mode", "precedents")
-            role = p.get("role", "technical_precedent")
-
-            bonus = 0.0
-            if seg_stage == stage:
-                bonus += 0.08
-            if seg_mode == mode:
-                bonus += 0.08
-            if mode in ("precedents", "exploration"):
-                bonus += 0.12
-            if gap == "precedent":
-                bonus += 0.10
-            if role == "technical_precedent":
-                bonus += 0.02
-
-            final_score = float(base_sim + bonus)
-            item = ThesisSegmentFromPayload(p)
-            results.append((item, final_score))
-
-        results.sort(key=lambda x: x[1], reverse=True)
-        return results[:top_k]
+    def bonus_terms(self, stage: str, mode: str, gap: str) -> List[Any]:
+        const = 0.05 if gap in ("process", "content") and mode in ("checklist", "diagnose", "ethics") else 0.0
+        return [
+            *self._item_or_doc_terms("item_stage", "doc_stage", stage),
+            *self._item_or_doc_terms("item_mode", "doc_mode", mode),
+            const,
+        ]
+
+
+class ThesisRepository(QdrantRepository):
+    fetch_limit = 80
+    item_cls = ThesisSegmentFromPayload
+    index_fields = ["stage", "mode", "role"]
+    # 与 ThesisSegmentFromPayload 一致：raw_excerpt_md 优先
+    markdown_fields = ["raw_excerpt_md", "source_chunk_md"]
+
+    def __init__(self, client: QdrantClient, collection_name: str = "thesis_segments", **kwargs):
+        super().__init__(client, collection_name, **kwargs)
+
+    def python_bonus(self, p: dict, stage: str, mode: str, gap: str) -> float:
+        seg_stage = p.get("stage", "other")
+        seg_mode = p.get("mode", "precedents")
+        role = p.get("role", "technical_precedent")
+
+        bonus = 0.0
+        if seg_stage == stage:
+            bonus += 0.08
+        if seg_mode == mode:
+            bonus += 0.08
+        if mode in ("precedents", "exploration"):
+            bonus += 0.12
+        if gap == "precedent":
+            bonus += 0.10
+        if role == "technical_precedent":
+            bonus += 0.02
+        return bonus
+
+    def vector_bonus(self, table: LocalPayloadTable, stage: str, mode: str, gap: str) -> np.ndarray:
+        bonus = (
+            0.08 * (table.column("stage", "other") == stage)
+            + 0.08 * (table.column("mode", "precedents") == mode)
+            + 0.02 * (table.column("role", "technical_precedent") == "technical_precedent")
+        )
+        if mode in ("precedents", "exploration"):
+            bonus += 0.12
+        if gap == "precedent":
+            bonus += 0.10
+        return bonus.astype(float)
+
+    def bonus_terms(self, stage: str, mode: str, gap: str) -> List[Any]:
+        const = 0.0
+        if mode in ("precedents", "exploration"):
+            const += 0.12
+        if gap == "precedent":
+            const += 0.10
+        return [
+            models.MultExpression(mult=[0.08, _match_or_default("stage", stage, "other")]),
+            models.MultExpression(mult=[0.08, _match_or_default("mode", mode, "precedents")]),
+            models.MultExpression(mult=[0.02, _match_or_default("role", "technical_precedent", "technical_precedent")]),
+            const,
+        ]
 
 # -----------------------
 # EvidenceCard + 融合
 # -----------------------
 
 class EvidenceCard:
+    __slots__ = ("id", "title", "snippet", "source_type", "meta")
+
     def __init__(
             self,
             evid_id: str,
@@ -1138,6 +2432,7 @@ def llm_rerank_evidence(
         query_text: str,
         candidates: List[Dict[str, Any]],
         top_k: int = 16,
+        budget: TurnBudget | None = None,
 ) -> Dict[str, Dict[str, Any]]:
     """
     Self-RAG 风格的 rerank：
@@ -1149,19 +2444,25 @@ def llm_rerank_evidence(
     if not candidates:
         return {}
 
-    def trunc(s: str, max_len: int = 420) -> str:
-        s = s.strip()
-        return s[: max_len - 3] + "..." if len(s) > max_len else s
-
+    # snippet 按 token 预算打包：融合分数高的候选多留一些，按句子边界截断
     cand_briefs = [
         {
             "id": c["id"],
             "title": c.get("title", ""),
             "source_type": c.get("source_type", ""),
-            "snippet": trunc(c.get("snippet", "")),
         }
         for c in candidates[: top_k * 2]
     ]
+    snippets = pack_evidence(
+        headers=[json.dumps(b, ensure_ascii=False) for b in cand_briefs],
+        snippets=[(c.get("snippet") or "").strip() for c in candidates[: top_k * 2]],
+        scores=[float(c.get("score", 1.0)) for c in candidates[: top_k * 2]],
+        budget_tokens=RERANK_EVIDENCE_TOKENS,
+        max_snippet_tokens=RERANK_SNIPPET_MAX_TOKENS,
+        label="rerank",
+    )
+    for brief, snippet in zip(cand_briefs, snippets):
+        brief["snippet"] = snippet
 
     system_prompt = (
         "You are a passage selector for EBCS—an Evidence-Bound, Rubric-Aligned "
@@ -1200,10 +2501,14 @@ def llm_rerank_evidence(
     user_prompt = json.dumps(user_payload, ensure_ascii=False)
 
     try:
-        resp = call_llm(system_prompt, user_prompt)
+        resp = call_llm(system_prompt, user_prompt,
+                        timeout=budget.timeout("rerank", floor_s=0.0) if budget else None,
+                        site="rerank", cache_if=is_json_text)
         txt = resp.strip()
         data = json.loads(txt)
     except Exception:
+        if budget is not None and budget.remaining("rerank") <= 0:
+            budget.degrade("skip_rerank")
         return {}
 
     results: Dict[str, Dict[str, Any]] = {}
@@ -1228,6 +2533,152 @@ def llm_rerank_evidence(
     return results
 
 
+class Reranker:
+    """
+    evidence reranker 接口：对 candidates（id / title / snippet / source_type）返回
+    { evid_id: {"score": float ∈ [0,1], "role": str, "tags": [...]} }，没判断的候选不出现在结果里。
+    vectors / has_vec 与 candidates 按行对齐（fetch_candidate_vectors 的输出），uses_vectors 的实现才会用到。
+    """
+
+    name = "base"
+    # 远程调用（受 TurnBudget 的 rerank 截止时间约束）
+    remote = False
+    # 需要候选的存储向量；fuse_evidence 会在 rerank 前取好，MMR 复用
+    uses_vectors = False
+
+    def rerank(
+            self,
+            query_text: str,
+            query_emb: np.ndarray | None,
+            candidates: List[Dict[str, Any]],
+            vectors: np.ndarray | None = None,
+            has_vec: np.ndarray | None = None,
+            top_k: int = 16,
+            budget: TurnBudget | None = None,
+    ) -> Dict[str, Dict[str, Any]]:
+        raise NotImplementedError
+
+
+class LLMReranker(Reranker):
+    name = "llm"
+    remote = True
+
+    def rerank(self, query_text, query_emb, candidates, vectors=None, has_vec=None, top_k=16, budget=None):
+        return llm_rerank_evidence(query_text, candidates, top_k=top_k, budget=budget)
+
+
+class LocalFeatureReranker(Reranker):
+    """
+    不调 LLM 的 reranker，纯 CPU：
+    - helpfulness = 语义相似度（query embedding 与候选存储向量的 cosine）和
+      词面相关度（候选集合内的 BM25）各自 min-max 归一化后的加权和；没有向量的行只看 BM25
+    - role 按来源：policy → rubric，thesis → precedent；helpfulness 太低的记为 other
+    - gap_tags 用关键词表匹配 title + snippet；thesis 候选总带 precedent
+    和 LLM reranker 一样只判断前 top_k * 2 个候选，保证 apply_llm_info 的语义不变。
+    """
+
+    name = "local"
+    uses_vectors = True
+
+    semantic_weight = 0.6
+    other_below = 0.2
+    k1, b = 1.2, 0.75
+
+    _token_re = re.compile(r"[a-z0-9]+")
+    _stopwords = frozenset(
+        "a an and are as at be by can do for from how i in is it my of on or our that the this to "
+        "we what which with you your".split()
+    )
+    _tag_patterns = {
+        "content": re.compile(
+            r"\b(research questions?|rqs?|problem statement|draft|hypothes[ie]s|objectives?|scope|"
+            r"definitions?|argument|abstract|chapter|report structure|writing)\b"
+        ),
+        "process": re.compile(
+            r"\b(checklists?|plan|planning|schedule|milestones?|kick-?off|mid-?term|green[- ]light|"
+            r"deadlines?|supervis\w*|approval|meetings?|deliverables?|timeline|procedure|templates?)\b"
+        ),
+        "knowledge": re.compile(
+            r"\b(theor\w*|concepts?|frameworks?|literature|methodolog\w*|validity|reliability|"
+            r"statistic\w*|analysis|principles?)\b"
+        ),
+    }
+
+    def _tokens(self, text: str) -> List[str]:
+        return [t for t in self._token_re.findall((text or "").lower()) if t not in self._stopwords]
+
+    def _bm25(self, query_text: str, docs: List[List[str]]) -> np.ndarray:
+        q_terms = set(self._tokens(query_text))
+        if not docs or not q_terms:
+            return np.zeros(len(docs))
+        lengths = np.array([len(d) for d in docs], dtype=np.float64)
+        avg_len = max(lengths.mean(), 1.0)
+        counts = [Counter(d) for d in docs]
+        scores = np.zeros(len(docs))
+        for term in q_terms:
+            tf = np.array([c.get(term, 0) for c in counts], dtype=np.float64)
+            df = np.count_nonzero(tf)
+            if not df:
+                continue
+            idf = np.log(1.0 + (len(docs) - df + 0.5) / (df + 0.5))
+            scores += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * lengths / avg_len))
+        return scores
+
+    @staticmethod
+    def _minmax(x: np.ndarray) -> np.ndarray:
+        if not len(x):
+            return x
+        span = x.max() - x.min()
+        return (x - x.min()) / span if span > 0 else np.zeros_like(x)
+
+    def rerank(self, query_text, query_emb, candidates, vectors=None, has_vec=None, top_k=16, budget=None):
+        cands = candidates[: top_k * 2]
+        if not cands:
+            return {}
+        texts = [f"{c.get('title', '')} {c.get('snippet', '')}" for c in cands]
+        helpful = self._minmax(self._bm25(query_text, [self._tokens(t) for t in texts]))
+
+        n = len(cands)
+        if query_emb is not None and vectors is not None and has_vec is not None and vectors.shape[1]:
+            vecs, valid = vectors[:n], has_vec[:n]
+            if valid.any() and vecs.shape[1] == np.shape(query_emb)[0]:
+                q = np.asarray(query_emb, dtype=np.float32)
+                norms = np.linalg.norm(vecs[valid], axis=1) * max(float(np.linalg.norm(q)), 1e-12)
+                cos = (vecs[valid] @ q) / np.maximum(norms, 1e-12)
+                w = self.semantic_weight
+                helpful = helpful.copy()
+                helpful[valid] = w * self._minmax(cos) + (1 - w) * helpful[valid]
+
+        results: Dict[str, Dict[str, Any]] = {}
+        for c, text, h in zip(cands, texts, helpful):
+            is_thesis = c.get("source_type") == "thesis"
+            lowered = text.lower()
+            tags = [tag for tag, pattern in self._tag_patterns.items() if pattern.search(lowered)]
+            if is_thesis:
+                tags.append("precedent")
+            if h < self.other_below:
+                role = "other"
+            else:
+                role = "precedent" if is_thesis else "rubric"
+            results[c["id"]] = {"score": float(h), "role": role, "tags": tags}
+        return results
+
+
+RERANKERS: Dict[str, type] = {
+    LLMReranker.name: LLMReranker,
+    LocalFeatureReranker.name: LocalFeatureReranker,
+}
+
+
+@st.cache_resource
+def get_reranker(name: str = RERANKER) -> Reranker:
+    cls = RERANKERS.get(name)
+    if cls is None:
+        log_step(f"unknown EBCS_RERANKER={name!r}, falling back to 'llm'")
+        cls = LLMReranker
+    return cls()
+
+
 from functools import lru_cache
 
 
@@ -1276,6 +2727,69 @@ def log_chat_turn(
         print("Failed to log EBCS chat turn:", e)
 
 
+def log_turn_degradations(
+        user_id: str,
+        round_index: int,
+        timestamp_answer: str,
+        degradations: List[str],
+):
+    """把本轮 TurnBudget.degradations 写进 turn_degradations_ebcs（没有降级就不写）。"""
+    if not degradations:
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                turn_degradations_ebcs_table.insert(),
+                [
+                    {
+                        "user_id": user_id,
+                        "turn_index": round_index,
+                        "timestamp_answer": timestamp_answer,
+                        "degradation": what,
+                    }
+                    for what in degradations
+                ],
+            )
+    except Exception as e:
+        print("Failed to log EBCS turn degradations:", e)
+
+
+def log_turn_usage(
+        user_id: str,
+        round_index: int,
+        timestamp_answer: str,
+        meter: UsageMeter,
+):
+    """把本轮 UsageMeter 按 (site, model) 写进 turn_usage_ebcs，并 log 一行汇总。"""
+    rows = meter.rows()
+    totals = meter.totals()
+    log_step(
+        f"[usage] turn {round_index}: {int(totals['calls'])} calls ({int(totals['cache_hits'])} cache hits), "
+        f"in {int(totals['input_tokens'])} (cached {int(totals['cached_input_tokens'])}) / "
+        f"out {int(totals['output_tokens'])} (reasoning {int(totals['reasoning_tokens'])}) tokens, "
+        f"{totals['wall_ms'] / 1000:.1f}s in API calls, ${totals['cost_usd']:.4f}"
+    )
+    if not rows:
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                turn_usage_ebcs_table.insert(),
+                [
+                    {
+                        **row,
+                        "user_id": user_id,
+                        "turn_index": round_index,
+                        "timestamp_answer": timestamp_answer,
+                        "wall_ms": round(row["wall_ms"], 1),
+                    }
+                    for row in rows
+                ],
+            )
+    except Exception as e:
+        print("Failed to log EBCS turn usage:", e)
+
+
 def log_evidence_event(
         user_id: str,
         round_index: int,
@@ -1330,32 +2844,173 @@ def _norm_heading(text: str) -> str:
     return t
 
 
-def fuse_evidence(
+def rerank_candidates(fused: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """按 fused 的插入顺序给 reranker 的候选简介（id / title / snippet / source_type / 融合分数 score）。"""
+    return [
+        {
+            "id": key,
+            "title": getattr(d["item"], "label", ""),
+            "snippet": getattr(d["item"], "description" if d["source_type"] == "policy" else "summary", ""),
+            "source_type": d["source_type"],
+            "score": d["score"],
+        }
+        for key, d in fused.items()
+    ]
+
+
+@st.cache_resource
+def get_retrieval_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=RETRIEVAL_POOL_SIZE, thread_name_prefix="ebcs-retrieval")
+
+
+def run_bounded(tasks: List[Callable[[], Any]], max_inflight: int) -> List[Any]:
+    """
+    在进程级线程池上执行 tasks，同一时刻最多 max_inflight 个在飞；
+    结果按 tasks 的顺序返回（与串行执行一致），任务里的异常原样抛出。
+    max_inflight <= 1 时直接在当前线程串行执行。
+    """
+    if max_inflight <= 1 or len(tasks) <= 1:
+        return [task() for task in tasks]
+
+    ctx = get_script_run_ctx()
+    gate = threading.BoundedSemaphore(max_inflight)
+
+    def run(task):
+        # 带上当前 session 的 ScriptRunContext，任务里用到 st.cache_resource 等也不会告警
+        add_script_run_ctx(threading.current_thread(), ctx)
+        try:
+            return task()
+        finally:
+            add_script_run_ctx(threading.current_thread(), None)
+            gate.release()
+
+    pool = get_retrieval_pool()
+    futures = []
+    for task in tasks:
+        gate.acquire()
+        # 每个任务一份 contextvars 副本（本轮的 UsageMeter 等）；同一个 Context 不能被多个线程同时 run
+        futures.append(pool.submit(contextvars.copy_context().run, run, task))
+    return [f.result() for f in futures]
+
+
+def fetch_candidate_vectors(
+        candidates: List[Dict[str, Any]],
+        policy_repo: PolicyRepository,
+        thesis_repo: ThesisRepository,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    每个仓库一次 retrieve 取回候选的存储向量，拼成 (n_candidates, dim) 的 float32 矩阵；
+    取不到向量的行为 0，has_vec 标记哪些行有效。
+    """
+    by_repo = {"policy": (policy_repo, []), "thesis": (thesis_repo, [])}
+    for d in candidates:
+        pid = getattr(d["item"], "point_id", None)
+        if pid is not None:
+            by_repo[d["source_type"]][1].append(pid)
+
+    found: Dict[tuple, np.ndarray] = {}
+    for source_type, (repo, ids) in by_repo.items():
+        try:
+            for pid, vec in repo.fetch_vectors(ids).items():
+                found[(source_type, pid)] = vec
+        except Exception as e:
+            log_step(f"[{repo.collection_name}] could not fetch vectors for MMR: {e}")
+
+    dim = next((v.shape[0] for v in found.values()), 0)
+    vectors = np.zeros((len(candidates), dim), dtype=np.float32)
+    has_vec = np.zeros(len(candidates), dtype=bool)
+    for i, d in enumerate(candidates):
+        vec = found.get((d["source_type"], getattr(d["item"], "point_id", None)))
+        if vec is not None and vec.shape[0] == dim:
+            vectors[i] = vec
+            has_vec[i] = True
+    return vectors, has_vec
+
+
+def select_mmr_with_quota(
+        scores: np.ndarray,
+        is_policy: np.ndarray,
+        vectors: np.ndarray,
+        has_vec: np.ndarray,
+        total_k: int,
+        lambda_div: float = 0.4,
+        min_policy: int = 2,
+        min_thesis: int = 3,
+) -> List[int]:
+    """
+    候选已按 score 降序排好；返回选中的下标（按 score 降序，最多 total_k 个）。
+    1) MMR：依次考察候选，mmr = score - lambda_div * max_sim(已选)，mmr > 0 或 max_sim < 0.85 就选；
+       没有向量的候选、以及第一个候选直接选。每选中一个候选做一次 (n, dim) @ (dim,) 的矩阵-向量乘，
+       max_sim 随选中集合增量更新，不再逐对算 cosine。
+    2) 配额：policy / thesis 不够 min_policy / min_thesis 时按 score 顺序从剩余候选补齐。
+    """
+    n = len(scores)
+    # 每个候选与"已选且有向量"的集合的最大相似度；-inf 表示还没有可比较的已选项
+    max_sim = np.full(n, -np.inf)
+    chosen = np.zeros(n, dtype=bool)
+    order: List[int] = []
+
+    for i in range(n):
+        if len(order) >= total_k:
+            break
+        if has_vec[i] and order:
+            ms = max_sim[i] if np.isfinite(max_sim[i]) else 0.0
+            if not (scores[i] - lambda_div * ms > 0.0 or ms < 0.85):
+                continue
+        order.append(i)
+        chosen[i] = True
+        if has_vec[i]:
+            np.maximum(max_sim, vectors @ vectors[i], out=max_sim)
+
+    # 配额没满足时从剩余候选里补齐（候选已按 score 排好，取最前面的即可）
+    for type_mask, minimum in ((is_policy, min_policy), (~is_policy, min_thesis)):
+        need = minimum - int((chosen & type_mask).sum())
+        if need > 0:
+            extra = np.flatnonzero(~chosen & type_mask)[:need]
+            chosen[extra] = True
+            order.extend(int(i) for i in extra)
+
+    # 最终按 score 排序并截断（稳定排序：同分时保持选入顺序）
+    order_arr = np.array(order, dtype=int)
+    return [int(i) for i in order_arr[np.argsort(-scores[order_arr], kind="stable")][:total_k]]
+
+
+def retrieve_candidates(
         query_text: str,
-        query_emb: List[float],
         stage: str,
         mode: str,
         gap: str,
         policy_repo: PolicyRepository,
         thesis_repo: ThesisRepository,
-        total_k: int = 12,
-) -> List[EvidenceCard]:
+        budget: TurnBudget | None = None,
+        cancelled: threading.Event | None = None,
+        subqueries: List[Dict[str, Any]] | None = None,
+) -> Dict[str, Dict[str, Any]] | None:
     """
-    RAG-Fusion + Self-RAG 风格的 evidence fusion：
-    1) 生成多条子查询（policy / precedent / mixed）
-    2) 对每条子查询在两个仓库检索，使用 RRF + 子查询权重做 rank fusion
-    3) 用 LLM reranker 估计 helpfulness + role/gap_tags
-    4) 做带配额的 MMR set selection，保证 rubrics & precedents 兼有且多样
+    fuse_evidence 的前半段：生成子查询 → 一次性 embedding → 两个仓库并行检索 → RRF 融合成
+    fused（evidence key → {id, item, source_type, base_score, rrf_score, score}）。
+    单独拆出来，路由还在跑时可以用猜测的 stage/mode/gap 推测执行（SpeculativeRetrieval）；
+    cancelled 被置位时在下一个检查点返回 None。
+    subqueries: 合并 intake（run_intake）已经给出的子查询，给了就不再调 generate_subqueries。
     """
-    log_step("Step 2: start fuse_evidence (RAG retrieval)...")
     # ---------- 1) Multi-query 生成 ----------
-    subqueries = generate_subqueries(
-        task_context=query_text,
-        stage=stage,
-        mode=mode,
-        gap=gap,
-        max_queries=6,
-    )
+    if subqueries:
+        pass
+    elif budget is None or budget.allows("subqueries", min_s=3.0):
+        subqueries = generate_subqueries(
+            task_context=query_text,
+            stage=stage,
+            mode=mode,
+            gap=gap,
+            max_queries=6,
+            budget=budget,
+        )
+    else:
+        budget.degrade("raw_query_subquery")
+        subqueries = []
+
+    if cancelled is not None and cancelled.is_set():
+        return None
 
     # 没拿到就 fallback 单 query
     if not subqueries:
@@ -1364,6 +3019,50 @@ def fuse_evidence(
         ]
 
     # ---------- 2) multi-query × dual-repo 检索 + RRF ----------
+    # 所有子查询一次性 embedding（一个请求），而不是每条子查询一个 round-trip
+    q_embs = embed_texts([q["text"] for q in subqueries])
+
+    searchable = []
+    for q, q_emb_row in zip(subqueries, q_embs):
+        if not q_emb_row.any():
+            log_step(f"skip subquery {q['id']}: no embedding")
+            continue
+        searchable.append((q, q_emb_row))
+
+    if cancelled is not None and cancelled.is_set():
+        return None
+
+    # 两个 repo 并行检索；在飞上限允许时再把子查询切成几段，每段一次 query_batch_points。
+    # 结果按 (repo, 段) 的固定顺序拼回去，和串行一次性 batch 的结果完全一致。
+    batch_embs = [e for _, e in searchable]
+    n_parts = max(1, min(len(batch_embs), RETRIEVAL_MAX_INFLIGHT // 2))
+    parts = [list(p) for p in np.array_split(np.arange(len(batch_embs)), n_parts)] if batch_embs else []
+    jobs = [
+        (repo, top_k, [batch_embs[i] for i in part], {})
+        for repo, top_k in ((policy_repo, 10), (thesis_repo, 12))
+        for part in parts
+    ]
+    t0 = time.perf_counter()
+    job_results = run_bounded(
+        [
+            partial(repo.batch_scored_search, embs, stage, mode, gap, top_k=top_k, stats=stats)
+            for repo, top_k, embs, stats in jobs
+        ],
+        max_inflight=RETRIEVAL_MAX_INFLIGHT,
+    )
+    p_batches, t_batches = [], []
+    for (repo, *_), res in zip(jobs, job_results):
+        (p_batches if repo is policy_repo else t_batches).extend(res)
+    transfer_stats: Dict[str, int] = {}
+    for *_, stats in jobs:
+        for k, v in stats.items():
+            transfer_stats[k] = transfer_stats.get(k, 0) + v
+    log_step(
+        f"retrieval: {len(jobs)} requests (max in-flight {RETRIEVAL_MAX_INFLIGHT}) in "
+        f"{(time.perf_counter() - t0) * 1000:.0f} ms, {transfer_stats.get('hits', 0)} hits, "
+        f"~{transfer_stats.get('payload_bytes', 0)} payload bytes this turn"
+    )
+
     def rrf(rank: int, k: int = 60) -> float:
         return 1.0 / (k + rank + 1)
 
@@ -1382,13 +3081,10 @@ def fuse_evidence(
             # 同一 doc 被不同子查询命中时，累加 rrf
             fused[evid_key]["rrf_score"] += float(rrf_score)
 
-    for q in subqueries:
-        q_text = q["text"]
+    for (q, _), p_scored, t_scored in zip(searchable, p_batches, t_batches):
         q_type = q["type"]
         w_q = q["weight"]
 
-        emb = embed_text(q_text)
-
         # 根据 q_type 调整两个 repo 的权重
         if q_type == "policy":
             w_policy, w_thesis = 1.0, 0.5
@@ -1397,10 +3093,6 @@ def fuse_evidence(
         else:  # mixed
             w_policy = w_thesis = 0.9
 
-        # 每个子查询里多取一点，再交给后面的融合
-        p_scored = policy_repo.scored_search(emb, stage, mode, gap, top_k=10)
-        t_scored = thesis_repo.scored_search(emb, stage, mode, gap, top_k=12)
-
         for rank, (it, s) in enumerate(p_scored):
             evid_key = f"policy:{it.id}"
             score_rrf = w_q * w_policy * rrf(rank)
@@ -1411,34 +3103,147 @@ def fuse_evidence(
             score_rrf = w_q * w_thesis * rrf(rank)
             add_candidate(evid_key, "thesis", seg, base_score=float(s), rrf_score=score_rrf)
 
+    # 把 base_score 和 rrf_score 合成一个初始分数
+    for d in fused.values():
+        # 这里简单线性组合：stage/mode/gap bonus 已经在 base_score 里
+        d["score"] = float(0.6 * d["base_score"] + 1.2 * d["rrf_score"])
+    return fused
+
+
+class SpeculationStats:
+    """推测执行的进程级统计：launched / reused / discarded / failed 次数，以及省下和浪费的秒数。"""
+
+    def __init__(self):
+        self.stats = {"launched": 0, "reused": 0, "discarded": 0, "failed": 0, "saved_s": 0.0, "wasted_s": 0.0}
+        self._lock = threading.Lock()
+
+    def record(self, outcome: str, saved_s: float = 0.0, wasted_s: float = 0.0):
+        with self._lock:
+            self.stats[outcome] += 1
+            self.stats["saved_s"] = round(self.stats["saved_s"] + saved_s, 3)
+            self.stats["wasted_s"] = round(self.stats["wasted_s"] + wasted_s, 3)
+
+
+@st.cache_resource
+def get_speculation_stats() -> SpeculationStats:
+    return SpeculationStats()
+
+
+@st.cache_resource
+def get_speculation_pool() -> ThreadPoolExecutor:
+    # 单独的池：推测任务内部还会往检索池提交任务，放在同一个池里可能互相等死
+    return ThreadPoolExecutor(max_workers=SPECULATION_POOL_SIZE, thread_name_prefix="ebcs-speculation")
+
+
+class SpeculativeRetrieval:
+    """
+    路由 LLM 还在跑的时候，用当前 alignment 猜测的 stage/mode/gap 先跑 retrieve_candidates
+    （子查询生成 + 检索）。路由返回同样的 stage/mode/gap 就直接复用（resolve），
+    否则丢弃（discard）：还没开始的任务直接取消，正在跑的在下一个检查点停下。
+    - 复用时省下的时间 = 路由结束前推测任务已经完成的那部分工作；
+    - 丢弃时浪费的时间 = 推测任务到丢弃为止跑了多久。
+    """
+
+    def __init__(self, task_context: str, alignment: Dict[str, Any],
+                 policy_repo: PolicyRepository, thesis_repo: ThesisRepository,
+                 budget: TurnBudget | None = None):
+        self.key = (alignment.get("stage"), alignment.get("mode"), alignment.get("gap"))
+        self.budget = budget.fork() if budget is not None else None
+        self.cancelled = threading.Event()
+        self.started = time.monotonic()
+        self.finished_at: float | None = None
+        ctx = get_script_run_ctx()
+
+        def run():
+            add_script_run_ctx(threading.current_thread(), ctx)
+            try:
+                return retrieve_candidates(task_context, *self.key, policy_repo, thesis_repo,
+                                           budget=self.budget, cancelled=self.cancelled)
+            finally:
+                self.finished_at = time.monotonic()
+                add_script_run_ctx(threading.current_thread(), None)
+
+        self.future = get_speculation_pool().submit(contextvars.copy_context().run, run)
+        get_speculation_stats().record("launched")
+        log_step(f"[speculation] started retrieval for stage/mode/gap={self.key}")
+
+    def resolve(self, stage: str, mode: str, gap: str,
+                budget: TurnBudget | None = None) -> Dict[str, Dict[str, Any]] | None:
+        """路由结果与猜测一致时返回推测算好的 fused 候选（必要时等它跑完），否则丢弃并返回 None。"""
+        if (stage, mode, gap) != self.key:
+            self.discard()
+            return None
+        routed_at = time.monotonic()
+        try:
+            table = self.future.result()
+        except Exception as e:
+            get_speculation_stats().record("failed", wasted_s=(self.finished_at or time.monotonic()) - self.started)
+            log_step(f"[speculation] failed, retrieving again: {e}")
+            return None
+        saved = min(self.finished_at or routed_at, routed_at) - self.started
+        get_speculation_stats().record("reused", saved_s=saved)
+        if budget is not None and self.budget is not None:
+            budget.absorb(self.budget)
+        log_step(f"[speculation] reused; saved {saved:.2f}s")
+        return table
+
+    def discard(self):
+        self.cancelled.set()
+        wasted = 0.0 if self.future.cancel() else (self.finished_at or time.monotonic()) - self.started
+        get_speculation_stats().record("discarded", wasted_s=wasted)
+        log_step(f"[speculation] discarded (guessed {self.key}); wasted {wasted:.2f}s")
+
+
+def fuse_evidence(
+        query_text: str,
+        query_emb: np.ndarray,
+        stage: str,
+        mode: str,
+        gap: str,
+        policy_repo: PolicyRepository,
+        thesis_repo: ThesisRepository,
+        total_k: int = 12,
+        budget: TurnBudget | None = None,
+        prepared: Dict[str, Dict[str, Any]] | None = None,
+        subqueries: List[Dict[str, Any]] | None = None,
+) -> List[EvidenceCard]:
+    """
+    RAG-Fusion + Self-RAG 风格的 evidence fusion：
+    1) 生成多条子查询（policy / precedent / mixed）
+    2) 对每条子查询在两个仓库检索，使用 RRF + 子查询权重做 rank fusion
+    3) 用 reranker（LLM 或本地特征打分，见 EBCS_RERANKER）估计 helpfulness + role/gap_tags
+    4) 做带配额的 MMR set selection，保证 rubrics & precedents 兼有且多样
+    给了 budget 时各步按 TurnBudget 的截止时间降级（见 TurnBudget）。
+    prepared: 推测执行已经算好的 1) + 2) 结果（retrieve_candidates 的返回值）。
+    subqueries: 合并 intake 已经生成的子查询（见 run_intake），跳过 1) 里的 LLM 调用。
+    """
+    log_step("Step 2: start fuse_evidence (RAG retrieval)...")
+    # ---------- 1) + 2) 子查询 + 检索 + RRF（推测执行时已经做完） ----------
+    fused = prepared
+    if fused is None:
+        fused = retrieve_candidates(query_text, stage, mode, gap, policy_repo, thesis_repo, budget=budget,
+                                    subqueries=subqueries)
     if not fused:
         return []
-
-    # 把 base_score 和 rrf_score 合成一个初始分数
-    for d in fused.values():
-        # 这里简单线性组合：stage/mode/gap bonus 已经在 base_score 里
-        d["score"] = float(0.6 * d["base_score"] + 1.2 * d["rrf_score"])
-
-    # ---------- 3) LLM rerank（Self-RAG 风格 helpfulness） ----------
-    cand_list_for_llm = []
-    for key, d in fused.items():
-        it = d["item"]
-        if d["source_type"] == "policy":
-            title = getattr(it, "label", "")
-            snippet = getattr(it, "description", "")
-        else:
-            title = getattr(it, "label", "")
-            snippet = getattr(it, "summary", "")
-        cand_list_for_llm.append(
-            {
-                "id": key,
-                "title": title,
-                "snippet": snippet,
-                "source_type": d["source_type"],
-            }
+    candidates = list(fused.values())
+    vectors = np.zeros((len(candidates), 0), dtype=np.float32)
+    has_vec = np.zeros(len(candidates), dtype=bool)
+
+    # ---------- 3) rerank（Self-RAG 风格 helpfulness；EBCS_RERANKER 选 LLM 或本地打分） ----------
+    reranker = get_reranker()
+    if reranker.uses_vectors:
+        vectors, has_vec = fetch_candidate_vectors(candidates, policy_repo, thesis_repo)
+
+    if not reranker.remote or budget is None or budget.allows("rerank", min_s=5.0):
+        t0 = time.perf_counter()
+        llm_info = reranker.rerank(
+            query_text, query_emb, rerank_candidates(fused),
+            vectors=vectors, has_vec=has_vec, top_k=total_k * 2, budget=budget,
         )
-
-    llm_info = llm_rerank_evidence(query_text, cand_list_for_llm, top_k=total_k * 2)
+        log_step(f"rerank ({reranker.name}): {len(llm_info)} judged in {(time.perf_counter() - t0) * 1000:.1f} ms")
+    else:
+        budget.degrade("skip_rerank")
+        llm_info = {}
 
     # 把 helpfulness/role/gap_tags 注入 fused
     for key, d in fused.items():
@@ -1457,70 +3262,41 @@ def fuse_evidence(
             d["llm_role"] = None
             d["llm_tags"] = []
 
-    # ---------- 4) 带配额的 MMR set selection ----------
-    # 至少想要多少 rubrics / precedents
-    min_policy = 2
-    min_thesis = 3
-
-    # 按最终 score 排序
-    candidates_sorted = sorted(fused.values(), key=lambda x: x["score"], reverse=True)
+    # 留给 plan 的时间已经不到它份额的 3/4：少给几条 evidence，缩短 plan 的 prompt
+    if budget is not None and budget.remaining("plan") < 0.75 * budget.share("plan"):
+        budget.degrade("shrink_total_k")
+        total_k = max(6, total_k * 2 // 3)
 
-    def get_embedding(d: Dict[str, Any]) -> np.ndarray:
-        it = d["item"]
-        return getattr(it, "embedding", None)
-
-    selected: List[Dict[str, Any]] = []
-    lambda_div = 0.4
-
-    for cand in candidates_sorted:
-        if len(selected) >= total_k:
-            break
-        emb_c = get_embedding(cand)
-        if emb_c is None or not selected:
-            selected.append(cand)
-            continue
-
-        sims = []
-        for s in selected:
-            emb_s = get_embedding(s)
-            if emb_s is None:
-                continue
-            denom = (np.linalg.norm(emb_c) * np.linalg.norm(emb_s) + 1e-9)
-            sims.append(float(np.dot(emb_c, emb_s) / denom))
-        max_sim = max(sims) if sims else 0.0
-
-        mmr_score = cand["score"] - lambda_div * max_sim
-        if mmr_score > 0.0 or max_sim < 0.85:
-            selected.append(cand)
-
-    # 如果配额没满足，尝试从剩余中补齐
-    def count_by_type(lst, t):
-        return sum(1 for d in lst if d["source_type"] == t)
-
-    # 补 policy
-    if count_by_type(selected, "policy") < min_policy:
-        for cand in candidates_sorted:
-            if cand in selected:
-                continue
-            if cand["source_type"] != "policy":
-                continue
-            selected.append(cand)
-            if count_by_type(selected, "policy") >= min_policy:
-                break
-
-    # 补 thesis
-    if count_by_type(selected, "thesis") < min_thesis:
-        for cand in candidates_sorted:
-            if cand in selected:
-                continue
-            if cand["source_type"] != "thesis":
-                continue
-            selected.append(cand)
-            if count_by_type(selected, "thesis") >= min_thesis:
-                break
-
-    # 最终截断并按 score 排序
-    selected = sorted(selected, key=lambda x: x["score"], reverse=True)[:total_k]
+    # ---------- 4) 带配额的 MMR set selection ----------
+    # 按最终 score 排序（稳定排序：同分时保持插入顺序）
+    order = sorted(range(len(candidates)), key=lambda i: candidates[i]["score"], reverse=True)
+    candidates_sorted = [candidates[i] for i in order]
+
+    t0 = time.perf_counter()
+    if not MMR_USE_VECTORS:
+        vectors = np.zeros((len(candidates), 0), dtype=np.float32)
+        has_vec = np.zeros(len(candidates), dtype=bool)
+    elif reranker.uses_vectors:
+        pass  # rerank 前已经取好
+    elif budget is not None and not budget.allows("rerank", min_s=0.0):
+        budget.degrade("skip_mmr_vectors")
+    else:
+        vectors, has_vec = fetch_candidate_vectors(candidates, policy_repo, thesis_repo)
+    t_fetch = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    picked = select_mmr_with_quota(
+        scores=np.array([d["score"] for d in candidates_sorted]),
+        is_policy=np.array([d["source_type"] == "policy" for d in candidates_sorted]),
+        vectors=vectors[order],
+        has_vec=has_vec[order],
+        total_k=total_k,
+    )
+    selected = [candidates_sorted[i] for i in picked]
+    log_step(
+        f"MMR: {len(candidates_sorted)} candidates ({int(has_vec.sum())} with vectors) -> {len(selected)}; "
+        f"vector fetch {t_fetch * 1000:.1f} ms, selection {(time.perf_counter() - t0) * 1000:.2f} ms"
+    )
 
     # ---------- 5) 构造 EvidenceCard ----------
     cards: List[EvidenceCard] = []
@@ -1548,7 +3324,9 @@ def fuse_evidence(
                 "llm_role": llm_role,
                 "tags": ",".join(llm_tags),
                 "source_path": getattr(it, "source_path", None),
+                # 原文 markdown 不随检索返回；展示时由 ensure_evidence_markdown 按 point_id 取
                 "source_chunk_md": getattr(it, "source_chunk_md", None),
+                "point_id": getattr(it, "point_id", None),
             }
         else:
             title = f"{it.label} (precedent)"
@@ -1566,6 +3344,7 @@ def fuse_evidence(
                 "tags": ",".join(llm_tags),
                 "source_path": getattr(it, "source_path", None),
                 "source_chunk_md": getattr(it, "source_chunk_md", None),
+                "point_id": getattr(it, "point_id", None),
             }
 
         cards.append(
@@ -1581,22 +3360,41 @@ def fuse_evidence(
     return cards
 
 
+def ensure_evidence_markdown(
+        card: EvidenceCard,
+        policy_repo: PolicyRepository,
+        thesis_repo: ThesisRepository,
+) -> str | None:
+    """
+    Evidence Vault 里真正被打开的卡片才去 Qdrant 取原文 markdown（client.retrieve by id），
+    结果写回 card.meta，同一张卡片只取一次。
+    """
+    meta = card.meta
+    if meta.get("source_chunk_md") or meta.get("markdown_fetched") or meta.get("point_id") is None:
+        return meta.get("source_chunk_md")
+
+    repo = policy_repo if card.source_type == "policy" else thesis_repo
+    try:
+        md_text = repo.fetch_markdown([meta["point_id"]]).get(meta["point_id"])
+    except Exception as e:
+        print("Failed to fetch evidence markdown:", e)
+        md_text = None
+    meta["source_chunk_md"] = md_text
+    meta["markdown_fetched"] = True
+    return md_text
+
+
 # -----------------------
 # 路由 + Gap 追问
 # -----------------------
 
-def route_and_maybe_ask(
-        conversation_text: str,
-) -> Dict[str, Any]:
-    """
-    Router：推断 stage / mode / gap，并判断是否信息足够。
-    专门针对 TU Delft IDE MSc graduation（rubrics + theses 双语料）。
-    """
+def router_instructions() -> str:
+    """route_and_maybe_ask 和 run_intake 共用的路由说明（不含输出格式部分）。"""
     stage_list = ", ".join(STAGES)
     mode_list = ", ".join(MODES)
     gap_list = ", ".join(GAPS)
 
-    system_prompt = (
+    return (
         "You are the intake router for EBCS, an evidence-bound thesis coach for MSc IDE "
         "graduation projects at TU Delft.\n"
         "The system uses:\n"
@@ -1643,6 +3441,18 @@ def route_and_maybe_ask(
         "  - answerable in 1–3 sentences.\n\n"
         "Also label what is missing, using a list drawn from:\n"
         "['domain', 'users', 'metrics', 'draft_status', 'method', 'other'].\n\n"
+    )
+
+
+def route_and_maybe_ask(
+        conversation_text: str,
+        budget: TurnBudget | None = None,
+) -> Dict[str, Any]:
+    """
+    Router：推断 stage / mode / gap，并判断是否信息足够。
+    专门针对 TU Delft IDE MSc graduation（rubrics + theses 双语料）。
+    """
+    system_prompt = router_instructions() + (
         "Return ONLY a JSON object with this schema:\n"
         "{\n"
         "  \"stage\": \"proposal|greenlight|midterm|final|defense|other\",\n"
@@ -1657,7 +3467,25 @@ def route_and_maybe_ask(
     )
     user_prompt = conversation_text
 
-    resp = call_llm(system_prompt, user_prompt)
+    fallback_routing = {
+        "stage": "proposal",
+        "mode": "exploration",
+        "gap": "unknown",
+        "enough_info": False,
+        "missing": ["domain", "users", "metrics"],
+        "reason": "Fallback router engaged due to JSON parse failure.",
+        "followup_question": (
+            "为了继续，我需要再了解一点：你的项目主要面向谁、在什么场景使用？"
+            "另外，你现在最想验证的 1–2 个指标是什么？"
+        ),
+    }
+    try:
+        resp = call_llm(system_prompt, user_prompt, timeout=budget.timeout("route") if budget else None,
+                        site="route", cache_if=is_json_text)
+    except (LLMUnavailable, openai.APIError) as e:
+        # provider 不可用：不再让 fallback router 调一次 LLM，直接用模板追问
+        log_step(f"[route] LLM unavailable ({type(e).__name__}), using the template follow-up")
+        return dict(fallback_routing, reason="Fallback router engaged because the LLM is unavailable.")
     txt = resp.strip()
 
     try:
@@ -1688,24 +3516,225 @@ def route_and_maybe_ask(
             fq = call_llm(
                 smart_fallback_prompt,
                 conversation_text,
+                timeout=budget.timeout("route") if budget else None,
+                site="route_fallback",
             ).strip()
         except Exception:
             # 最后兜底：如果 LLM 又挂了
-            fq = (
-                "为了继续，我需要再了解一点：你的项目主要面向谁、在什么场景使用？"
-                "另外，你现在最想验证的 1–2 个指标是什么？"
-            )
+            fq = fallback_routing["followup_question"]
+
+        return dict(fallback_routing, followup_question=fq)
+
+
+# 本地路由的种子原型：每个标签一句描述（取自 router_instructions 里的解释）；
+# bench.py fit-router 可以用带标签的历史对话重新拟合并写到 ROUTER_PROTOTYPES_PATH
+ROUTER_LABEL_DESCRIPTIONS = {
+    "stage": {
+        "proposal": "exploring a thesis topic and early problem framing for the graduation proposal",
+        "greenlight": "preparing or revising a formal research plan for green-light approval",
+        "midterm": "in the middle of thesis work, methods partly running, first results emerging",
+        "final": "writing up and polishing the final thesis report or design dossier",
+        "defense": "preparing for the final defense presentation and exam questions",
+        "other": "a question unrelated to a specific graduation stage",
+    },
+    "mode": {
+        "exploration": "clarify the topic, problem space or possible directions",
+        "precedents": "look for similar past theses, methods or cases",
+        "diagnose": "figure out what is wrong or stuck with the research question, method or results",
+        "checklist": "work through stage-specific requirements, rubrics and checklists",
+        "plan_synthesis": "synthesize a concrete next-steps plan or research design",
+        "critique": "get critique on a draft, concept, method or research question",
+        "ethics": "ethics, privacy, data protection, consent or risk questions",
+        "defense_drill": "rehearse exam and defense questions",
+        "other": "generic chat that is not about the thesis",
+    },
+    "gap": {
+        "content": "I have a draft text, slides or plan that needs improvement",
+        "process": "unsure about procedures, requirements, deadlines or next steps",
+        "knowledge": "missing conceptual or methodological background knowledge",
+        "precedent": "mainly want examples from previous theses",
+        "mixed": "several problems at once: draft quality, procedures and background",
+        "unknown": "no concrete problem described yet, just a greeting or a vague request for help",
+    },
+}
 
-        return {
-            "stage": "proposal",
-            "mode": "exploration",
-            "gap": "unknown",
-            "enough_info": False,
-            "missing": ["domain", "users", "metrics"],
-            "reason": "Fallback router engaged due to JSON parse failure.",
-            "followup_question": fq,
+
+class LocalRouter:
+    """
+    stage / mode / gap 各一组单位化质心（原型向量）。classify 对单位化的对话 embedding 做 cosine，
+    softmax(sim / ROUTER_TEMPERATURE) 的最大概率作为置信度。
+    """
+
+    axes = ("stage", "mode", "gap")
+
+    def __init__(self, prototypes: Dict[str, tuple[List[str], np.ndarray]]):
+        self.prototypes = {
+            axis: (list(labels), centroids / np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12))
+            for axis, (labels, centroids) in prototypes.items()
         }
 
+    @classmethod
+    def from_descriptions(cls, descriptions: Dict[str, Dict[str, str]] = ROUTER_LABEL_DESCRIPTIONS) -> "LocalRouter":
+        texts = [text for axis in cls.axes for text in descriptions[axis].values()]
+        embs = embed_texts(texts)
+        prototypes, start = {}, 0
+        for axis in cls.axes:
+            n = len(descriptions[axis])
+            prototypes[axis] = (list(descriptions[axis]), embs[start:start + n])
+            start += n
+        return cls(prototypes)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "LocalRouter":
+        with np.load(path, allow_pickle=False) as data:
+            return cls({axis: (data[f"{axis}_labels"].tolist(), data[f"{axis}_centroids"]) for axis in cls.axes})
+
+    def save(self, path: str | Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        arrays = {}
+        for axis, (labels, centroids) in self.prototypes.items():
+            arrays[f"{axis}_labels"] = np.array(labels)
+            arrays[f"{axis}_centroids"] = centroids.astype(np.float32)
+        np.savez(path, **arrays)
+
+    def classify(self, emb: np.ndarray) -> Dict[str, tuple[str, float]]:
+        emb = emb / max(float(np.linalg.norm(emb)), 1e-12)
+        out = {}
+        for axis, (labels, centroids) in self.prototypes.items():
+            logits = centroids @ emb / ROUTER_TEMPERATURE
+            probs = np.exp(logits - logits.max())
+            probs /= probs.sum()
+            best = int(np.argmax(probs))
+            out[axis] = (labels[best], float(probs[best]))
+        return out
+
+
+@st.cache_resource
+def get_local_router() -> LocalRouter | None:
+    try:
+        if Path(ROUTER_PROTOTYPES_PATH).exists():
+            return LocalRouter.load(ROUTER_PROTOTYPES_PATH)
+        return LocalRouter.from_descriptions()
+    except Exception as e:
+        log_step(f"[router] local router unavailable: {e}")
+        return None
+
+
+class RouterStats:
+    """本地路由的进程级统计：本地决定 / 因置信度低或 enough_info 拿不准而交给 LLM 的次数，本地耗时和估算省下的时间。"""
+
+    def __init__(self):
+        self.stats = {"local": 0, "llm_low_confidence": 0, "llm_enough_info": 0, "local_s": 0.0, "saved_s": 0.0}
+        self._lock = threading.Lock()
+
+    def record(self, outcome: str, local_s: float = 0.0, saved_s: float = 0.0):
+        with self._lock:
+            self.stats[outcome] += 1
+            self.stats["local_s"] = round(self.stats["local_s"] + local_s, 3)
+            self.stats["saved_s"] = round(self.stats["saved_s"] + saved_s, 3)
+
+
+@st.cache_resource
+def get_router_stats() -> RouterStats:
+    return RouterStats()
+
+
+INTAKE_SLOT_PATTERNS = {
+    "users": re.compile(
+        r"\b(users?|students?|participants?|stakeholders?|customers?|patients?|employees?|workers?|pickers?|"
+        r"people|elderly|children|clinicians?|nurses?|visitors?|citizens?|drivers?|operators?)\b"
+        r"|用户|学生|参与者|使用者|患者|员工"
+    ),
+    "metrics": re.compile(
+        r"\b(metrics?|measur\w*|evaluat\w*|usability|completion time|error rates?|engagement|satisfaction|"
+        r"adoption|trust|accuracy|effectiveness|efficiency|workload|retention|kpis?)\b"
+        r"|指标|评估|衡量|满意度|效率|错误率"
+    ),
+}
+
+
+def missing_intake_slots(conversation_text: str) -> List[str]:
+    """
+    粗略的槽位检查：domain 看描述长度，users / metrics 看关键词；返回缺的槽位。
+    关键词很宽（"student" 算 users，"evaluate" 算 metrics），所以"槽位都在"不代表信息足够，
+    只有缺得多时才用来判 enough_info=False（见 decide_local_route）。
+    """
+    text = conversation_text.lower()
+    missing = []
+    if len(text.split()) < 15 and len(text) < 60:
+        missing.append("domain")
+    missing.extend(slot for slot, pattern in INTAKE_SLOT_PATTERNS.items() if not pattern.search(text))
+    return missing
+
+
+def decide_local_route(
+        labels: Dict[str, tuple[str, float]],
+        missing: List[str],
+) -> tuple[Dict[str, Any] | None, str]:
+    """
+    本地路由的判定规则：本地只决定 stage / mode / gap，enough_info 只能本地判成 False。
+    三个轴的置信度都 ≥ ROUTER_MIN_CONFIDENCE、且至少缺 2 个槽位（明显还要追问）时给出 routing；
+    否则 (None, 交给 LLM 的原因)——信息可能已经足够时，由 LLM 路由判断 enough_info。
+    """
+    if any(conf < ROUTER_MIN_CONFIDENCE for _, conf in labels.values()):
+        return None, "llm_low_confidence"
+    if len(missing) < 2:
+        return None, "llm_enough_info"
+    confidences = ", ".join(f"{axis}={label}@{conf:.2f}" for axis, (label, conf) in labels.items())
+    return {
+        "stage": labels["stage"][0],
+        "mode": labels["mode"][0],
+        "gap": labels["gap"][0],
+        "enough_info": False,
+        "missing": missing,
+        "reason": f"Local prototype router ({confidences}).",
+        "followup_question": "",
+    }, "local"
+
+
+def route_locally(conversation_text: str) -> Dict[str, Any] | None:
+    """
+    本地路由：embedding（走 EmbeddingCache，Step 1 会复用）→ LocalRouter 分类 + 槽位检查。
+    三个轴的置信度都够、且明显缺信息（缺 ≥2 个槽位）时返回与 route_and_maybe_ask 相同结构、enough_info=False
+    的 routing；否则返回 None，由 LLM 路由决定（包括 enough_info）。followup_question 留空，交给 build_followup_question。
+    """
+    router = get_local_router()
+    if router is None:
+        return None
+    stats = get_router_stats()
+    t0 = time.perf_counter()
+    labels = router.classify(embed_text(conversation_text))
+    missing = missing_intake_slots(conversation_text)
+    local_s = time.perf_counter() - t0
+    routing, outcome = decide_local_route(labels, missing)
+    if routing is None:
+        stats.record(outcome, local_s=local_s)
+        log_step(f"[router] {outcome}: {labels}, missing={missing}; asking the LLM router")
+        return None
+
+    # 省下的时间按最近 LLM 路由延迟的中位数估算
+    llm_route_s = get_llm_resilience().latency_quantile("route", 0.5)
+    saved_s = max(0.0, llm_route_s - local_s) if llm_route_s is not None else 0.0
+    stats.record("local", local_s=local_s, saved_s=saved_s)
+    log_step(f"[router] routed locally in {local_s * 1000:.0f} ms: {routing['reason']} missing={missing}")
+    return routing
+
+
+def subquery_guidance() -> str:
+    """generate_subqueries 和 run_intake 共用的子查询规划说明。"""
+    return (
+        "Each sub-query must target one of: 'policy', 'precedent', or 'mixed'.\n\n"
+        "Guidance:\n"
+        "- Use 'policy' for queries about requirements, assessment criteria, checklists, deadlines,\n"
+        "  mandatory elements of proposal/green-light/midterm/final/defense.\n"
+        "- Use 'precedent' for queries about similar IDE theses, methods, metrics, research questions,\n"
+        "  data collection, analysis pipelines, or typical pitfalls.\n"
+        "- Use 'mixed' when both rubrics and precedents are equally important.\n"
+        "- Tailor queries to the given stage and mode; e.g., at 'proposal/exploration', focus on\n"
+        "  framing RQs and domain exemplars; at 'greenlight/checklist', focus on required slots\n"
+        "  (population, context, method↔metric, feasibility, ethics).\n\n"
+    )
+
 
 def generate_subqueries(
         task_context: str,
@@ -1713,6 +3742,7 @@ def generate_subqueries(
         mode: str,
         gap: str,
         max_queries: int = 6,
+        budget: TurnBudget | None = None,
 ) -> List[Dict[str, Any]]:
     """
     RAG-Fusion 风格的子查询生成：
@@ -1726,16 +3756,7 @@ def generate_subqueries(
         "- 'thesis': segments from past IDE MSc theses (methods, metrics, RQs, pitfalls, examples).\n\n"
         "Given the student's notes plus the routing (stage/mode/gap), propose 3–6 short English "
         "sub-queries for retrieval.\n"
-        "Each sub-query must target one of: 'policy', 'precedent', or 'mixed'.\n\n"
-        "Guidance:\n"
-        "- Use 'policy' for queries about requirements, assessment criteria, checklists, deadlines,\n"
-        "  mandatory elements of proposal/green-light/midterm/final/defense.\n"
-        "- Use 'precedent' for queries about similar IDE theses, methods, metrics, research questions,\n"
-        "  data collection, analysis pipelines, or typical pitfalls.\n"
-        "- Use 'mixed' when both rubrics and precedents are equally important.\n"
-        "- Tailor queries to the given stage and mode; e.g., at 'proposal/exploration', focus on\n"
-        "  framing RQs and domain exemplars; at 'greenlight/checklist', focus on required slots\n"
-        "  (population, context, method↔metric, feasibility, ethics).\n\n"
+        + subquery_guidance() +
         "Return ONLY a JSON object like:\n"
         "{\n"
         "  \"queries\": [\n"
@@ -1762,11 +3783,17 @@ def generate_subqueries(
     user_prompt = json.dumps(user_payload, ensure_ascii=False)
 
     try:
-        resp = call_llm(system_prompt, user_prompt)
+        resp = call_llm(system_prompt, user_prompt,
+                        timeout=budget.timeout("subqueries", floor_s=0.0) if budget else None,
+                        site="subqueries", cache_if=is_json_text)
         txt = resp.strip()
         data = json.loads(txt)
         queries = data.get("queries", [])
     except Exception:
+        if budget is not None and budget.remaining("subqueries") <= 0:
+            # 超时：交给 fuse_evidence 用原始问题做单条子查询
+            budget.degrade("raw_query_subquery")
+            return []
         base_q = task_context.split("\n")[-1][:120]
         queries = [
             {
@@ -1789,6 +3816,11 @@ def generate_subqueries(
             },
         ]
 
+    return clean_subqueries(queries, task_context, max_queries)
+
+
+def clean_subqueries(queries: List[Dict[str, Any]], task_context: str, max_queries: int = 6) -> List[Dict[str, Any]]:
+    """规整模型给的子查询：type 限定在 policy/precedent/mixed，weight 夹到 [0.3, 1.0]，不足 3 条用原始问题补齐。"""
     cleaned = []
     for i, q in enumerate(queries):
         text = str(q.get("text", "")).strip()
@@ -1830,6 +3862,7 @@ def build_followup_question(
         task_context: str,
         routing: Dict[str, Any],
         followup_count: int,
+        budget: TurnBudget | None = None,
 ) -> str:
     """
     使用模型来生成澄清问题：
@@ -1873,7 +3906,8 @@ def build_followup_question(
     user_prompt = json.dumps(payload, ensure_ascii=False)
 
     try:
-        resp = call_llm(system_prompt, user_prompt)
+        resp = call_llm(system_prompt, user_prompt, timeout=budget.timeout("plan") if budget else None,
+                        site="followup")
         text = resp.strip()
         if not text:
             if base_q:
@@ -1897,6 +3931,7 @@ def build_exhausted_warning(
         task_context: str,
         alignment: Dict[str, Any],
         followup_count: int,
+        budget: TurnBudget | None = None,
 ) -> str:
     """
     Called when we already asked several clarification questions but the project
@@ -1956,11 +3991,16 @@ def build_exhausted_warning(
     user_prompt = json.dumps(payload, ensure_ascii=False)
 
     try:
-        resp = call_llm(system_prompt, user_prompt)
+        resp = call_llm(system_prompt, user_prompt, timeout=budget.timeout("plan") if budget else None,
+                        site="warning")
         text = resp.strip()
         if not text:
             raise ValueError("empty warn text")
         return text
+    except (LLMUnavailable, openai.APIError) as e:
+        # provider 已经在报错 / 熔断：别再发第二个 LLM 请求，直接用模板
+        log_step(f"[warning] LLM unavailable ({type(e).__name__}), using the template warning")
+        return EXHAUSTED_WARNING_TEMPLATE
     except Exception:
         # Intelligent fallback: regenerate a natural warning message via LLM
         fallback_prompt = (
@@ -1979,6 +4019,8 @@ def build_exhausted_warning(
             out = call_llm(
                 fallback_prompt,
                 json.dumps(payload, ensure_ascii=False),
+                timeout=budget.timeout("plan") if budget else None,
+                site="warning_fallback",
             ).strip()
             if out:
                 return out
@@ -1986,26 +4028,531 @@ def build_exhausted_warning(
             pass
 
         # Final fallback (rarely triggered)
-        return (
-            "The information is still too high-level for me to align accurately with IDE thesis rubrics.\n\n"
-            "I will now make some reasonable assumptions based on common IDE MSc projects and give you a general but actionable plan.\n\n"
-            "Next time, if you can provide clearer project context, main users, research focus, and intended methods/metrics, "
-            "I can give you much more tailored guidance."
+        return EXHAUSTED_WARNING_TEMPLATE
+
+
+EXHAUSTED_WARNING_TEMPLATE = (
+    "The information is still too high-level for me to align accurately with IDE thesis rubrics.\n\n"
+    "I will now make some reasonable assumptions based on common IDE MSc projects and give you a general but actionable plan.\n\n"
+    "Next time, if you can provide clearer project context, main users, research focus, and intended methods/metrics, "
+    "I can give you much more tailored guidance."
+)
+
+
+@st.cache_resource
+def get_memory_pool() -> ThreadPoolExecutor:
+    # 摘要折叠在后台跑，不占当前轮的延迟
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="ebcs-memory")
+
+
+class RollingMemory:
+    """
+    有界的 task_context：用户消息原文一直保留，直到未折叠的原文超过 fold_tokens（默认 CONTEXT_FOLD_TOKENS）；
+    这时除最近 recent_n 条以外的原文作为一批，在后台线程池里折叠进滚动摘要（一次 call_llm，site="summary"）。
+    折叠不在关键路径上：本轮照常用旧摘要 + 原文（超出 site 预算的较早原文先省略），
+    后面某一轮 update() 发现折叠完成时再换上新摘要。对象存在 st.session_state 里。
+    context(site) 按 CONTEXT_SITE_TOKENS[site] 组装：优先放最近的消息，剩下的预算给摘要；
+    没有摘要且没超预算时就是原来的 "\n".join(user_msgs)。
+    """
+
+    def __init__(self, recent_n: int = CONTEXT_RECENT_MESSAGES, summary_tokens: int = CONTEXT_SUMMARY_TOKENS,
+                 fold_tokens: int = CONTEXT_FOLD_TOKENS):
+        self.recent_n = recent_n
+        self.summary_tokens = summary_tokens
+        self.fold_tokens = fold_tokens
+        self.summary = ""
+        self.folded = 0  # 已经折叠进 summary 的用户消息条数
+        self.messages: List[str] = []
+        self.pending: Future | None = None  # 后台折叠，结果是 (summary, fold_until)
+
+    def update(self, user_msgs: List[str]):
+        if len(user_msgs) < self.folded or self.messages[:len(user_msgs)] != list(user_msgs)[:len(self.messages)]:
+            # 对话被清空 / 重开：摘要和还在跑的折叠都作废
+            self.summary, self.folded, self.pending = "", 0, None
+        self.messages = list(user_msgs)
+        self._apply_pending()
+        if self.pending is not None:
+            return
+        unfolded = self.messages[self.folded:]
+        fold_until = len(self.messages) - self.recent_n
+        if fold_until <= self.folded or estimate_tokens("\n".join(unfolded)) <= self.fold_tokens:
+            return
+        to_fold = self.messages[self.folded:fold_until]
+        ctx = get_script_run_ctx()
+
+        def run():
+            add_script_run_ctx(threading.current_thread(), ctx)
+            try:
+                return self._summarize(self.summary, to_fold), fold_until
+            finally:
+                add_script_run_ctx(threading.current_thread(), None)
+
+        self.pending = get_memory_pool().submit(contextvars.copy_context().run, run)
+        log_step(f"[memory] folding {len(to_fold)} message(s) in the background")
+
+    def _apply_pending(self):
+        if self.pending is None or not self.pending.done():
+            return
+        summary, fold_until = self.pending.result()
+        self.pending = None
+        self.summary, self.folded = summary, fold_until
+        log_step(f"[memory] folded up to message {fold_until}; summary ≈ {estimate_tokens(summary)} tokens")
+
+    def _summarize(self, summary: str, to_fold: List[str]) -> str:
+        system_prompt = (
+            "You maintain a running summary of a student's notes for EBCS, a thesis coach for TU Delft IDE "
+            "MSc graduation projects.\n"
+            "Merge the new notes into the existing summary. Keep every concrete fact that matters for "
+            "coaching: project domain and context, users/stakeholders, research question drafts, methods, "
+            "metrics, stage and deadlines, what the student already tried, open problems.\n"
+            "Drop greetings and repetition. Write compact plain-text bullet points in the student's language, "
+            f"at most about {self.summary_tokens} tokens. Output only the summary."
         )
+        user_prompt = json.dumps({"existing_summary": summary, "new_notes": to_fold}, ensure_ascii=False)
+        try:
+            text = call_llm(system_prompt, user_prompt, site="summary").strip()
+            if text:
+                return truncate_to_tokens(text, self.summary_tokens, keep="head")
+        except Exception as e:
+            log_step(f"[memory] summarization failed ({type(e).__name__}), keeping an extractive summary")
+        # 兜底：旧摘要 + 新消息原文，超出预算时丢掉最早的部分
+        return truncate_to_tokens("\n".join([summary, *to_fold]).strip(), self.summary_tokens, keep="tail")
+
+    def context(self, site: str) -> str:
+        max_tokens = CONTEXT_SITE_TOKENS.get(site, CONTEXT_SITE_TOKENS["plan"])
+        recent = self.messages[self.folded:]
+        if not self.summary and estimate_tokens("\n".join(recent)) <= max_tokens:
+            return "\n".join(recent)
+
+        # 从最新的消息往前放，最新一条放不下时截它的末尾
+        kept: List[str] = []
+        used = 0
+        for msg in reversed(recent):
+            cost = estimate_tokens(msg) + 1
+            if used + cost > max_tokens:
+                if not kept:
+                    kept.append(truncate_to_tokens(msg, max_tokens, keep="tail"))
+                    used = max_tokens
+                break
+            kept.append(msg)
+            used += cost
+        kept.reverse()
+
+        # 预算里放不下的较早原文这一轮直接省略（后台折叠完成后由摘要覆盖）
+        summary = truncate_to_tokens(self.summary, max_tokens - used - 20, keep="head") if self.summary else ""
+        if not summary:
+            return "\n".join(kept)
+        return f"Summary of earlier notes:\n{summary}\n\nRecent notes:\n" + "\n".join(kept)
 
 
 # -----------------------
 # Evidence-bound 回复：JSON 结构化输出
 # -----------------------
-def call_llm(system_prompt: str, user_prompt: str) -> str:
+class LLMResponseCache:
+    """
+    call_llm 的进程级响应缓存：key = (model, sha256(system_prompt), sha256(user_prompt))，
+    每条记录带过期时间（TTL 按 call site 配置），按条数 LRU 淘汰。
+    stats 按 call site 统计 hits / misses / expired / stores。
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self._entries: "OrderedDict[tuple, tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, user_prompt: str) -> tuple:
+        return (
+            model,
+            hashlib.sha256(system_prompt.encode("utf-8")).hexdigest(),
+            hashlib.sha256(user_prompt.encode("utf-8")).hexdigest(),
+        )
+
+    def _count(self, site: str, field: str):
+        site_stats = self.stats.setdefault(site, {"hits": 0, "misses": 0, "expired": 0, "stores": 0})
+        site_stats[field] += 1
+
+    def get(self, key: tuple, site: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._count(site, "misses")
+                return None
+            expires_at, text = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                self._count(site, "expired")
+                self._count(site, "misses")
+                return None
+            self._entries.move_to_end(key)
+            self._count(site, "hits")
+            return text
+
+    def put(self, key: tuple, text: str, ttl_s: float, site: str):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl_s, text)
+            self._entries.move_to_end(key)
+            self._count(site, "stores")
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def hit_rates(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                site: {**s, "hit_rate": round(s["hits"] / max(1, s["hits"] + s["misses"]), 3)}
+                for site, s in self.stats.items()
+            }
+
+
+@st.cache_resource
+def get_llm_cache() -> LLMResponseCache:
+    return LLMResponseCache(LLM_CACHE_ITEMS)
+
+
+def is_json_text(text: str) -> bool:
+    """给 call_llm(cache_if=...) 用：只缓存能解析的 JSON 输出，解析失败的下次重新请求。"""
+    try:
+        json.loads(text.strip())
+        return True
+    except Exception:
+        return False
+
+
+class LLMProfile:
+    """
+    一组 Responses API 调用参数。值为 None 的字段不发送（沿用 API 默认）：
+    - model:             默认 OPENAI_MODEL
+    - reasoning_effort:  minimal / low / medium / high（只对 reasoning 模型发送）
+    - verbosity:         low / medium / high（只对 gpt-5 系列发送）
+    - max_output_tokens: 输出上限（含 reasoning token）
+    - timeout_s:         单次请求超时；None 时用 LLM_SITE_TIMEOUTS
+    """
+
+    fields = ("model", "reasoning_effort", "verbosity", "max_output_tokens", "timeout_s")
+
+    def __init__(self, name: str, model: str | None = None, reasoning_effort: str | None = None,
+                 verbosity: str | None = None, max_output_tokens: int | None = None,
+                 timeout_s: float | None = None):
+        self.name = name
+        self.model = model or OPENAI_MODEL
+        self.reasoning_effort = reasoning_effort
+        self.verbosity = verbosity
+        self.max_output_tokens = max_output_tokens
+        self.timeout_s = timeout_s
+
+    def request_kwargs(self) -> Dict[str, Any]:
+        """给 responses.create / parse / stream 的额外参数。"""
+        kwargs: Dict[str, Any] = {"model": self.model}
+        if self.reasoning_effort and self.model.startswith(("gpt-5", "o1", "o3", "o4")):
+            kwargs["reasoning"] = {"effort": self.reasoning_effort}
+        if self.verbosity and self.model.startswith("gpt-5"):
+            kwargs["text"] = {"verbosity": self.verbosity}
+        if self.max_output_tokens:
+            kwargs["max_output_tokens"] = self.max_output_tokens
+        return kwargs
+
+    def cache_tag(self) -> str:
+        """响应缓存 key 里的 "model" 部分：参数不同的 profile 不共用缓存。"""
+        return "|".join(str(getattr(self, f)) for f in self.fields[:4])
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {f: getattr(self, f) for f in self.fields}
+
+
+def load_llm_profiles(config: str = LLM_PROFILES_CONFIG) -> Dict[str, LLMProfile]:
+    """LLM_PROFILE_DEFAULTS 叠加 EBCS_LLM_PROFILES（JSON 字符串或 JSON 文件路径）的字段覆盖。"""
+    specs = {name: dict(spec) for name, spec in LLM_PROFILE_DEFAULTS.items()}
+    if config:
+        try:
+            text = Path(config).read_text(encoding="utf-8") if Path(config).is_file() else config
+            for name, spec in json.loads(text).items():
+                specs.setdefault(name, {}).update(spec)
+        except Exception as e:
+            log_step(f"[llm] ignoring invalid EBCS_LLM_PROFILES: {e}")
+    profiles = {}
+    for name, spec in specs.items():
+        unknown = set(spec) - set(LLMProfile.fields)
+        if unknown:
+            log_step(f"[llm] profile {name!r}: ignoring unknown fields {sorted(unknown)}")
+        profiles[name] = LLMProfile(name, **{k: v for k, v in spec.items() if k in LLMProfile.fields})
+    return profiles
+
+
+LLM_PROFILES = load_llm_profiles()
+
+
+def get_llm_profile(site: str) -> LLMProfile:
+    return LLM_PROFILES.get(LLM_SITE_PROFILES.get(site, "default")) or LLM_PROFILES["default"]
+
+
+def log_incomplete(site: str, resp: Any):
+    """输出被 max_output_tokens 截断时记一笔：JSON 多半解析不了，调用方会走兜底。"""
+    if getattr(resp, "status", None) == "incomplete":
+        reason = getattr(getattr(resp, "incomplete_details", None), "reason", None)
+        log_step(f"[llm:{site}] response incomplete ({reason}); profile {get_llm_profile(site).name!r}")
+
+
+class LLMUnavailable(RuntimeError):
+    """熔断器打开时 resilient_call 直接抛出；调用方应走模板兜底，而不是再发一次 LLM 请求。"""
+
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+def is_retryable_error(e: Exception) -> bool:
+    """超时 / 连接错误 / 429 / 5xx 才重试并计入熔断；4xx（prompt、schema 问题）重试也没用。"""
+    if isinstance(e, openai.APIConnectionError):  # 包括 APITimeoutError
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in RETRYABLE_STATUS or e.status_code >= 500
+    return False
+
+
+def retry_after_s(e: Exception) -> float:
+    response = getattr(e, "response", None)
+    try:
+        return min(float(response.headers.get("retry-after", 0)), LLM_BACKOFF_MAX_S)
+    except (AttributeError, TypeError, ValueError):
+        return 0.0
+
+
+class CircuitBreaker:
+    """
+    provider 级熔断器：closed → 连续 failure_threshold 次可重试错误 → open（cooldown_s 内 allow() 为 False）
+    → half_open（只放一个探测请求）→ 成功回到 closed，失败重新 open。
+    探测请求被非 Exception 打断（Streamlit 的 RerunException / StopException、KeyboardInterrupt）时
+    调用 release_probe()：不判定 provider 好坏，保持 half_open，让下一个请求重新探测。
+    """
+
+    def __init__(self, failure_threshold: int, cooldown_s: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown_s = cooldown_s
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown_s:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def release_probe(self):
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    log_step(f"[llm] circuit breaker open for {self.cooldown_s:.0f}s after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+class LLMResilience:
+    """进程级：熔断器 + 每个 call site 最近的成功延迟（算 hedge 延迟）+ 重试/hedge/熔断计数。"""
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN_S)
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, deque] = {}
+        self.stats: Dict[str, Counter] = {}
+
+    def record(self, site: str, event: str):
+        with self._lock:
+            self.stats.setdefault(site, Counter())[event] += 1
+
+    def add_latency(self, site: str, seconds: float):
+        with self._lock:
+            self.latencies.setdefault(site, deque(maxlen=200)).append(seconds)
+
+    def latency_quantile(self, site: str, q: float, min_samples: int = 1) -> float | None:
+        with self._lock:
+            samples = list(self.latencies.get(site, ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        return float(np.quantile(samples, q))
+
+    def hedge_delay(self, site: str) -> float | None:
+        """该 site 最近成功延迟的 LLM_HEDGE_QUANTILE 分位；样本不够时返回 None（不 hedge）。"""
+        return self.latency_quantile(site, LLM_HEDGE_QUANTILE, min_samples=LLM_HEDGE_MIN_SAMPLES)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "breaker": self.breaker.state,
+                "sites": {site: dict(c) for site, c in self.stats.items()},
+            }
+
+
+@st.cache_resource
+def get_llm_resilience() -> LLMResilience:
+    return LLMResilience()
+
+
+@st.cache_resource
+def get_hedge_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="ebcs-hedge")
+
+
+def _hedged_call(fn: Callable[[], Any], delay_s: float, site: str) -> Any:
+    """先发一次；delay_s 内没回来就再发一份，返回先成功的那个（另一份在后台跑完后丢弃）。"""
+    res = get_llm_resilience()
+    ctx = get_script_run_ctx()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        try:
+            return fn()
+        finally:
+            add_script_run_ctx(threading.current_thread(), None)
+
+    pool = get_hedge_pool()
+    primary = pool.submit(contextvars.copy_context().run, run)
+    done, _ = wait([primary], timeout=delay_s)
+    if done:
+        return primary.result()
+
+    res.record(site, "hedged")
+    log_step(f"[llm:{site}] no response after {delay_s:.1f}s, sending a hedged request")
+    pending = {primary, pool.submit(contextvars.copy_context().run, run)}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None:
+                if f is not primary:
+                    res.record(site, "hedge_won")
+                return f.result()
+            error = f.exception()
+    raise error
+
+
+def resilient_call(
+        site: str,
+        fn: Callable[[float], Any],
+        timeout: float | None = None,
+        hedge: bool | None = None,
+) -> Any:
+    """
+    对一次 OpenAI 请求加容错：fn(attempt_timeout_s) 发出请求并返回结果。
+    - 熔断器打开时直接抛 LLMUnavailable
+    - 单次请求超时 = min(site 的超时, 到整体截止的剩余时间)；site 的超时取 profile 的 timeout_s，
+      没配就用 LLM_SITE_TIMEOUTS；整体截止 = timeout（默认 LLM_TIMEOUT_S）
+    - 可重试错误（is_retryable_error）按 full-jitter 指数退避重试最多 LLM_RETRIES 次，尊重 Retry-After，
+      剩余时间不够退避 + 1s 就不再重试
+    - hedge（默认 LLM_HEDGE 且 site 在 LLM_HEDGE_SITES 里）：超过该 site 的 p95 延迟还没回来就再发一份
+    """
+    res = get_llm_resilience()
+    if not res.breaker.allow():
+        res.record(site, "short_circuited")
+        raise LLMUnavailable(f"LLM circuit breaker is {res.breaker.state}")
+    if hedge is None:
+        hedge = LLM_HEDGE and site in LLM_HEDGE_SITES
+    deadline = time.monotonic() + (timeout if timeout is not None else LLM_TIMEOUT_S)
+    site_timeout = get_llm_profile(site).timeout_s or LLM_SITE_TIMEOUTS.get(site, LLM_TIMEOUT_S)
+
+    for attempt in itertools.count():
+        attempt_timeout = max(1.0, min(site_timeout, deadline - time.monotonic()))
+        call = partial(fn, attempt_timeout)
+        delay = res.hedge_delay(site) if hedge else None
+        t0 = time.perf_counter()
+        try:
+            if delay is not None and delay < attempt_timeout:
+                result = _hedged_call(call, delay, site)
+            else:
+                result = call()
+        except Exception as e:
+            if not is_retryable_error(e):
+                # provider 有响应（4xx / 解析错误）：不算 provider 故障，也结束 half_open 探测
+                res.breaker.record_success()
+                raise
+            res.breaker.record_failure()
+            res.record(site, "failures")
+            backoff = max(random.uniform(0, min(LLM_BACKOFF_MAX_S, LLM_BACKOFF_BASE_S * 2 ** attempt)),
+                          retry_after_s(e))
+            if attempt >= LLM_RETRIES or deadline - time.monotonic() < backoff + 1.0:
+                raise
+            if res.breaker.state == "open":
+                res.record(site, "short_circuited")
+                raise LLMUnavailable("LLM circuit breaker opened while retrying") from e
+            log_step(f"[llm:{site}] {type(e).__name__}, retry {attempt + 1}/{LLM_RETRIES} in {backoff:.2f}s")
+            res.record(site, "retries")
+            time.sleep(backoff)
+            continue
+        except BaseException:
+            # rerun / stop / Ctrl-C 打断了请求：不算成功也不算失败，但必须放掉 half_open 的探测名额，
+            # 否则 allow() 永远 False（熔断器是进程级的）
+            res.breaker.release_probe()
+            raise
+        res.breaker.record_success()
+        res.add_latency(site, time.perf_counter() - t0)
+        return result
+
+
+def call_llm(
+        system_prompt: str,
+        user_prompt: str,
+        timeout: float | None = None,
+        site: str = "default",
+        cacheable: bool = True,
+        cache_if: Callable[[str], bool] | None = None,
+) -> str:
     """
     统一封装 Responses API 调用：
     - system_prompt: 系统指令
     - user_prompt:   用户/上下文内容（可以很长）
+    - timeout:       本次调用（含重试）的整体超时（秒，通常来自 TurnBudget.timeout），默认 LLM_TIMEOUT_S；
+                     重试 / 熔断 / hedge 见 resilient_call，熔断时抛 LLMUnavailable
+    - site:          调用点名字（route / subqueries / rerank / ...），决定调用 profile（LLM_SITE_PROFILES）、
+                     缓存 TTL，并用于统计命中率
+    - cacheable:     False 时既不读也不写缓存（非确定性 prompt 用）
+    - cache_if:      只有 cache_if(text) 为真才写缓存，例如 is_json_text
     返回：模型文本输出（已经拼接好）
     """
-    resp = client.responses.create(
-        model=OPENAI_MODEL,
+    profile = get_llm_profile(site)
+    ttl_s = LLM_CACHE_TTLS.get(site, 0) if cacheable else 0
+    if ttl_s > 0:
+        cache = get_llm_cache()
+        key = cache.make_key(profile.cache_tag(), system_prompt, user_prompt)
+        cached = cache.get(key, site)
+        if cached is not None:
+            log_step(f"[llm:{site}] served from cache")
+            meter = CURRENT_USAGE.get()
+            if meter is not None:
+                meter.record_cache_hit(site, profile.model)
+            return cached
+
+    text = resilient_call(site, partial(_call_llm_uncached, system_prompt, user_prompt, site=site), timeout)
+    if ttl_s > 0 and text and (cache_if is None or cache_if(text)):
+        cache.put(key, text, ttl_s, site)
+    return text
+
+
+def _call_llm_uncached(system_prompt: str, user_prompt: str, timeout: float, site: str = "default") -> str:
+    # 重试由 resilient_call 负责，SDK 自己不再重试
+    llm = client.with_options(timeout=timeout, max_retries=0)
+    profile = get_llm_profile(site)
+    t0 = time.perf_counter()
+    resp = llm.responses.create(
+        **profile.request_kwargs(),
         input=[
             {
                 "role": "system",
@@ -2021,6 +4568,8 @@ def call_llm(system_prompt: str, user_prompt: str) -> str:
             },
         ],
     )
+    record_usage(site, profile.model, getattr(resp, "usage", None), time.perf_counter() - t0)
+    log_incomplete(site, resp)
 
     # 新 SDK 通常有 output_text，稳一点就两种都支持
     if hasattr(resp, "output_text"):
@@ -2050,6 +4599,162 @@ class CoachPlan(BaseModel):
     follow_up: Optional[str] = None
 
 
+class StreamingPlanParser:
+    """
+    CoachPlan 结构化输出的增量解析器：把流式收到的 JSON 文本片段 feed 进来，
+    顶层字段（overview / follow_up）以及 recommendations 数组里的每个元素一旦完整就作为事件返回：
+        ("overview", "..."), ("recommendations", {...}), ("follow_up", "...")
+    只扫描顶层对象和 array_fields 这一层数组，元素本身交给 json.JSONDecoder.raw_decode；
+    不完整的值 raw_decode 会失败，等下一个片段再试。
+    """
+
+    _skip = re.compile(r"[\s,]*")
+    _colon = re.compile(r"\s*:")
+
+    def __init__(self, array_fields: tuple = ("recommendations",)):
+        self.array_fields = array_fields
+        self.buf = ""
+        self.pos = 0
+        self.state = "start"
+        self.key: str | None = None
+        self._decoder = json.JSONDecoder()
+
+    def _decode(self):
+        try:
+            return self._decoder.raw_decode(self.buf, self.pos)
+        except json.JSONDecodeError:
+            return None
+
+    def feed(self, delta: str) -> List[tuple[str, Any]]:
+        self.buf += delta
+        events: List[tuple[str, Any]] = []
+        while self.state != "done":
+            self.pos = self._skip.match(self.buf, self.pos).end()
+            if self.pos >= len(self.buf):
+                break
+            ch = self.buf[self.pos]
+            if self.state == "start":
+                if ch != "{":
+                    raise ValueError(f"expected a JSON object, got {ch!r}")
+                self.pos += 1
+                self.state = "key"
+            elif self.state == "key":
+                if ch == "}":
+                    self.pos += 1
+                    self.state = "done"
+                    break
+                decoded = self._decode()
+                colon = self._colon.match(self.buf, decoded[1]) if decoded else None
+                if colon is None:
+                    break
+                self.key, self.pos, self.state = decoded[0], colon.end(), "value"
+            elif self.state == "value":
+                if ch == "[" and self.key in self.array_fields:
+                    self.pos += 1
+                    self.state = "array"
+                    continue
+                decoded = self._decode()
+                # 数字在缓冲区末尾时可能还没收完（"12" 之后还会来 "3"），等下一个片段
+                if decoded is None or (decoded[1] == len(self.buf) and isinstance(decoded[0], (int, float))):
+                    break
+                events.append((self.key, decoded[0]))
+                self.pos, self.state = decoded[1], "key"
+            else:  # array
+                if ch == "]":
+                    self.pos += 1
+                    self.state = "key"
+                    continue
+                decoded = self._decode()
+                if decoded is None:
+                    break
+                events.append((self.key, decoded[0]))
+                self.pos = decoded[1]
+        return events
+
+
+class IntakeSubquery(BaseModel):
+    id: str
+    text: str
+    type: Literal["policy", "precedent", "mixed"]
+    weight: float
+
+
+class IntakeDecision(BaseModel):
+    """run_intake 的结构化输出：route_and_maybe_ask 的路由字段 + generate_subqueries 的子查询。"""
+    stage: Literal[tuple(STAGES)]
+    mode: Literal[tuple(MODES)]
+    gap: Literal[tuple(GAPS)]
+    enough_info: bool
+    missing: List[str]
+    reason: str
+    followup_question: str
+    subqueries: List[IntakeSubquery]
+
+
+def run_intake(
+        conversation_text: str,
+        max_queries: int = 6,
+        budget: TurnBudget | None = None,
+) -> tuple[Dict[str, Any], List[Dict[str, Any]]] | None:
+    """
+    合并的 intake：一次 responses.parse（IntakeDecision）同时给出路由和检索子查询，
+    省掉 route_and_maybe_ask → generate_subqueries 的第二个 round-trip。
+    返回 (routing, subqueries)，字段与那两个函数的返回值一致；enough_info=False 时 subqueries 为空。
+    请求失败返回 None，调用方回退到分开的两次调用。
+    """
+    system_prompt = router_instructions() + (
+        f"5) If there IS enough information, also plan 3–{max_queries} short English sub-queries "
+        "for retrieval over two repositories, tailored to the stage/mode/gap you inferred:\n"
+        "- 'policy': official IDE rubrics, graduation handbook pages, stage checklists, templates.\n"
+        "- 'thesis': segments from past IDE MSc theses (methods, metrics, RQs, pitfalls, examples).\n"
+        + subquery_guidance() +
+        "Sub-query constraints: 'text' ≤ 25 words; 'weight' is a float in [0.3,1.0] "
+        "(higher = more important); ids Q1, Q2, ...\n"
+        "If there is NOT enough information, return an empty 'subqueries' list and fill "
+        "'followup_question' (in Chinese); otherwise 'followup_question' may be empty.\n"
+        "Fill the IntakeDecision schema provided by the caller."
+    )
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": conversation_text},
+    ]
+
+    def parse_intake(attempt_timeout: float) -> IntakeDecision:
+        profile = get_llm_profile("intake")
+        t0 = time.perf_counter()
+        response = client.with_options(timeout=attempt_timeout, max_retries=0).responses.parse(
+            **profile.request_kwargs(),
+            input=messages,
+            text_format=IntakeDecision,
+        )
+        record_usage("intake", profile.model, response.usage, time.perf_counter() - t0)
+        log_incomplete("intake", response)
+        return response.output_parsed
+
+    t0 = time.perf_counter()
+    try:
+        # 一次调用做了路由和子查询两步的事，截止时间用子查询阶段的
+        decision = resilient_call("intake", parse_intake, budget.timeout("subqueries") if budget else None)
+    except Exception as e:
+        log_step(f"[intake] fused intake failed ({type(e).__name__}: {e}), falling back to split routing")
+        return None
+    if decision is None:
+        return None
+
+    routing = decision.model_dump(exclude={"subqueries"})
+    routing["followup_question"] = routing["followup_question"].strip()
+    subqueries = []
+    if decision.enough_info:
+        subqueries = clean_subqueries(
+            [q.model_dump() for q in decision.subqueries], conversation_text, max_queries
+        )
+    log_step(
+        f"[intake] fused routing + {len(subqueries)} subqueries in {time.perf_counter() - t0:.2f}s "
+        f"(stage={decision.stage}, mode={decision.mode}, gap={decision.gap}, enough_info={decision.enough_info})"
+    )
+    return routing, subqueries
+
+
 def generate_coach_plan(
         user_input: str,
         stage: str,
@@ -2058,12 +4763,25 @@ def generate_coach_plan(
         task_context: str,
         evidence_cards: List[EvidenceCard],
         history: List[Dict[str, str]],
+        budget: TurnBudget | None = None,
+        on_partial: Callable[[Dict[str, Any]], None] | None = None,
 ) -> CoachPlan:
     """
     使用 responses.parse + Pydantic，直接拿到结构化的 CoachPlan 对象。
+    给了 on_partial 时改用 responses.stream：overview 和每条 Recommendation 一完整就
+    以 plan dict（目前已完成的部分）回调 on_partial，方便界面先画出来；最终仍返回完整解析的 CoachPlan。
     """
+    # evidence 总量按 PLAN_EVIDENCE_TOKENS 打包，plan prompt 的长度不随 thesis 摘要的长短变化
+    headers = [f"[{e.id}] {e.title}" for e in evidence_cards]
+    snippets = pack_evidence(
+        headers=headers,
+        snippets=[e.snippet or "" for e in evidence_cards],
+        scores=[float(e.meta.get("score") or 0.0) for e in evidence_cards],
+        budget_tokens=PLAN_EVIDENCE_TOKENS,
+        label="plan evidence",
+    )
     evid_text = "\n".join(
-        f"[{e.id}] {e.title}\n{e.snippet}" for e in evidence_cards
+        f"{header}\n{snippet}" for header, snippet in zip(headers, snippets)
     ) or "(no evidence found)"
 
     hist = "\n".join(f"{m['role']}: {m.get('content', '')}" for m in history[-6:])
@@ -2124,13 +4842,120 @@ def generate_coach_plan(
         "content": user_ctx,
     }
 
-    response = client.responses.parse(
-        model=OPENAI_MODEL,
-        input=[system_msg, user_msg],
-        text_format=CoachPlan,
+    # plan 是必需输出：预算用完也至少给 20 秒；重试 / 熔断见 resilient_call（plan 不做 hedge，太贵）
+    timeout = budget.timeout("plan", floor_s=20.0) if budget is not None else None
+
+    def parse_plan(attempt_timeout: float) -> CoachPlan:
+        llm = client.with_options(timeout=attempt_timeout, max_retries=0)
+        if on_partial is not None:
+            return stream_coach_plan(llm, [system_msg, user_msg], on_partial)
+
+        profile = get_llm_profile("plan")
+        t0 = time.perf_counter()
+        response = llm.responses.parse(
+            **profile.request_kwargs(),
+            input=[system_msg, user_msg],
+            text_format=CoachPlan,
+        )
+        record_usage("plan", profile.model, response.usage, time.perf_counter() - t0)
+        log_incomplete("plan", response)
+        if response.output_parsed is None:
+            raise ValueError("no parsed CoachPlan in the response")
+        log_step(f"Step 3 done: coach plan in {time.perf_counter() - t0:.2f}s (non-streaming)")
+        return response.output_parsed
+
+    try:
+        return resilient_call("plan", parse_plan, timeout, hedge=False)
+    except (LLMUnavailable, openai.APIError, ValueError) as e:
+        # ValueError：输出被截断 / 不符合 CoachPlan（pydantic ValidationError 也是 ValueError）
+        log_step(f"Step 3: plan generation unavailable ({type(e).__name__}), using the template plan")
+        if budget is not None:
+            budget.degrade("template_plan")
+        return fallback_coach_plan(stage, evidence_cards)
+
+
+def fallback_coach_plan(stage: str, evidence_cards: List[EvidenceCard], max_items: int = 4) -> CoachPlan:
+    """provider 不可用时的模板 plan：不调 LLM，直接把排在前面的 evidence 变成"先读这条"的建议。"""
+    recommendations = [
+        Recommendation(
+            title=f"Review: {e.title}",
+            evidence_ids=[e.id],
+            reason=(e.snippet or "").strip()[:400] or "Retrieved as one of the most relevant items for your stage.",
+            action=(
+                "Read this item in the Evidence Vault and write down, in 2–3 bullet points, "
+                "what it asks of your project and where your current draft already covers it."
+            ),
+        )
+        for e in evidence_cards[:max_items]
+    ]
+    return CoachPlan(
+        overview=(
+            "The coach model is temporarily unavailable, so this turn only lists the rubric items and "
+            f"precedents that match your {stage} stage best. Please check them against your draft and ask "
+            "again in a minute for tailored recommendations."
+        ),
+        recommendations=recommendations,
+        follow_up=None,
     )
 
+
+def stream_coach_plan(
+        llm: OpenAI,
+        messages: List[Dict[str, Any]],
+        on_partial: Callable[[Dict[str, Any]], None],
+) -> CoachPlan:
+    """
+    responses.stream 版本的 CoachPlan 生成：边收 output_text 增量边用 StreamingPlanParser 解析。
+    time-to-first-recommendation（TTFR）和总生成时间分开记日志。
+    """
+    t0 = time.perf_counter()
+    t_first_rec = None
+    parser = StreamingPlanParser()
+    partial_plan: Dict[str, Any] = {"overview": "", "recommendations": [], "follow_up": None}
+
+    profile = get_llm_profile("plan")
+    with llm.responses.stream(
+        **profile.request_kwargs(),
+        input=messages,
+        text_format=CoachPlan,
+    ) as stream:
+        for event in stream:
+            if event.type != "response.output_text.delta":
+                continue
+            try:
+                updates = parser.feed(event.delta)
+            except ValueError as e:
+                # 输出不是预期的 JSON 对象：不再增量渲染，等最终解析结果
+                log_step(f"[plan stream] incremental parsing stopped: {e}")
+                updates = []
+                parser.state = "done"
+            for key, value in updates:
+                if key == "recommendations":
+                    try:
+                        value = Recommendation.model_validate(value).model_dump()
+                    except Exception:
+                        continue
+                    partial_plan["recommendations"].append(value)
+                    if t_first_rec is None:
+                        t_first_rec = time.perf_counter() - t0
+                        log_step(f"[plan stream] first recommendation after {t_first_rec:.2f}s")
+                elif key in partial_plan:
+                    partial_plan[key] = value
+                else:
+                    continue
+                on_partial(dict(partial_plan, recommendations=list(partial_plan["recommendations"])))
+        response = stream.get_final_response()
+
+    record_usage("plan", profile.model, response.usage, time.perf_counter() - t0)
+    log_incomplete("plan", response)
     plan: CoachPlan = response.output_parsed
+    if plan is None:
+        raise ValueError("no parsed CoachPlan in the streamed response")
+    ttfr = f"{t_first_rec:.2f}s" if t_first_rec is not None else "n/a"
+    log_step(
+        f"Step 3 done: coach plan streamed in {time.perf_counter() - t0:.2f}s "
+        f"(TTFR {ttfr}, {len(plan.recommendations)} recommendations)"
+    )
     return plan
 
 
@@ -2141,8 +4966,28 @@ def generate_coach_plan(
 # ========= 状态初始化 =========
 @st.cache_resource
 def load_repositories():
+    if VECTOR_BACKEND == "local":
+        policy_repo = PolicyRepository(
+            None, POLICY_COLLECTION,
+            local_index=get_local_index(POLICY_COLLECTION, tuple(PolicyRepository.markdown_fields)),
+        )
+        thesis_repo = ThesisRepository(
+            None, THESES_COLLECTION,
+            local_index=get_local_index(THESES_COLLECTION, tuple(ThesisRepository.markdown_fields)),
+        )
+        return policy_repo, thesis_repo
+
     client_q = get_qdrant_client()
-    return PolicyRepository(client_q, POLICY_COLLECTION), ThesisRepository(client_q, THESES_COLLECTION)
+    policy_repo = PolicyRepository(
+        client_q, POLICY_COLLECTION, retrieval_mode=POLICY_RETRIEVAL_MODE, scoring=SCORING_MODE
+    )
+    thesis_repo = ThesisRepository(
+        client_q, THESES_COLLECTION, retrieval_mode=THESES_RETRIEVAL_MODE, scoring=SCORING_MODE
+    )
+    if SCORING_MODE == "server":
+        policy_repo.ensure_payload_indexes()
+        thesis_repo.ensure_payload_indexes()
+    return policy_repo, thesis_repo
 
 
 def init_state():
@@ -2726,12 +5571,23 @@ label[data-testid="stWidgetLabel"] p {
                 user_id = st.session_state.get("user_id")
                 # ✅ 记录这条触发 plan 的问题时间
                 st.session_state["last_question_ts"] = datetime.utcnow().isoformat()
+                # 本轮的延迟预算：路由 / 追问 / 检索 / plan 共用
+                budget = TurnBudget()
+                speculation = None
+                intake_subqueries = None
+                # 本轮 OpenAI 调用的用量计量；追问轮不单独写库，累计到最终生成 plan 的那一轮
+                usage_meter = st.session_state.setdefault("usage_meter", UsageMeter())
+                CURRENT_USAGE.set(usage_meter)
 
                 # 记录用户消息
                 st.session_state.messages.append({"role": "user", "content": user_text})
                 # 汇总上下文
                 user_msgs = [m["content"] for m in st.session_state.messages if m["role"] == "user"]
-                task_context = "\n".join(user_msgs)
+                # 有界上下文：旧消息折叠进滚动摘要，各用途按自己的 token 上限取（见 RollingMemory）
+                memory = st.session_state.setdefault("memory", RollingMemory())
+                memory.update(user_msgs)
+                task_context = memory.context("route")
+                retrieval_context = memory.context("retrieval")
                 st.session_state.task_context = task_context
 
                 # 路由 & 追问逻辑（Stage×Mode×Gap + AI 生成 follow-up）
@@ -2744,7 +5600,20 @@ label[data-testid="stWidgetLabel"] p {
                             state="running",
                         )
                         follow_status.write("Embedding your notes and routing to the right stage/mode…")
-                        routing = route_and_maybe_ask(task_context)
+                        if SPECULATIVE_RETRIEVAL and not FUSED_INTAKE:
+                            # 路由期间先按上一轮的 stage/mode/gap 把子查询 + 检索跑起来；
+                            # 合并 intake 自己给子查询，再推测一遍就是重复调用
+                            speculation = SpeculativeRetrieval(
+                                retrieval_context, dict(align), policy_repo, thesis_repo, budget=budget
+                            )
+                        routing = route_locally(task_context) if LOCAL_ROUTER else None
+                        intake = None
+                        if routing is None and FUSED_INTAKE:
+                            intake = run_intake(task_context, budget=budget)
+                        if intake is not None:
+                            routing, intake_subqueries = intake
+                        elif routing is None:
+                            routing = route_and_maybe_ask(task_context, budget=budget)
 
                         st.session_state.alignment.update(
                             {
@@ -2772,6 +5641,7 @@ label[data-testid="stWidgetLabel"] p {
                                     task_context=task_context,
                                     alignment=st.session_state.alignment,
                                     followup_count=count,
+                                    budget=budget,
                                 )
                                 st.session_state.messages.append(
                                     {"role": "assistant", "content": warn_text}
@@ -2788,6 +5658,7 @@ label[data-testid="stWidgetLabel"] p {
                                     task_context=task_context,
                                     routing=routing,
                                     followup_count=count,
+                                    budget=budget,
                                 )
                                 st.session_state.messages.append(
                                     {"role": "assistant", "content": follow_q}
@@ -2796,6 +5667,8 @@ label[data-testid="stWidgetLabel"] p {
                                     label="Done — I have a clarifying question for you ✅",
                                     state="complete",
                                 )
+                                if speculation is not None:
+                                    speculation.discard()
                                 # 结束 loading，允许用户继续输入
                                 st.session_state.busy = False
                                 st.rerun()
@@ -2809,23 +5682,31 @@ label[data-testid="stWidgetLabel"] p {
                             )
 
                 # enough_info=True → 检索 + 生成 plan
+                # 流式生成时，已完成的 recommendations 先画在这个占位里；st.rerun() 后由历史消息正常渲染
+                plan_slot = st.empty()
                 with st.status("Generating coach recommendations…", expanded=True) as status:
                     # Step 1: embed + 对齐
                     status.update(label="Step 1/4: Embedding the conversation and aligning Stage × Mode × Gap…",
                                   state="running")
-                    q_emb = embed_text(task_context)
+                    q_emb = embed_text(retrieval_context)
                     align = st.session_state.alignment
 
                     # Step 2: RAG retrieval
                     status.update(label="Step 2/4: Retrieving evidence from rubrics and past theses…", state="running")
+                    prepared = None
+                    if speculation is not None:
+                        prepared = speculation.resolve(align["stage"], align["mode"], align["gap"], budget=budget)
                     cards = fuse_evidence(
-                        query_text=task_context,
+                        query_text=retrieval_context,
                         query_emb=q_emb,
                         stage=align["stage"],
                         mode=align["mode"],
                         gap=align["gap"],
                         policy_repo=policy_repo,
                         thesis_repo=thesis_repo,
+                        budget=budget,
+                        prepared=prepared,
+                        subqueries=intake_subqueries,
                     )
                     st.session_state.evidence_cards = cards
 
@@ -2835,14 +5716,29 @@ label[data-testid="stWidgetLabel"] p {
 
                     # Step 3: Generate structured action plan
                     status.update(label="Step 3/4: Generating a structured action plan from evidence…", state="running")
+                    on_partial = None
+                    if STREAM_PLAN:
+                        stream_evidence_index = {c.id: c for c in cards}
+                        partial_renders = itertools.count()
+
+                        def on_partial(partial_plan: Dict[str, Any]):
+                            # 每次重画都换一个 key_prefix，避免和上一次渲染的按钮 key 冲突
+                            n = next(partial_renders)
+                            with plan_slot.container():
+                                with st.chat_message("assistant"):
+                                    render_plan_as_cards(partial_plan, stream_evidence_index,
+                                                         key_prefix=f"stream{round_idx}_{n}_")
+
                     plan_obj = generate_coach_plan(
                         user_input=user_text,
                         stage=align["stage"],
                         mode=align["mode"],
                         gap=align["gap"],
-                        task_context=task_context,
+                        task_context=memory.context("plan"),
                         evidence_cards=cards,
                         history=st.session_state.messages,
+                        budget=budget,
+                        on_partial=on_partial,
                     )
 
                     # Save the assistant message containing the plan
@@ -2865,6 +5761,10 @@ label[data-testid="stWidgetLabel"] p {
                         evidence_cards=cards,
                         alignment=align,
                     )
+                    log_turn_degradations(st.session_state.get("user_id"), round_idx, ts_a, budget.degradations)
+                    log_turn_usage(st.session_state.get("user_id"), round_idx, ts_a, usage_meter)
+                    st.session_state.last_turn_usage = usage_meter.rows()
+                    st.session_state.usage_meter = UsageMeter()
 
                     status.update(label="Step 4/4: Done — coach recommendations generated ✅", state="complete")
 
@@ -2974,7 +5874,7 @@ label[data-testid="stWidgetLabel"] p {
                             st.markdown(html, unsafe_allow_html=True)
                             # ==== 新增：原始文件 section ====
                             source_path = sel.meta.get("source_path")
-                            source_chunk_md = sel.meta.get("source_chunk_md")
+                            source_chunk_md = ensure_evidence_markdown(sel, policy_repo, thesis_repo)
                             # st.write("DEBUG meta for", sel.id, ":", sel.meta)
                             if source_chunk_md or source_path:
                                 # full_md = load_markdown_file(source_path)
@@ -3030,6 +5930,18 @@ label[data-testid="stWidgetLabel"] p {
     # # ---------- Debug：内部 Stage×Mode×Gap 状态 ----------
     with st.expander("Debug：内部 Stage × Mode × Gap 状态（开发用）"):
         st.json(st.session_state.alignment)
+        st.json({
+            "embedding_cache": get_embedding_cache().stats,
+            "payload_intern": get_payload_intern_cache().stats,
+            "fixed_md_cache": get_fixed_md_cache().stats,
+            "llm_cache": get_llm_cache().hit_rates(),
+            "speculation": get_speculation_stats().stats,
+            "llm_resilience": get_llm_resilience().snapshot(),
+            "local_router": get_router_stats().stats,
+        })
+        if st.session_state.get("last_turn_usage"):
+            st.caption("上一轮 OpenAI 用量（按 call site）")
+            st.dataframe(st.session_state.last_turn_usage)
 
 
 if __name__ == "__main__":
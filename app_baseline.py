@@ -1,6 +1,12 @@
 # baseline_chat.py
 import os
 import json
+import time
+import base64
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
 from pathlib import Path
 from typing import List, Dict, Any
 
@@ -23,6 +29,10 @@ load_dotenv()
 # 模型配置
 OPENAI_MODEL = os.getenv("EBCS_MODEL", "gpt-5-mini")
 EMBED_MODEL = os.getenv("EBCS_EMBED_MODEL", "text-embedding-3-large")
+# Embedding 缓存（与 app.py 相同的配置项，可共用同一个 SQLite 文件）
+EMBED_CACHE_PATH = os.getenv("EBCS_EMBED_CACHE_PATH", ".cache/ebcs_embeddings.sqlite3")
+EMBED_CACHE_MEM_ITEMS = int(os.getenv("EBCS_EMBED_CACHE_MEM_ITEMS", "2048"))
+EMBED_CACHE_DISK_ITEMS = int(os.getenv("EBCS_EMBED_CACHE_DISK_ITEMS", "50000"))
 client = OpenAI()
 # # Baseline VS 路径
 # VS_DIR = Path("baseline_from_indexes_vs")
@@ -950,12 +960,163 @@ def post_survey_dialog():
 #     return load_vector_store()
 
 
+class EmbeddingCache:
+    """
+    两级 embedding 缓存，key = sha256(EMBED_MODEL + 归一化后的文本)：
+    - 进程内 LRU（OrderedDict），按条数上限淘汰；
+    - SQLite 磁盘层（float32 bytes），容器重启后依然有效，按 last_used 淘汰最久未用的。
+    hits / misses 计数在 self.stats 里。
+    """
+
+    def __init__(self, model: str, path: str | None, mem_items: int, disk_items: int):
+        self.model = model
+        self.mem_items = mem_items
+        self.disk_items = disk_items
+        self.stats = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "disk_evictions": 0}
+        self._mem: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            try:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    " key TEXT PRIMARY KEY, vec BLOB NOT NULL, last_used REAL NOT NULL)"
+                )
+                self._db.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)"
+                )
+                self._db.commit()
+            except Exception as e:
+                print("Embedding disk cache disabled:", e)
+                self._db = None
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    def key(self, text: str) -> str:
+        raw = f"{self.model}\x00{self.normalize(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, vec: np.ndarray):
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_items:
+            self._mem.popitem(last=False)
+
+    def get_many(self, texts: List[str]) -> List[np.ndarray | None]:
+        keys = [self.key(t) for t in texts]
+        out: List[np.ndarray | None] = [None] * len(texts)
+        with self._lock:
+            missing = []
+            for i, k in enumerate(keys):
+                vec = self._mem.get(k)
+                if vec is not None:
+                    self._mem.move_to_end(k)
+                    out[i] = vec
+                    self.stats["mem_hits"] += 1
+                else:
+                    missing.append(i)
+
+            if missing and self._db is not None:
+                try:
+                    wanted = list({keys[i] for i in missing})
+                    found = {}
+                    for start in range(0, len(wanted), 500):
+                        chunk = wanted[start:start + 500]
+                        rows = self._db.execute(
+                            f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                            chunk,
+                        ).fetchall()
+                        found.update({k: np.frombuffer(blob, dtype=np.float32) for k, blob in rows})
+                    if found:
+                        now = time.time()
+                        self._db.executemany(
+                            "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                            [(now, k) for k in found],
+                        )
+                        self._db.commit()
+                    still_missing = []
+                    for i in missing:
+                        vec = found.get(keys[i])
+                        if vec is None:
+                            still_missing.append(i)
+                            continue
+                        out[i] = vec
+                        self._remember(keys[i], vec)
+                        self.stats["disk_hits"] += 1
+                    missing = still_missing
+                except Exception as e:
+                    print("Embedding disk cache read failed:", e)
+
+            self.stats["misses"] += len(missing)
+        return out
+
+    def put_many(self, texts: List[str], vecs: List[np.ndarray]):
+        if not texts:
+            return
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, vec in zip(texts, vecs):
+                vec = np.asarray(vec, dtype=np.float32)
+                if vec.flags.writeable:
+                    # 缓存里的向量会被多处共享，统一只读
+                    vec = vec.copy()
+                    vec.setflags(write=False)
+                k = self.key(text)
+                self._remember(k, vec)
+                rows.append((k, vec.tobytes(), now))
+
+            if self._db is None:
+                return
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vec, last_used) VALUES (?, ?, ?)",
+                    rows,
+                )
+                (n_rows,) = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+                overflow = n_rows - self.disk_items
+                if overflow > 0:
+                    self._db.execute(
+                        "DELETE FROM embeddings WHERE key IN ("
+                        " SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                        (overflow,),
+                    )
+                    self.stats["disk_evictions"] += overflow
+                self._db.commit()
+            except Exception as e:
+                print("Embedding disk cache write failed:", e)
+
+
+@st.cache_resource
+def get_embedding_cache() -> EmbeddingCache:
+    return EmbeddingCache(
+        model=EMBED_MODEL,
+        path=EMBED_CACHE_PATH,
+        mem_items=EMBED_CACHE_MEM_ITEMS,
+        disk_items=EMBED_CACHE_DISK_ITEMS,
+    )
+
+
 def embed_text(text: str) -> np.ndarray:
+    cache = get_embedding_cache()
+    cached = cache.get_many([text])[0]
+    if cached is not None:
+        return cached
+
+    # base64 → np.frombuffer，直接得到 float32 向量，不再经过 list[float]
     resp = client.embeddings.create(
         model=EMBED_MODEL,
         input=[text],
+        encoding_format="base64",
     )
-    return np.array(resp.data[0].embedding, dtype="float32")
+    vec = np.frombuffer(base64.b64decode(resp.data[0].embedding), dtype=np.float32)
+    cache.put_many([text], [vec])
+    return vec
 
 def cosine_sim_matrix(matrix: np.ndarray, query_vec: np.ndarray) -> np.ndarray:
     denom = (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vec) + 1e-9)
@@ -971,7 +1132,7 @@ def retrieve_top_k(
     # ✅ 注意这里：拿 .points
     resp = client_q.query_points(
         collection_name="baseline_vs",
-        query=q_vec.tolist(),   # 确保是 list[float]
+        query=q_vec,   # float32 ndarray，qdrant-client 发请求时再序列化
         limit=top_k,
         with_payload=True,
     )
@@ -0,0 +1,1030 @@
+"""
+EBCS 性能基准 / 维护工具（开发用，不打进 Docker 镜像）。
+
+    python bench.py build-two-stage --source policy_docs --target policy_docs_2stage
+    python bench.py retrieval --collection policy_docs_2stage --limit 60
+    python bench.py scoring-equivalence
+    python bench.py scoring-equivalence --fixture 300
+    python bench.py memory --turns 20
+    python bench.py export-local --collection policy_docs
+    python bench.py local-equivalence
+    python bench.py rerank --questions questions.txt
+    python bench.py intake --questions questions.txt
+    python bench.py fit-router --labelled routed_turns.jsonl
+    python bench.py router --questions questions.txt
+    python bench.py context-memory
+    python bench.py breaker-probe
+    python bench.py profiles --questions questions.txt --profiles classify,write,plan
+
+连接参数默认读 QDRANT_URL / QDRANT_API_KEY（和 app.py 一样），
+也可以用 --url 指向本地 Qdrant（例如 http://localhost:6333）。
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List
+
+import numpy as np
+from qdrant_client import QdrantClient, models
+from streamlit.runtime.scriptrunner import StopException
+
+import app
+
+
+def get_client(args) -> QdrantClient:
+    url = args.url or app.QDRANT_URL or "http://localhost:6333"
+    if url == ":memory:":
+        return QdrantClient(location=":memory:")
+    return QdrantClient(url=url, api_key=args.api_key or app.QDRANT_API_KEY)
+
+
+def summarize_ms(samples: List[float]) -> str:
+    arr = np.asarray(samples) * 1000
+    return (
+        f"mean {arr.mean():7.1f} ms | p50 {np.percentile(arr, 50):7.1f} ms | "
+        f"p95 {np.percentile(arr, 95):7.1f} ms"
+    )
+
+
+# -----------------------
+# 两阶段检索：建 collection + recall / latency 对比
+# -----------------------
+
+def create_two_stage_collection(client: QdrantClient, name: str, dim: int):
+    if client.collection_exists(name):
+        client.delete_collection(name)
+    client.create_collection(
+        collection_name=name,
+        vectors_config={
+            app.FULL_VECTOR_NAME: models.VectorParams(size=dim, distance=models.Distance.COSINE),
+            app.COARSE_VECTOR_NAME: models.VectorParams(
+                size=app.COARSE_VECTOR_DIM, distance=models.Distance.COSINE
+            ),
+        },
+    )
+
+
+def two_stage_point(point_id, full_vec: np.ndarray, payload: Dict) -> models.PointStruct:
+    return models.PointStruct(
+        id=point_id,
+        vector={
+            app.FULL_VECTOR_NAME: full_vec.tolist(),
+            app.COARSE_VECTOR_NAME: app.truncate_embedding(full_vec, app.COARSE_VECTOR_DIM).tolist(),
+        },
+        payload=payload,
+    )
+
+
+def cmd_build_two_stage(args):
+    """把现有 collection（默认向量）复制成带 full + coarse 两个 named vector 的新 collection。"""
+    client = get_client(args)
+    offset = None
+    created = False
+    n = 0
+    while True:
+        points, offset = client.scroll(
+            collection_name=args.source,
+            limit=args.batch,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        if not points:
+            break
+        batch = []
+        for p in points:
+            vec = p.vector[app.FULL_VECTOR_NAME] if isinstance(p.vector, dict) else p.vector
+            vec = np.asarray(vec, dtype=np.float32)
+            if not created:
+                create_two_stage_collection(client, args.target, vec.shape[0])
+                created = True
+            batch.append(two_stage_point(p.id, vec, p.payload or {}))
+        client.upsert(collection_name=args.target, points=batch)
+        n += len(batch)
+        print(f"copied {n} points")
+        if offset is None:
+            break
+    print(f"done: {args.source} -> {args.target} ({n} points, coarse dim {app.COARSE_VECTOR_DIM})")
+
+
+def build_synthetic_collection(client: QdrantClient, name: str, n: int, dim: int, seed: int) -> np.ndarray:
+    """随机语料：方差随维度衰减，大致模拟 Matryoshka embedding 前缀维度信息更多的特性。"""
+    rng = np.random.default_rng(seed)
+    decay = 1.0 / np.sqrt(1.0 + np.arange(dim) / 64.0)
+    corpus = (rng.standard_normal((n, dim)) * decay).astype(np.float32)
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    create_two_stage_collection(client, name, dim)
+    for start in range(0, n, 256):
+        client.upsert(
+            collection_name=name,
+            points=[two_stage_point(start + i, v, {}) for i, v in enumerate(corpus[start:start + 256])],
+        )
+    return corpus
+
+
+def point_vector(point) -> np.ndarray:
+    vec = point.vector[app.FULL_VECTOR_NAME] if isinstance(point.vector, dict) else point.vector
+    return np.asarray(vec, dtype=np.float32)
+
+
+def sample_queries(client: QdrantClient, collection: str, n: int, noise: float, seed: int) -> np.ndarray:
+    """从 collection 里抽 n 个向量加噪声当 query（不需要调用 embedding API）。"""
+    points, _ = client.scroll(
+        collection_name=collection,
+        limit=max(n * 4, 64),
+        with_payload=False,
+        with_vectors=True,
+    )
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(points), size=min(n, len(points)), replace=False)
+    base = np.stack([point_vector(points[i]) for i in picked])
+    q = base + noise * rng.standard_normal(base.shape).astype(np.float32) / np.sqrt(base.shape[1])
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+def cmd_retrieval(args):
+    client = get_client(args)
+    collection = args.collection
+    if args.synthetic:
+        collection = collection or "ebcs_bench_synthetic"
+        build_synthetic_collection(client, collection, args.synthetic, args.dim, args.seed)
+
+    if args.questions:
+        with open(args.questions, encoding="utf-8") as f:
+            queries = app.embed_texts([line.strip() for line in f if line.strip()])
+    else:
+        queries = sample_queries(client, collection, args.queries, args.noise, args.seed)
+
+    k = args.limit
+    full_lat, two_lat = [], []
+    full_recall, two_recall = [], []
+    for q in queries:
+        exact = client.query_points(
+            collection_name=collection,
+            query=q,
+            using=app.FULL_VECTOR_NAME,
+            limit=k,
+            search_params=models.SearchParams(exact=True),
+        ).points
+        truth = {p.id for p in exact}
+
+        t0 = time.perf_counter()
+        full = client.query_points(
+            collection_name=collection,
+            query=q,
+            using=app.FULL_VECTOR_NAME,
+            limit=k,
+        ).points
+        full_lat.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        two = client.query_points(
+            collection_name=collection,
+            **app.vector_query_kwargs(q, limit=k, retrieval_mode="two_stage"),
+        ).points
+        two_lat.append(time.perf_counter() - t0)
+
+        full_recall.append(len(truth & {p.id for p in full}) / max(1, len(truth)))
+        two_recall.append(len(truth & {p.id for p in two}) / max(1, len(truth)))
+
+    print(f"collection={collection} queries={len(queries)} k={k} "
+          f"coarse_dim={app.COARSE_VECTOR_DIM} overfetch={app.COARSE_OVERFETCH}")
+    print(f"full      : {summarize_ms(full_lat)} | recall@{k} {np.mean(full_recall):.3f}")
+    print(f"two_stage : {summarize_ms(two_lat)} | recall@{k} {np.mean(two_recall):.3f}")
+
+
+# -----------------------
+# Server-side formula scoring vs Python scoring
+# -----------------------
+
+def compare_result_lists(label: str, expected, actual, names=("expected", "actual")) -> int:
+    """分数序列需在 1e-4 内一致，id 集合需一致（同分时顺序可以不同）；返回不一致的列表数。"""
+    mismatches = 0
+    for exp, act in zip(expected, actual):
+        exp_scores = np.array([s for _, s in exp])
+        act_scores = np.array([s for _, s in act])
+        same = (
+            len(exp) == len(act)
+            and np.allclose(exp_scores, act_scores, atol=1e-4)
+            and {it.id for it, _ in exp} == {it.id for it, _ in act}
+        )
+        if not same:
+            mismatches += 1
+            print(f"MISMATCH {label}")
+            print(f"  {names[0]}:", [(it.id, round(s, 4)) for it, s in exp])
+            print(f"  {names[1]}:", [(it.id, round(s, 4)) for it, s in act])
+    return mismatches
+
+
+# bonus 用到的字段；fixture 里随机删掉 / 置 null，覆盖 python_bonus 的默认值和 item → doc 回退
+SCORING_FIXTURE_FIELDS = {
+    "policy": ["item_stage", "doc_stage", "item_mode", "doc_mode"],
+    "thesis": ["stage", "mode", "role"],
+}
+
+
+def build_scoring_fixture(client: QdrantClient, n: int, dim: int, seed: int) -> Dict[str, str]:
+    """
+    在 client（一般是 QdrantClient(":memory:")）里建 policy / thesis 两个 fixture collection：
+    随机单位向量 + synthetic_payloads，bonus 字段各有约 25% 缺失、约 10% 为 null；
+    role 另有一部分取非默认值。返回 {"policy": name, "thesis": name}。
+    """
+    rng = np.random.default_rng(seed)
+    names = {}
+    for kind, fields in SCORING_FIXTURE_FIELDS.items():
+        name = f"scoring_fixture_{kind}"
+        if client.collection_exists(name):
+            client.delete_collection(name)
+        client.create_collection(
+            collection_name=name,
+            vectors_config=models.VectorParams(size=dim, distance=models.Distance.COSINE),
+        )
+        vecs = rng.standard_normal((n, dim)).astype(np.float32)
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+        payloads = synthetic_payloads(kind, n, rng)
+        for p in payloads:
+            if kind == "thesis" and rng.random() < 0.3:
+                p["role"] = "design_precedent"
+            for field in fields:
+                u = rng.random()
+                if u < 0.25:
+                    p.pop(field, None)
+                elif u < 0.35:
+                    p[field] = None
+        client.upsert(
+            collection_name=name,
+            points=[models.PointStruct(id=i, vector=v.tolist(), payload=p)
+                    for i, (v, p) in enumerate(zip(vecs, payloads))],
+        )
+        names[kind] = name
+    return names
+
+
+def cmd_scoring_equivalence(args):
+    """
+    对随机 stage/mode/gap 组合，比较 scoring="python" 和 scoring="server" 的 top_k：
+    分数序列需在 1e-4 内一致，id 集合需一致（同分时顺序可以不同）。
+    --fixture N：不连外部 Qdrant，在 QdrantClient(":memory:") 里建带缺失 / null 字段的 fixture collection
+    （每个 N 个点），自包含地跑同样的比较。
+    """
+    if args.fixture:
+        client = QdrantClient(location=":memory:")
+        names = build_scoring_fixture(client, args.fixture, args.dim, args.seed)
+        args.policy_collection, args.thesis_collection = names["policy"], names["thesis"]
+        args.retrieval_mode = "full"
+    else:
+        client = get_client(args)
+    rng = np.random.default_rng(args.seed)
+    mismatches = 0
+    checked = 0
+    for repo_cls, collection, top_k in (
+        (app.PolicyRepository, args.policy_collection, 10),
+        (app.ThesisRepository, args.thesis_collection, 12),
+    ):
+        python_repo = repo_cls(client, collection, retrieval_mode=args.retrieval_mode, scoring="python")
+        server_repo = repo_cls(client, collection, retrieval_mode=args.retrieval_mode, scoring="server")
+        queries = list(sample_queries(client, collection, args.queries, args.noise, args.seed))
+        for _ in range(args.combos):
+            stage = str(rng.choice(app.STAGES))
+            mode = str(rng.choice(app.MODES))
+            gap = str(rng.choice(app.GAPS))
+
+            t0 = time.perf_counter()
+            expected = python_repo.batch_scored_search(queries, stage, mode, gap, top_k=top_k)
+            t_python = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            actual = server_repo.batch_scored_search(queries, stage, mode, gap, top_k=top_k)
+            t_server = time.perf_counter() - t0
+            if server_repo.active_scoring() != "server":
+                raise SystemExit(f"{collection}: server-side scoring failed against this Qdrant (see log)")
+
+            checked += len(expected)
+            mismatches += compare_result_lists(f"{collection} stage={stage} mode={mode} gap={gap}",
+                                               expected, actual, ("python", "server"))
+            print(f"{collection:>20} {stage}/{mode}/{gap}: python {t_python * 1000:6.1f} ms, "
+                  f"server {t_server * 1000:6.1f} ms")
+
+    print(f"checked {checked} result lists, {mismatches} mismatches")
+    if mismatches:
+        raise SystemExit(1)
+
+
+# -----------------------
+# 本地 mmap 后端：导出 + 与 Qdrant 的一致性 / 延迟对比
+# -----------------------
+
+def cmd_export_local(args):
+    """把 Qdrant collection 导出成 local 后端读取的目录：vectors.npy（L2 归一化）+ payloads.jsonl。"""
+    client = get_client(args)
+    out_dir = Path(args.out or app.LOCAL_INDEX_DIR) / (args.name or args.collection)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    vectors = []
+    tmp_payloads = out_dir / "payloads.jsonl.tmp"
+    offset = None
+    with open(tmp_payloads, "w", encoding="utf-8") as f:
+        while True:
+            points, offset = client.scroll(
+                collection_name=args.collection,
+                limit=args.batch,
+                offset=offset,
+                with_payload=True,
+                with_vectors=True,
+            )
+            for p in points:
+                vectors.append(point_vector(p))
+                f.write(json.dumps({"id": p.id, "payload": p.payload or {}}, ensure_ascii=False) + "\n")
+            if offset is None or not points:
+                break
+    matrix = np.stack(vectors).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-9
+    # 先写临时文件再 rename：正在 mmap 旧文件的进程不受影响
+    tmp_vectors = out_dir / "vectors.tmp.npy"
+    np.save(tmp_vectors, matrix)
+    os.replace(tmp_vectors, out_dir / "vectors.npy")
+    os.replace(tmp_payloads, out_dir / "payloads.jsonl")
+    print(f"exported {matrix.shape[0]} x {matrix.shape[1]} vectors to {out_dir} "
+          f"({matrix.nbytes / 1024 / 1024:.1f} MiB)")
+
+
+def cmd_local_equivalence(args):
+    """local 后端 vs Qdrant（python scoring）的 top_k 一致性和延迟；local 目录需先 export-local。"""
+    client = get_client(args)
+    rng = np.random.default_rng(args.seed)
+    mismatches = 0
+    checked = 0
+    for repo_cls, collection, top_k in (
+        (app.PolicyRepository, args.policy_collection, 10),
+        (app.ThesisRepository, args.thesis_collection, 12),
+    ):
+        qdrant_repo = repo_cls(client, collection, scoring="python")
+        local_repo = repo_cls(None, collection, local_index=app.LocalVectorIndex(
+            Path(args.local_dir or app.LOCAL_INDEX_DIR) / collection, tuple(repo_cls.markdown_fields)
+        ))
+        queries = list(sample_queries(client, collection, args.queries, args.noise, args.seed))
+        qdrant_lat, local_lat = [], []
+        for _ in range(args.combos):
+            stage = str(rng.choice(app.STAGES))
+            mode = str(rng.choice(app.MODES))
+            gap = str(rng.choice(app.GAPS))
+
+            t0 = time.perf_counter()
+            expected = qdrant_repo.batch_scored_search(queries, stage, mode, gap, top_k=top_k)
+            qdrant_lat.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            actual = local_repo.batch_scored_search(queries, stage, mode, gap, top_k=top_k)
+            local_lat.append(time.perf_counter() - t0)
+
+            checked += len(expected)
+            mismatches += compare_result_lists(f"{collection} stage={stage} mode={mode} gap={gap}",
+                                               expected, actual, ("qdrant", "local"))
+        print(f"{collection:>20} qdrant: {summarize_ms(qdrant_lat)}")
+        print(f"{collection:>20} local : {summarize_ms(local_lat)}")
+
+    print(f"checked {checked} result lists, {mismatches} mismatches")
+    if mismatches:
+        raise SystemExit(1)
+
+
+# -----------------------
+# 检索命中对象的内存占用：旧的 __dict__ 对象 vs slots + raw_id intern
+# -----------------------
+
+class LegacyPolicyItem:
+    """改造前的 PolicyItemFromPayload（每个 hit 一个带 __dict__ 的新对象），只用于对比。"""
+
+    def __init__(self, payload: dict, point_id=None):
+        self.id = payload["raw_id"]
+        self.point_id = point_id
+        self.label = payload.get("label")
+        self.description = payload.get("description")
+        self.risk_level = payload.get("risk_level")
+        self.doc_title = payload.get("doc_title")
+        self.doc_stage = payload.get("doc_stage")
+        self.doc_mode = payload.get("doc_mode")
+        self.item_stage = payload.get("item_stage", self.doc_stage)
+        self.item_mode = payload.get("item_mode", self.doc_mode)
+        self.source_type = "policy"
+        self.source_path = payload.get("source_path")
+        self._raw_md = payload.get("source_chunk_md")
+        self.embedding = None
+
+
+class LegacyThesisSegment:
+    def __init__(self, payload: dict, point_id=None):
+        self.id = payload["raw_id"]
+        self.point_id = point_id
+        self.label = payload.get("label", "")
+        self.summary = payload.get("summary") or payload.get("description") or ""
+        self.stage = payload.get("stage", payload.get("item_stage", "other"))
+        self.mode = payload.get("mode", payload.get("item_mode", "precedents"))
+        self.field = payload.get("field", "unknown")
+        self.source_path = payload.get("source_path")
+        self.doc_title = payload.get("doc_title")
+        self.source_type = payload.get("source_type", "thesis")
+        self.role = payload.get("role", "technical_precedent")
+        self.domain_tags = payload.get("domain_tags", [])
+        self.construct_tags = payload.get("construct_tags", [])
+        self.user_tags = payload.get("user_tags", [])
+        self.metric_tags = payload.get("metric_tags", [])
+        self._raw_md = payload.get("raw_excerpt_md") or payload.get("source_chunk_md")
+        self.embedding = None
+
+
+def synthetic_payloads(kind: str, n: int, rng) -> List[Dict]:
+    payloads = []
+    for i in range(n):
+        stage = str(rng.choice(app.STAGES))
+        mode = str(rng.choice(app.MODES))
+        p = {
+            "raw_id": f"{kind}-{i}",
+            "label": f"{kind} item {i}",
+            "description": "lorem ipsum " * int(rng.integers(5, 30)),
+            "doc_title": f"{kind} document {i // 10}",
+            "source_path": f"docs/{kind}/{i // 10}.md",
+        }
+        if kind == "policy":
+            p.update(doc_stage=stage, doc_mode=mode, item_stage=stage, item_mode=mode, risk_level="medium")
+        else:
+            p.update(stage=stage, mode=mode, field="hci", role="technical_precedent",
+                     domain_tags=["health"], construct_tags=["trust"], user_tags=[], metric_tags=["sus"])
+        payloads.append(p)
+    return payloads
+
+
+def legacy_rank_hits(repo, hits, stage, mode, gap, top_k):
+    """改造前 _rank_hits 的行为：每个 hit 都构造新对象，再排序截断。"""
+    legacy_cls = LegacyPolicyItem if repo.item_cls is app.PolicyItemFromPayload else LegacyThesisSegment
+    results = []
+    for h in hits:
+        p = h.payload or {}
+        results.append((legacy_cls(p, point_id=h.id), float(h.score + repo.python_bonus(p, stage, mode, gap))))
+    results.sort(key=lambda x: x[1], reverse=True)
+    return results[:top_k]
+
+
+def cmd_memory(args):
+    """
+    模拟 args.turns 个 turn（每个 turn args.subqueries 个子查询，policy / thesis 各 fetch_limit 个 hit），
+    用 tracemalloc 统计每个 turn 检索结果对象的分配量（峰值 + turn 结束时仍被结果持有的部分）。
+    """
+    rng = np.random.default_rng(args.seed)
+    corpora = {
+        app.PolicyRepository: synthetic_payloads("policy", args.corpus, rng),
+        app.ThesisRepository: synthetic_payloads("thesis", args.corpus, rng),
+    }
+    repos = [cls(None, cls.__name__, scoring="python") for cls in corpora]
+
+    turns = []
+    for _ in range(args.turns):
+        stage, mode, gap = str(rng.choice(app.STAGES)), str(rng.choice(app.MODES)), str(rng.choice(app.GAPS))
+        per_repo = []
+        for repo in repos:
+            corpus = corpora[type(repo)]
+            subqueries = []
+            for _ in range(args.subqueries):
+                idx = rng.choice(len(corpus), size=repo.fetch_limit, replace=False)
+                scores = np.sort(rng.random(repo.fetch_limit))[::-1]
+                subqueries.append([
+                    SimpleNamespace(id=int(i), payload=corpus[i], score=float(s)) for i, s in zip(idx, scores)
+                ])
+            per_repo.append((repo, subqueries))
+        turns.append((stage, mode, gap, per_repo))
+
+    top_k = {app.PolicyRepository: 10, app.ThesisRepository: 12}
+
+    def run(rank_fn, label):
+        retained, peaks, blocks = [], [], []
+        kept = []  # 模拟 session_state 里跨 turn 保留的结果
+        tracemalloc.start()
+        for stage, mode, gap, per_repo in turns:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            snap_before = tracemalloc.take_snapshot()
+            results = [
+                rank_fn(repo, hits, stage, mode, gap, top_k[type(repo)])
+                for repo, subqueries in per_repo
+                for hits in subqueries
+            ]
+            after, peak = tracemalloc.get_traced_memory()
+            snap_after = tracemalloc.take_snapshot()
+            kept.append(results)
+            retained.append(after - before)
+            peaks.append(peak - before)
+            blocks.append(sum(s.count_diff for s in snap_after.compare_to(snap_before, "filename")
+                              if s.count_diff > 0))
+        tracemalloc.stop()
+        print(f"{label:>14}: retained {np.mean(retained) / 1024:8.1f} KiB/turn | "
+              f"peak {np.mean(peaks) / 1024:8.1f} KiB/turn | new blocks {np.mean(blocks):8.0f}/turn")
+
+    run(legacy_rank_hits, "before (dict)")
+    app.get_payload_intern_cache.clear()
+    run(lambda repo, *a: repo._rank_hits(*a), "after (slots)")
+    print(f"intern cache: {app.get_payload_intern_cache().stats}")
+
+
+# -----------------------
+# reranker：LLM vs 本地特征打分的延迟和一致性
+# -----------------------
+
+def spearman(a: np.ndarray, b: np.ndarray) -> float:
+    if len(a) < 2:
+        return float("nan")
+    ra = np.argsort(np.argsort(a)).astype(np.float64)
+    rb = np.argsort(np.argsort(b)).astype(np.float64)
+    if ra.std() == 0 or rb.std() == 0:
+        return float("nan")
+    return float(np.corrcoef(ra, rb)[0, 1])
+
+
+def cmd_rerank(args):
+    """
+    对真实问题跑一遍检索，用同一批候选分别调 LLM reranker 和本地 reranker：
+    延迟（LLM 每个问题只调一次，避免命中 call_llm 缓存），以及两者在
+    helpfulness 排序（Spearman）、top-k 重合、role 一致、gap_tags Jaccard 上的一致性。
+    需要 OpenAI key（子查询 / embedding / LLM rerank）和 app 配置的向量后端。
+    """
+    questions = [q.strip() for q in Path(args.questions).read_text(encoding="utf-8").splitlines() if q.strip()]
+    policy_repo, thesis_repo = app.load_repositories()
+    rng = np.random.default_rng(args.seed)
+    llm, local = app.LLMReranker(), app.get_reranker(args.local)
+    lat = {"llm": [], "local": []}
+    rhos, overlaps, role_agree, tag_jaccard = [], [], [], []
+
+    for question in questions[: args.limit]:
+        stage, mode, gap = str(rng.choice(app.STAGES)), str(rng.choice(app.MODES)), str(rng.choice(app.GAPS))
+        fused = app.retrieve_candidates(question, stage, mode, gap, policy_repo, thesis_repo)
+        if not fused:
+            continue
+        candidates = app.rerank_candidates(fused)
+        query_emb = app.embed_text(question)
+        vectors, has_vec = app.fetch_candidate_vectors(list(fused.values()), policy_repo, thesis_repo)
+
+        t0 = time.perf_counter()
+        expected = llm.rerank(question, query_emb, candidates, top_k=args.top_k)
+        lat["llm"].append(time.perf_counter() - t0)
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            actual = local.rerank(question, query_emb, candidates, vectors=vectors, has_vec=has_vec, top_k=args.top_k)
+            lat["local"].append(time.perf_counter() - t0)
+
+        common = [cid for cid in expected if cid in actual]
+        if not common:
+            print(f"no LLM judgements for: {question[:60]!r}")
+            continue
+        a = np.array([expected[cid]["score"] for cid in common])
+        b = np.array([actual[cid]["score"] for cid in common])
+        rhos.append(spearman(a, b))
+        k = min(args.overlap_k, len(common))
+        top_a = {common[i] for i in np.argsort(-a, kind="stable")[:k]}
+        top_b = {common[i] for i in np.argsort(-b, kind="stable")[:k]}
+        overlaps.append(len(top_a & top_b) / k)
+        for cid in common:
+            role_agree.append(expected[cid]["role"] == actual[cid]["role"])
+            ta, tb = set(expected[cid]["tags"]), set(actual[cid]["tags"])
+            tag_jaccard.append(len(ta & tb) / len(ta | tb) if ta | tb else 1.0)
+
+    if not rhos:
+        raise SystemExit("no comparable questions")
+    print(f"{'llm':>6}: {summarize_ms(lat['llm'])}")
+    print(f"{local.name:>6}: {summarize_ms(lat['local'])}")
+    print(f"questions {len(rhos)} | spearman(helpfulness) mean {np.nanmean(rhos):.3f} | "
+          f"top-{args.overlap_k} overlap {np.mean(overlaps):.2f} | role agreement {np.mean(role_agree):.2f} | "
+          f"gap_tags jaccard {np.mean(tag_jaccard):.2f}")
+
+
+# -----------------------
+# intake：route_and_maybe_ask + generate_subqueries（两次调用）vs run_intake（一次 parse）
+# -----------------------
+
+def cmd_intake(args):
+    """
+    同一批问题上比较分开的两次 LLM 调用和合并 intake 的端到端延迟，以及路由结果的一致性。
+    关掉 call_llm 的响应缓存，保证每次都是真实 round-trip；需要 OpenAI key。
+    """
+    questions = [q.strip() for q in Path(args.questions).read_text(encoding="utf-8").splitlines() if q.strip()]
+    app.LLM_CACHE_TTLS.clear()
+    lat = {"split": [], "fused": []}
+    agree = {"stage": 0, "mode": 0, "gap": 0, "enough_info": 0}
+    n_subqueries = {"split": [], "fused": []}
+    compared = 0
+
+    for question in questions[: args.limit]:
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            routing = app.route_and_maybe_ask(question)
+            split_queries = []
+            if routing["enough_info"]:
+                split_queries = app.generate_subqueries(question, routing["stage"], routing["mode"], routing["gap"])
+            lat["split"].append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            fused = app.run_intake(question)
+            lat["fused"].append(time.perf_counter() - t0)
+            if fused is None:
+                print(f"fused intake failed for: {question[:60]!r}")
+                continue
+
+            fused_routing, fused_queries = fused
+            compared += 1
+            for key in agree:
+                agree[key] += routing[key] == fused_routing[key]
+            if routing["enough_info"]:
+                n_subqueries["split"].append(len(split_queries))
+            if fused_routing["enough_info"]:
+                n_subqueries["fused"].append(len(fused_queries))
+
+    print(f"{'split':>6}: {summarize_ms(lat['split'])}")
+    print(f"{'fused':>6}: {summarize_ms(lat['fused'])}")
+    if compared:
+        print("routing agreement: " + ", ".join(f"{k} {v / compared:.2f}" for k, v in agree.items())
+              + f" ({compared} runs)")
+    for mode, counts in n_subqueries.items():
+        if counts:
+            print(f"{mode:>6}: {np.mean(counts):.1f} subqueries per enough_info turn")
+
+
+# -----------------------
+# 本地路由：拟合原型 + 与 LLM 路由的一致性 / 省下的时间
+# -----------------------
+
+def load_router_examples(args) -> List[Dict]:
+    """--labelled: JSONL，每行 {"text", "stage", "mode", "gap"}；--questions: 纯文本问题，用 LLM 路由打标签。"""
+    if args.labelled:
+        lines = Path(args.labelled).read_text(encoding="utf-8").splitlines()
+        return [json.loads(line) for line in lines if line.strip()]
+    app.LLM_CACHE_TTLS.clear()
+    questions = [q.strip() for q in Path(args.questions).read_text(encoding="utf-8").splitlines() if q.strip()]
+    examples = []
+    for question in questions:
+        routing = app.route_and_maybe_ask(question)
+        examples.append({"text": question, **{axis: routing[axis] for axis in app.LocalRouter.axes}})
+    return examples
+
+
+def cmd_fit_router(args):
+    """每个标签的质心 = 种子描述 embedding 和该标签所有样本 embedding 的均值，写到 npz。"""
+    examples = load_router_examples(args)
+    seed = app.LocalRouter.from_descriptions()
+    embs = app.embed_texts([ex["text"] for ex in examples])
+    prototypes = {}
+    for axis in app.LocalRouter.axes:
+        labels, seed_centroids = seed.prototypes[axis]
+        centroids = []
+        for label, seed_vec in zip(labels, seed_centroids):
+            rows = [embs[i] for i, ex in enumerate(examples) if ex.get(axis) == label and embs[i].any()]
+            unit = [r / np.linalg.norm(r) for r in rows]
+            centroids.append(np.mean([seed_vec, *unit], axis=0))
+            print(f"{axis:>5} {label:>15}: {len(rows)} examples")
+        prototypes[axis] = (labels, np.stack(centroids))
+    out = args.out or app.ROUTER_PROTOTYPES_PATH
+    app.LocalRouter(prototypes).save(out)
+    print(f"wrote {out} from {len(examples)} examples")
+
+
+def cmd_router(args):
+    """
+    本地路由 vs LLM 路由（关掉响应缓存）：每个轴的一致率（全部问题 / 本地会直接决定的问题）、
+    enough_info 和 LLM 的一致情况（本地只会判 False：看这些轮 LLM 是否也判 False，以及 LLM 判 False 的轮
+    本地接住了多少）、本地决定的比例，以及每轮平均省下的时间
+    （本地决定的轮省掉 LLM 延迟，其余轮多付本地那一点开销）。
+    """
+    questions = [q.strip() for q in Path(args.questions).read_text(encoding="utf-8").splitlines() if q.strip()]
+    questions = questions[: args.limit]
+    app.LLM_CACHE_TTLS.clear()
+    router = app.LocalRouter.load(args.prototypes) if args.prototypes else app.get_local_router()
+    if router is None:
+        raise SystemExit("local router unavailable")
+
+    llm_lat, local_lat, saved = [], [], []
+    outcomes = {"local": 0, "llm_low_confidence": 0, "llm_enough_info": 0}
+    keys = (*app.LocalRouter.axes, "enough_info")
+    agree_all = dict.fromkeys(app.LocalRouter.axes, 0)
+    agree_local = dict.fromkeys(keys, 0)
+    # 槽位检查（缺 ≥2 个 → 本地判 enough_info=False）对比 LLM 的 enough_info，不看轴置信度
+    slots_vs_llm = Counter()
+
+    for question in questions:
+        t0 = time.perf_counter()
+        expected = app.route_and_maybe_ask(question)
+        llm_s = time.perf_counter() - t0
+        llm_lat.append(llm_s)
+
+        t0 = time.perf_counter()
+        labels = router.classify(app.embed_text(question))
+        missing = app.missing_intake_slots(question)
+        routing, outcome = app.decide_local_route(labels, missing)
+        local_s = time.perf_counter() - t0
+        local_lat.append(local_s)
+        outcomes[outcome] += 1
+
+        for axis in app.LocalRouter.axes:
+            agree_all[axis] += labels[axis][0] == expected[axis]
+        slots_vs_llm[(len(missing) >= 2, bool(expected["enough_info"]))] += 1
+        if routing is not None:
+            saved.append(llm_s - local_s)
+            for key in keys:
+                agree_local[key] += routing[key] == expected[key]
+        else:
+            saved.append(-local_s)
+
+    n, n_local = len(questions), outcomes["local"]
+    print(f"{'llm':>6}: {summarize_ms(llm_lat)}")
+    print(f"{'local':>6}: {summarize_ms(local_lat)}  (embedding included; cached texts are much faster)")
+    print("decisions: " + ", ".join(f"{k} {v}" for k, v in outcomes.items()) + f" (of {n})")
+    print("agreement, all questions: " + ", ".join(f"{k} {v / n:.2f}" for k, v in agree_all.items()))
+    if n_local:
+        print("agreement, locally routed: " + ", ".join(f"{k} {v / n_local:.2f}" for k, v in agree_local.items()))
+    flagged = slots_vs_llm[(True, False)] + slots_vs_llm[(True, True)]
+    llm_false = slots_vs_llm[(True, False)] + slots_vs_llm[(False, False)]
+    print(f"enough_info: slot check says 'missing' on {flagged}/{n}, LLM agrees (False) on "
+          f"{slots_vs_llm[(True, False)]}/{flagged}; LLM says False on {llm_false}/{n}, "
+          f"slot check catches {slots_vs_llm[(True, False)]}/{llm_false}")
+    print(f"time saved per turn: mean {np.mean(saved) * 1000:.0f} ms, total {np.sum(saved):.1f} s")
+
+
+# -----------------------
+# 滚动对话记忆：预算内不折叠；超预算时后台批量折叠，不阻塞 update()（不需要网络 / key）
+# -----------------------
+
+def cmd_context_memory(args):
+    """
+    用一个计数 + sleep 的假 call_llm 模拟一段会话：
+    - 短消息（总量在 CONTEXT_FOLD_TOKENS 内）：不能有任何 summary 调用；
+    - 长消息：超预算后才折叠，每次折叠一批、同一时刻最多一个在跑，update() 不等 LLM。
+    不满足就非零退出。
+    """
+    calls = []
+
+    def fake_call_llm(system_prompt, user_prompt, timeout=None, site="default", **kwargs):
+        calls.append(len(json.loads(user_prompt)["new_notes"]))
+        time.sleep(args.llm_s)
+        return "summary"
+
+    original = app.call_llm
+    app.call_llm = fake_call_llm
+    failed = 0
+    try:
+        for label, words, expect_folds in (("short", 12, False), ("long", 120, True)):
+            calls.clear()
+            memory = app.RollingMemory()
+            msgs, update_ms = [], []
+            for i in range(args.turns):
+                msgs.append(f"note {i}: " + "thesis context " * (words // 2))
+                t0 = time.perf_counter()
+                memory.update(msgs)
+                update_ms.append((time.perf_counter() - t0) * 1000)
+                memory.context("route")
+                time.sleep(args.turn_s)
+            if memory.pending is not None:
+                memory.pending.result()
+            total = app.estimate_tokens("\n".join(msgs))
+            ok = bool(calls) == expect_folds and max(update_ms) < args.llm_s * 1000 / 2
+            failed += not ok
+            print(f"{'ok' if ok else 'FAIL':>4}  {label}: {args.turns} messages, ≈{total} tokens "
+                  f"(fold at {app.CONTEXT_FOLD_TOKENS}): {len(calls)} summary calls, batch sizes {calls}, "
+                  f"max update() {max(update_ms):.1f} ms")
+    finally:
+        app.call_llm = original
+    if failed:
+        raise SystemExit(f"{failed} check(s) failed")
+
+
+# -----------------------
+# 熔断器：half_open 探测被 rerun / stop 打断后不能卡死（不需要网络 / key）
+# -----------------------
+
+def cmd_breaker_probe(args):
+    """
+    把进程级熔断器拨到 cooldown 已过的 open，然后让探测请求分别被 StopException（Streamlit rerun / stop
+    都是 BaseException）和 KeyboardInterrupt 打断：之后 allow() 必须仍然放行一个新的探测，
+    探测成功后回到 closed。不满足就非零退出。
+    """
+    res = app.get_llm_resilience()
+    breaker = res.breaker
+    failed = 0
+
+    def expect(label: str, ok: bool):
+        nonlocal failed
+        failed += not ok
+        print(f"{'ok' if ok else 'FAIL':>4}  {label} (state={breaker.state}, probing={breaker._probing})")
+
+    def interrupted(exc: BaseException):
+        def fn(attempt_timeout: float):
+            raise exc
+        return fn
+
+    for exc in (StopException(), KeyboardInterrupt()):
+        breaker.record_failure()
+        breaker.state, breaker.opened_at = "open", time.monotonic() - breaker.cooldown_s
+        try:
+            app.resilient_call("bench", interrupted(exc), timeout=5.0, hedge=False)
+        except BaseException as e:
+            expect(f"probe interrupted by {type(e).__name__} is re-raised", e is exc)
+        expect("half_open probe slot released", breaker.state == "half_open" and not breaker._probing)
+        try:
+            expect("next probe allowed", app.resilient_call("bench", lambda t: "pong", hedge=False) == "pong")
+        except app.LLMUnavailable:
+            expect("next probe allowed", False)
+        expect("breaker closed after a successful probe", breaker.state == "closed")
+
+    if failed:
+        raise SystemExit(f"{failed} check(s) failed")
+
+# -----------------------
+# LLM 调用 profile：每个 profile 在 route / subqueries / plan 上的延迟和输出有效率
+# -----------------------
+
+def profile_output_valid(site: str, raw: str, result) -> bool:
+    """route / subqueries 看原始输出是不是合法 JSON；plan 看有没有退回模板 plan。"""
+    if site == "plan":
+        return result is not None and bool(result.recommendations)
+    try:
+        data = json.loads(raw or "")
+    except ValueError:
+        return False
+    if site == "route":
+        return data.get("stage") in app.STAGES and isinstance(data.get("enough_info"), bool)
+    return isinstance(data.get("queries"), list) and len(data["queries"]) > 0
+
+
+def cmd_profiles(args):
+    """
+    把 --profiles 里的每个 profile 依次挂到 --sites 的每个 call site 上（app.LLM_SITE_PROFILES），
+    对同一批问题跑真实调用（关掉响应缓存）：延迟分布、输出有效率、平均 output / reasoning token。
+    需要 OpenAI key。
+    """
+    questions = [q.strip() for q in Path(args.questions).read_text(encoding="utf-8").splitlines() if q.strip()]
+    questions = questions[: args.limit]
+    names = [n.strip() for n in args.profiles.split(",") if n.strip()] or list(app.LLM_PROFILES)
+    unknown = [n for n in names if n not in app.LLM_PROFILES]
+    if unknown:
+        raise SystemExit(f"unknown profiles: {unknown} (have {sorted(app.LLM_PROFILES)})")
+    sites = [s.strip() for s in args.sites.split(",") if s.strip()]
+    if set(sites) - {"route", "subqueries", "plan"}:
+        raise SystemExit(f"unsupported sites: {sorted(set(sites) - {'route', 'subqueries', 'plan'})}")
+    app.LLM_CACHE_TTLS.clear()
+
+    # 抓 call_llm 的原始输出（route / subqueries 解析失败时会静默走兜底，从返回值看不出来）
+    raw = {}
+    uncached = app._call_llm_uncached
+
+    def capture(system_prompt, user_prompt, timeout, site="default"):
+        raw[site] = uncached(system_prompt, user_prompt, timeout, site=site)
+        return raw[site]
+
+    app._call_llm_uncached = capture
+    original = dict(app.LLM_SITE_PROFILES)
+    try:
+        for site in sites:
+            print(f"--- {site}")
+            for name in names:
+                app.LLM_SITE_PROFILES[site] = name
+                profile = app.LLM_PROFILES[name]
+                meter = app.UsageMeter()
+                token = app.CURRENT_USAGE.set(meter)
+                lat, valid = [], 0
+                try:
+                    for question in questions:
+                        raw.clear()
+                        budget = app.TurnBudget()
+                        t0 = time.perf_counter()
+                        if site == "route":
+                            result = app.route_and_maybe_ask(question)
+                        elif site == "subqueries":
+                            result = app.generate_subqueries(question, "proposal", "exploration", "unknown")
+                        else:
+                            result = app.generate_coach_plan(question, "proposal", "plan_synthesis", "unknown",
+                                                             question, [], [], budget=budget)
+                            if "template_plan" in budget.degradations:
+                                result = None
+                        lat.append(time.perf_counter() - t0)
+                        valid += profile_output_valid(site, raw.get(site), result)
+                finally:
+                    app.CURRENT_USAGE.reset(token)
+                totals = meter.totals()
+                calls = max(totals["calls"], 1)
+                print(f"{name:>10} ({profile.model}, effort={profile.reasoning_effort}, "
+                      f"cap={profile.max_output_tokens}): {summarize_ms(lat)}")
+                print(f"{'':>10} valid {valid}/{len(questions)} | output tokens/call {totals['output_tokens'] / calls:.0f} "
+                      f"(reasoning {totals['reasoning_tokens'] / calls:.0f}) | cost ${totals['cost_usd']:.4f}")
+    finally:
+        app._call_llm_uncached = uncached
+        app.LLM_SITE_PROFILES.clear()
+        app.LLM_SITE_PROFILES.update(original)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="EBCS performance benchmarks")
+    parser.add_argument("--url", default=os.getenv("EBCS_BENCH_QDRANT_URL"))
+    parser.add_argument("--api-key", default=None)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("build-two-stage", help="copy a collection into full + coarse named vectors")
+    p.add_argument("--source", required=True)
+    p.add_argument("--target", required=True)
+    p.add_argument("--batch", type=int, default=128)
+    p.set_defaults(func=cmd_build_two_stage)
+
+    p = sub.add_parser("retrieval", help="latency / recall@k: full vs two-stage retrieval")
+    p.add_argument("--collection", default=None, help="collection built by build-two-stage")
+    p.add_argument("--synthetic", type=int, default=0, help="build a random corpus of N points instead")
+    p.add_argument("--dim", type=int, default=3072)
+    p.add_argument("--questions", default=None, help="text file, one question per line (uses the embedding API)")
+    p.add_argument("--queries", type=int, default=50)
+    p.add_argument("--noise", type=float, default=0.5)
+    p.add_argument("--limit", type=int, default=60)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=cmd_retrieval)
+
+    p = sub.add_parser("scoring-equivalence", help="server-side formula scoring vs Python bonus scoring")
+    p.add_argument("--policy-collection", default=app.POLICY_COLLECTION)
+    p.add_argument("--thesis-collection", default=app.THESES_COLLECTION)
+    p.add_argument("--retrieval-mode", default="full")
+    p.add_argument("--queries", type=int, default=8)
+    p.add_argument("--combos", type=int, default=20)
+    p.add_argument("--noise", type=float, default=0.5)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--fixture", type=int, default=0,
+                   help="self-contained: N fixture points per collection in an in-memory Qdrant (ignores --url)")
+    p.add_argument("--dim", type=int, default=64, help="vector size for --fixture")
+    p.set_defaults(func=cmd_scoring_equivalence)
+
+    p = sub.add_parser("memory", help="per-turn allocations of retrieval hit objects: before vs after interning")
+    p.add_argument("--turns", type=int, default=20)
+    p.add_argument("--subqueries", type=int, default=6)
+    p.add_argument("--corpus", type=int, default=400, help="synthetic payloads per collection")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=cmd_memory)
+
+    p = sub.add_parser("export-local", help="export a Qdrant collection for EBCS_VECTOR_BACKEND=local")
+    p.add_argument("--collection", required=True)
+    p.add_argument("--name", default=None, help="directory name under --out (default: collection name)")
+    p.add_argument("--out", default=None, help=f"default: EBCS_LOCAL_INDEX_DIR ({app.LOCAL_INDEX_DIR})")
+    p.add_argument("--batch", type=int, default=256)
+    p.set_defaults(func=cmd_export_local)
+
+    p = sub.add_parser("local-equivalence", help="local mmap backend vs Qdrant: top_k equality and latency")
+    p.add_argument("--policy-collection", default=app.POLICY_COLLECTION)
+    p.add_argument("--thesis-collection", default=app.THESES_COLLECTION)
+    p.add_argument("--local-dir", default=None)
+    p.add_argument("--queries", type=int, default=8)
+    p.add_argument("--combos", type=int, default=20)
+    p.add_argument("--noise", type=float, default=0.5)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=cmd_local_equivalence)
+
+    p = sub.add_parser("rerank", help="LLM reranker vs local reranker: latency and agreement")
+    p.add_argument("--questions", required=True, help="text file, one question per line")
+    p.add_argument("--local", default="local", choices=sorted(app.RERANKERS))
+    p.add_argument("--limit", type=int, default=20)
+    p.add_argument("--top-k", type=int, default=24, help="same as fuse_evidence: total_k * 2")
+    p.add_argument("--overlap-k", type=int, default=12)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=cmd_rerank)
+
+    p = sub.add_parser("intake", help="split routing + subqueries vs one fused intake call: latency")
+    p.add_argument("--questions", required=True, help="text file, one question per line")
+    p.add_argument("--limit", type=int, default=20)
+    p.add_argument("--repeat", type=int, default=1)
+    p.set_defaults(func=cmd_intake)
+
+    p = sub.add_parser("fit-router", help="fit local router prototypes from labelled conversations")
+    src = p.add_mutually_exclusive_group(required=True)
+    src.add_argument("--labelled", help='JSONL with {"text", "stage", "mode", "gap"} per line')
+    src.add_argument("--questions", help="text file, one question per line (labelled by the LLM router)")
+    p.add_argument("--out", default=None, help=f"default: EBCS_ROUTER_PROTOTYPES ({app.ROUTER_PROTOTYPES_PATH})")
+    p.set_defaults(func=cmd_fit_router)
+
+    p = sub.add_parser("router", help="local prototype router vs LLM router: agreement and time saved")
+    p.add_argument("--questions", required=True, help="text file, one question per line")
+    p.add_argument("--prototypes", default=None, help="npz from fit-router (default: the app's router)")
+    p.add_argument("--limit", type=int, default=50)
+    p.set_defaults(func=cmd_router)
+
+    p = sub.add_parser("context-memory", help="rolling memory: no summary calls within budget, folds off the critical path")
+    p.add_argument("--turns", type=int, default=20)
+    p.add_argument("--llm-s", type=float, default=0.2, help="simulated summary call latency")
+    p.add_argument("--turn-s", type=float, default=0.1, help="simulated time between turns")
+    p.set_defaults(func=cmd_context_memory)
+
+    p = sub.add_parser("breaker-probe", help="circuit breaker: an interrupted half-open probe must not wedge it")
+    p.set_defaults(func=cmd_breaker_probe)
+
+    p = sub.add_parser("profiles", help="sweep LLM call profiles over call sites: latency and output validity")
+    p.add_argument("--questions", required=True, help="text file, one question per line")
+    p.add_argument("--profiles", default="", help="comma-separated profile names (default: all)")
+    p.add_argument("--sites", default="route,subqueries,plan", help="comma-separated: route, subqueries, plan")
+    p.add_argument("--limit", type=int, default=10)
+    p.set_defaults(func=cmd_profiles)
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    args.func(args)